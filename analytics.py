@@ -0,0 +1,243 @@
+import math
+from datetime import datetime
+from typing import Optional
+
+from sleep_records import SleepRecords
+from sleep_store import MAX_VALID_SLEEP_MINUTES, SleepStore
+
+# 1日に必要とする睡眠時間（睡眠負債の計算に使う）
+SLEEP_TARGET_MINUTES = 7 * 60
+# 睡眠負債を数える日数
+SLEEP_DEBT_DAYS = 14
+MINUTES_PER_DAY = 24 * 60
+US_PER_MINUTE = 60 * 1_000_000
+US_PER_DAY = MINUTES_PER_DAY * US_PER_MINUTE
+
+
+def percentile(sorted_values, p: float) -> float:
+    # 線形補間のパーセンタイル（sorted_values は昇順）
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def circular_spread(minutes_of_day):
+    # 時刻（0時からの分）の平均と、ばらつき（円周標準偏差・分）。日付をまたぐ就寝時刻でも正しく扱う
+    if not minutes_of_day:
+        return None, None
+    scale = 2 * math.pi / MINUTES_PER_DAY
+    sin_sum = sum(math.sin(m * scale) for m in minutes_of_day)
+    cos_sum = sum(math.cos(m * scale) for m in minutes_of_day)
+    return circular_from_sums(sin_sum, cos_sum, len(minutes_of_day))
+
+
+def circular_from_sums(sin_sum: float, cos_sum: float, count: int):
+    # circular_spread と同じ値を、sin・cos の合計と件数から求める（記録を1件ずつ足していく場合に使う）
+    if not count:
+        return None, None
+    scale = 2 * math.pi / MINUTES_PER_DAY
+    mean = (math.atan2(sin_sum, cos_sum) / scale) % MINUTES_PER_DAY
+    resultant = min(1.0, math.hypot(sin_sum, cos_sum) / count)
+    if resultant <= 0:
+        return mean, MINUTES_PER_DAY / 2
+    return mean, math.sqrt(-2 * math.log(resultant)) / scale
+
+
+def _streaks(days, today: int):
+    # days は記録のある日（ローカル日付の通し番号）の集合。(現在の連続日数, 最長の連続日数)
+    longest = 0
+    for day in days:
+        if day - 1 in days:
+            continue
+        length = 1
+        while day + length in days:
+            length += 1
+        longest = max(longest, length)
+    current = 0
+    day = today if today in days else today - 1
+    while day in days:
+        current += 1
+        day -= 1
+    return current, longest
+
+
+def compute_user_stats(records: SleepRecords, now_us: int, utc_offset: int) -> Optional[dict]:
+    # 1ユーザー分の統計を列から計算する。200時間以上の記録（異常データ）は除く
+    durations = records.durations
+    ends = records.end_us
+    starts = records.start_us
+    offset_us = utc_offset * 1_000_000
+    valid = [
+        i for i in range(len(durations))
+        if durations[i] < MAX_VALID_SLEEP_MINUTES and records.raw(i) is None
+    ]
+    untimed = [
+        durations[i] for i in range(len(durations))
+        if durations[i] < MAX_VALID_SLEEP_MINUTES and records.raw(i) is not None
+    ]
+    all_durations = sorted([durations[i] for i in valid] + untimed)
+    if not all_durations:
+        return None
+
+    local_ends = [ends[i] + offset_us for i in valid]
+    local_starts = [starts[i] + offset_us for i in valid]
+    valid_durations = [durations[i] for i in valid]
+    today = (now_us + offset_us) // US_PER_DAY
+
+    # 起床日（ローカル日付）ごとの合計
+    per_day: dict = {}
+    for end, duration in zip(local_ends, valid_durations):
+        day = end // US_PER_DAY
+        per_day[day] = per_day.get(day, 0) + duration
+
+    def rolling(days):
+        first = today - days + 1
+        window = [total for day, total in per_day.items() if first <= day <= today]
+        return sum(window) / len(window) if window else None
+
+    debt_from = today - SLEEP_DEBT_DAYS + 1
+    sleep_debt = sum(
+        max(0, SLEEP_TARGET_MINUTES - total)
+        for day, total in per_day.items() if debt_from <= day <= today
+    )
+    bedtime_mean, bedtime_spread = circular_spread([(s % US_PER_DAY) / US_PER_MINUTE for s in local_starts])
+    wake_mean, wake_spread = circular_spread([(e % US_PER_DAY) / US_PER_MINUTE for e in local_ends])
+    current_streak, longest_streak = _streaks(per_day.keys(), today)
+
+    return {
+        'count': len(all_durations),
+        'mean_minutes': sum(all_durations) / len(all_durations),
+        'median_minutes': percentile(all_durations, 50),
+        'p10_minutes': percentile(all_durations, 10),
+        'p90_minutes': percentile(all_durations, 90),
+        'rolling_7d_minutes': rolling(7),
+        'rolling_30d_minutes': rolling(30),
+        'bedtime_mean': bedtime_mean,
+        'bedtime_spread_minutes': bedtime_spread,
+        'wake_mean': wake_mean,
+        'wake_spread_minutes': wake_spread,
+        'sleep_debt_minutes': sleep_debt,
+        'current_streak_days': current_streak,
+        'longest_streak_days': longest_streak,
+        # ギルド全体の分布を作るときに使う（昇順）
+        'durations': all_durations
+    }
+
+
+def combine_stats(user_stats: list) -> Optional[dict]:
+    # 複数ユーザーの統計をギルド全体の統計にまとめる
+    user_stats = [stats for stats in user_stats if stats is not None]
+    if not user_stats:
+        return None
+    pooled = sorted(d for stats in user_stats for d in stats['durations'])
+
+    def mean_of(key):
+        values = [stats[key] for stats in user_stats if stats[key] is not None]
+        return sum(values) / len(values) if values else None
+
+    return {
+        'users': len(user_stats),
+        'count': len(pooled),
+        'mean_minutes': sum(pooled) / len(pooled),
+        'median_minutes': percentile(pooled, 50),
+        'p10_minutes': percentile(pooled, 10),
+        'p90_minutes': percentile(pooled, 90),
+        'rolling_7d_minutes': mean_of('rolling_7d_minutes'),
+        'rolling_30d_minutes': mean_of('rolling_30d_minutes'),
+        'bedtime_spread_minutes': mean_of('bedtime_spread_minutes'),
+        'sleep_debt_minutes': mean_of('sleep_debt_minutes'),
+        'longest_streak_days': max(stats['longest_streak_days'] for stats in user_stats)
+    }
+
+
+class SleepAnalytics:
+    # ユーザーごとの統計をキャッシュする。記録が増減したとき（ストアの通知）だけ作り直す。
+    # 7日・30日の平均や連続日数は日付に依存するので、ローカル日付が変わったときも作り直す。
+
+    def __init__(self, store: SleepStore, tz):
+        self.store = store
+        self.tz = tz
+        self._users: dict = {}
+        self._guilds: dict = {}
+        self._version = 0
+        # アーカイブの中身が変わった回数（prefetch で読んでいる間に変わったら使わない）
+        self._archive_version = 0
+        store.add_listener(self._on_store_change)
+
+    def _on_store_change(self, user_id, op, record):
+        if op in ('clear', 'fold'):
+            self._archive_version += 1
+        if op in ('clear', 'import') or (op == 'wake' and record is not None):
+            self._users.pop(user_id, None)
+            self._version += 1
+
+    def _now(self, now: Optional[datetime]):
+        now = now or datetime.now(self.tz)
+        utc_offset = int(now.utcoffset().total_seconds())
+        now_us = int(now.timestamp()) * 1_000_000
+        return now_us, utc_offset, (now_us + utc_offset * 1_000_000) // US_PER_DAY
+
+    def user_stats(self, user_id, now: Optional[datetime] = None, archived: Optional[list] = None) -> Optional[dict]:
+        user_id = str(user_id)
+        now_us, utc_offset, today = self._now(now)
+        cached = self._users.get(user_id)
+        if cached is not None and cached[0] == today:
+            return cached[1]
+        stats = compute_user_stats(self.store.get_history_columns(user_id, archived), now_us, utc_offset)
+        self._users[user_id] = (today, stats)
+        return stats
+
+    def needs_archive(self, user_ids, now: Optional[datetime] = None) -> list:
+        # 統計をまだ作っておらず、作るのにアーカイブを読む必要があるユーザー
+        archive = self.store.archive
+        if archive is None:
+            return []
+        _, _, today = self._now(now)
+        missing = []
+        for user_id in user_ids:
+            user_id = str(user_id)
+            cached = self._users.get(user_id)
+            if (cached is None or cached[0] != today) and archive.months_of(user_id) and user_id in self.store:
+                missing.append(user_id)
+        return missing
+
+    async def prefetch(self, user_ids, io, now: Optional[datetime] = None, batch: int = 500):
+        # needs_archive のユーザーのアーカイブ済みの記録を I/O スレッドで batch 人ずつまとめて読み、統計を作っておく
+        # （user_stats / guild_stats がイベントループでアーカイブの gzip を読まないように）
+        for i in range(0, len(user_ids), batch):
+            chunk = user_ids[i:i + batch]
+            version = self._archive_version
+            archived = await io.run(self.store.archive.read_users, chunk)
+            if self._archive_version != version:
+                # 読んでいる間に記録がアーカイブに移った・消された。残りは user_stats がその場で読む
+                return
+            for user_id in chunk:
+                self.user_stats(user_id, now, archived.get(user_id, []))
+
+    def guild_stats(self, guild_id, user_ids, now: Optional[datetime] = None) -> Optional[dict]:
+        user_ids = [str(user_id) for user_id in user_ids if user_id in self.store]
+        _, _, today = self._now(now)
+        key = frozenset(user_ids)
+        cached = self._guilds.get(guild_id)
+        if cached is not None and cached[0] == (today, self._version, key):
+            return cached[1]
+        stats = combine_stats([self.user_stats(user_id, now) for user_id in user_ids])
+        self._guilds[guild_id] = ((today, self._version, key), stats)
+        return stats
+
+
+def format_minutes(minutes: Optional[float]) -> str:
+    if minutes is None:
+        return "記録なし"
+    minutes = int(round(minutes))
+    return f"{minutes // 60}時間{minutes % 60}分"
+
+
+def format_clock(minute_of_day: Optional[float]) -> str:
+    if minute_of_day is None:
+        return "記録なし"
+    minute_of_day = int(round(minute_of_day)) % MINUTES_PER_DAY
+    return f"{minute_of_day // 60:02d}:{minute_of_day % 60:02d}"
@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+# ボットのホットパスをネットワークなしで計測するベンチマーク。
+#   python -m benchmarks.bench_handlers --users 1000 --records 200
+#   python -m benchmarks.bench_handlers --users 100000 --records 50 --output after.json --compare before.json
+# データセットは --seed から決定的に生成するので、同じ引数なら実行間で比較できる。
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JST = timezone(timedelta(hours=9))
+# 150時間・200時間のルールに引っかからないよう、記録は実行日の朝を基準に並べる（形は毎回同じ）
+BASE_TIME = datetime.now(JST).replace(hour=7, minute=0, second=0, microsecond=0)
+
+
+def generate_dataset(path, users, max_records, seed, base_time=None):
+    # sleep_data.json と同じ形式で、1ユーザーずつ書き出す。base_time（既定は実行日の朝）より前の記録を作る
+    base_time = base_time or BASE_TIME
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{')
+        for i in range(users):
+            user_id = str(10 ** 17 + i)
+            count = rng.randint(0, max_records)
+            night = base_time - timedelta(days=count + 1)
+            records = []
+            for _ in range(count):
+                night += timedelta(days=1)
+                sleep_start = night.replace(hour=0, minute=0) - timedelta(minutes=rng.randint(-120, 120))
+                if rng.random() < 0.005:
+                    duration = rng.randint(200 * 60, 300 * 60)
+                else:
+                    duration = rng.randint(300, 600)
+                sleep_end = sleep_start + timedelta(minutes=duration)
+                records.append({
+                    'sleep_start': sleep_start.isoformat(),
+                    'sleep_end': sleep_end.isoformat(),
+                    'duration_minutes': duration
+                })
+            user_data = {'sleep_records': records}
+            if rng.random() < 0.3:
+                user_data['is_sleeping'] = True
+                user_data['sleep_start'] = (base_time - timedelta(minutes=rng.randint(10, 600))).isoformat()
+            else:
+                user_data['is_sleeping'] = False
+                if records:
+                    user_data['sleep_end'] = records[-1]['sleep_end']
+            if i:
+                f.write(',')
+            f.write(json.dumps(user_id))
+            f.write(':')
+            f.write(json.dumps(user_data, ensure_ascii=False))
+        f.write('}')
+    return [str(10 ** 17 + i) for i in range(users)]
+
+
+def summarize(samples, elapsed):
+    samples = sorted(samples)
+    count = len(samples)
+
+    def pct(p):
+        if not samples:
+            return 0.0
+        return samples[min(count - 1, int(p / 100 * count))] * 1000
+
+    return {
+        'ops': count,
+        'throughput_per_s': count / elapsed if elapsed else 0.0,
+        'mean_ms': sum(samples) / count * 1000 if count else 0.0,
+        'p50_ms': pct(50),
+        'p90_ms': pct(90),
+        'p99_ms': pct(99),
+        'max_ms': samples[-1] * 1000 if samples else 0.0
+    }
+
+
+class Bench:
+    def __init__(self, main, args, user_ids):
+        self.main = main
+        self.args = args
+        self.rng = random.Random(args.seed + 1)
+        self.user_ids = user_ids
+        from benchmarks.fakes import FakeChannel, FakeGuild, FakeMember, HttpStats
+        self.http = HttpStats()
+        self.channel = FakeChannel(stats=self.http)
+        statuses = [self.main.discord.Status.online, self.main.discord.Status.idle, self.main.discord.Status.offline]
+        guild_ids = self.rng.sample(user_ids, min(args.guild_size, len(user_ids)))
+        self.members = [
+            FakeMember(int(user_id), f'user{n}', self.rng.choice(statuses))
+            for n, user_id in enumerate(guild_ids)
+        ]
+        self.guild = FakeGuild(1, self.members)
+        self.partition = self.main.partitions.for_guild(self.guild)
+        self.results = {}
+
+    def _bytes_written(self):
+        store = self.partition.store
+        if hasattr(store, 'bytes_written'):
+            return store.bytes_written
+        total = 0
+        for suffix in ('', '-wal'):
+            path = store.path + suffix
+            if os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+
+    def interaction(self, member):
+        from benchmarks.fakes import FakeInteraction
+        return FakeInteraction(member, self.guild, self.channel, self.http)
+
+    async def measure(self, name, ops, fn):
+        samples = []
+        bytes_before = self._bytes_written()
+        http_before = self.http.total
+        started = time.perf_counter()
+        for i in range(ops):
+            t0 = time.perf_counter()
+            await fn(i)
+            samples.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - started
+        result = summarize(samples, elapsed)
+        result['bytes_written'] = self._bytes_written() - bytes_before
+        result['http_calls'] = self.http.total - http_before
+        self.results[name] = result
+
+    async def measure_loop_lag(self, name, save):
+        # save() の実行中、1ms ごとのタイマーがどれだけ遅れたか（イベントループが止まっていた時間）
+        loop = asyncio.get_running_loop()
+        samples = []
+        done = False
+
+        async def ticker():
+            while not done:
+                started = loop.time()
+                await asyncio.sleep(0.001)
+                samples.append(max(0.0, loop.time() - started - 0.001))
+
+        task = loop.create_task(ticker())
+        await asyncio.sleep(0.01)
+        bytes_before = self._bytes_written()
+        started = time.perf_counter()
+        await save()
+        elapsed = time.perf_counter() - started
+        done = True
+        await task
+        result = summarize(samples, elapsed)
+        result['bytes_written'] = self._bytes_written() - bytes_before
+        result['http_calls'] = 0
+        self.results[name] = result
+
+    async def run(self):
+        main = self.main
+        ops = self.args.ops
+        view = main.SleepTrackerView()
+
+        async def latest_info(i):
+            main.get_user_latest_sleep_info(self.partition, self.rng.choice(self.user_ids))
+
+        async def status(i):
+            member = self.rng.choice(self.members)
+            await main.send_all_members_status(self.interaction(member), str(member.id))
+
+        async def stats_button(i):
+            await view.stats_button.callback(self.interaction(self.rng.choice(self.members)))
+
+        async def sleep_wake(i):
+            member = self.rng.choice(self.members)
+            if self.partition.store.is_sleeping(member.id):
+                await view.wake_button.callback(self.interaction(member))
+            else:
+                await view.sleep_button.callback(self.interaction(member))
+
+        async def presence(i):
+            member = self.rng.choice(self.members)
+            before = member
+            after = member.with_status(
+                main.discord.Status.offline if member.status != main.discord.Status.offline
+                else main.discord.Status.online
+            )
+            member.status = after.status
+            await main.on_presence_update(before, after)
+
+        async def presence_flush(i):
+            self.partition.presence_pipeline.flush_due(force=True)
+
+        await self.measure('get_user_latest_sleep_info', ops, latest_info)
+        await self.measure('send_all_members_status', max(1, ops // 10), status)
+        await self.measure('stats_button', max(1, ops // 10), stats_button)
+        await self.measure('sleep_wake_buttons', ops, sleep_wake)
+        await self.measure('on_presence_update', ops, presence)
+        await self.measure('presence_flush', 1, presence_flush)
+
+        store = self.partition.store
+        if hasattr(store, 'flush_async') and getattr(store, 'io', None) is not None:
+            # スナップショットの書き出し（圧縮）をイベントループ上で行う場合と I/O スレッドで行う場合の比較
+            async def save_on_loop():
+                store.compact()
+
+            async def save_on_io():
+                store._journal_events = store.compact_every
+                store.mark_dirty()
+                await store.flush_async()
+
+            await self.measure_loop_lag('loop_lag_compact_on_loop', save_on_loop)
+            await self.measure_loop_lag('loop_lag_compact_on_io', save_on_io)
+
+
+def print_results(report, baseline=None):
+    print(f"users={report['params']['users']} records<={report['params']['records']} "
+          f"guild={report['params']['guild_size']} backend={report['params']['backend']}")
+    print(f"load: {report['load']['seconds']:.3f}s peak_alloc={report['load']['peak_alloc_bytes'] / 1e6:.1f}MB "
+          f"max_rss={report['max_rss_kb'] / 1024:.1f}MB")
+    header = f"{'scenario':<30}{'ops':>7}{'ops/s':>12}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'bytes':>12}{'http':>7}"
+    print(header)
+    for name, r in report['scenarios'].items():
+        line = (f"{name:<30}{r['ops']:>7}{r['throughput_per_s']:>12.1f}{r['p50_ms']:>10.3f}"
+                f"{r['p90_ms']:>10.3f}{r['p99_ms']:>10.3f}{r.get('max_ms', 0.0):>10.3f}{r['bytes_written']:>12}{r['http_calls']:>7}")
+        if baseline and name in baseline.get('scenarios', {}):
+            base = baseline['scenarios'][name]
+            if base['p50_ms']:
+                line += f"  p50 {r['p50_ms'] / base['p50_ms']:.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='睡眠トラッカーのハンドラのベンチマーク')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--records', type=int, default=200, help='1ユーザーあたりの最大記録数')
+    parser.add_argument('--guild-size', type=int, default=500)
+    parser.add_argument('--ops', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--output', help='結果を JSON で保存するファイル')
+    parser.add_argument('--compare', help='比較する以前の結果 (JSON)')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    compare = os.path.abspath(args.compare) if args.compare else None
+
+    workdir = tempfile.mkdtemp(prefix='sleepbench-')
+    user_ids = generate_dataset(os.path.join(workdir, 'sleep_data.json'), args.users, args.records, args.seed)
+
+    # main はカレントディレクトリの sleep_data.json を使うので、生成したデータのある場所で読み込む
+    os.environ['SLEEP_STORAGE_BACKEND'] = args.backend
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import main as bot_main
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    bot_main.load_state()
+    load_seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    bench = Bench(bot_main, args, user_ids)
+    asyncio.run(bench.run())
+    bot_main.partitions.close()
+
+    report = {
+        'params': {
+            'users': args.users,
+            'records': args.records,
+            'guild_size': args.guild_size,
+            'ops': args.ops,
+            'seed': args.seed,
+            'backend': args.backend
+        },
+        'machine': {'python': platform.python_version(), 'platform': platform.platform()},
+        'load': {'seconds': load_seconds, 'peak_alloc_bytes': peak},
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'scenarios': bench.results,
+        'http_calls': bench.http.calls
+    }
+
+    baseline = None
+    if compare:
+        with open(compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(report, baseline)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
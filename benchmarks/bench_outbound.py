@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+
+# 深夜0時に全員が「おやすみ」を押したときの Discord への送信を、ローカルの偽 API サーバーに対して再現する。
+#   python -m benchmarks.bench_outbound --users 40
+# baseline: 以前の動作（古いメッセージの削除を待ってから応答する。後片付けの優先度なし）
+# scheduler: OutboundScheduler + 削除の列（応答を先に送り、削除はまとめて後で送る）
+# どちらもクライアント側に discord.py と同じ方式のレート制限（残り0なら待つ・429なら Retry-After 後に再送）を入れる。
+# 偽サーバーの制限値は Discord の公開されている挙動に近づけたモデルで、実際の値とは異なる場合がある。
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# インタラクションに応答（defer）しなければならない時間
+ACK_DEADLINE = 3.0
+APPLICATION_ID = '900000000000000000'
+
+
+class FakeDiscord:
+    # ルート -> (回数, 秒)。major parameter ごとに数える。インタラクションの応答は制限なし
+    LIMITS = {
+        'POST /webhooks/{id}/{id}': (5, 2.0),
+        'DELETE /webhooks/{id}/{id}/messages/{id}': (5, 1.0),
+        'DELETE /channels/{id}/messages/{id}': (5, 1.0),
+        'POST /channels/{id}/messages/bulk-delete': (1, 1.0),
+    }
+    # インタラクション・webhook 以外に掛かる全体の制限（1秒あたり）
+    GLOBAL_LIMIT = 50
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self._windows: dict = {}
+        self._global = []
+        self._ids = itertools.count(10 ** 18)
+        self.requests = 0
+        self.rate_limited = 0
+
+    def _check(self, route: str, major: str):
+        # (許可するか, ヘッダー)
+        now = time.monotonic()
+        if not route.startswith(('POST /interactions', 'POST /webhooks', 'DELETE /webhooks')):
+            self._global = [t for t in self._global if now - t < 1.0]
+            if len(self._global) >= self.GLOBAL_LIMIT:
+                return False, {'Retry-After': f'{1.0 - (now - self._global[0]):.3f}', 'X-RateLimit-Global': 'true'}
+            self._global.append(now)
+        limit = self.LIMITS.get(route)
+        if limit is None:
+            return True, {}
+        count, period = limit
+        key = (route, major)
+        started, used = self._windows.get(key, (now, 0))
+        if now - started >= period:
+            started, used = now, 0
+        reset_after = period - (now - started)
+        headers = {
+            'X-RateLimit-Limit': str(count),
+            'X-RateLimit-Bucket': route.replace(' ', ':'),
+            'X-RateLimit-Reset-After': f'{reset_after:.3f}'
+        }
+        if used >= count:
+            headers['X-RateLimit-Remaining'] = '0'
+            headers['Retry-After'] = f'{reset_after:.3f}'
+            return False, headers
+        self._windows[key] = (started, used + 1)
+        headers['X-RateLimit-Remaining'] = str(count - used - 1)
+        return True, headers
+
+    async def handle(self, request):
+        from outbound import route_key
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        route, major = route_key(request.method, request.path)
+        allowed, headers = self._check(route, major)
+        if not allowed:
+            self.rate_limited += 1
+            return web.json_response({'message': 'You are being rate limited.', 'retry_after': float(headers['Retry-After'])},
+                                     status=429, headers=headers)
+        if request.method == 'POST' and route == 'POST /webhooks/{id}/{id}':
+            return web.json_response({'id': str(next(self._ids))}, headers=headers)
+        return web.Response(status=204, headers=headers)
+
+
+class DiscordLikeClient:
+    # discord.py の HTTPClient と同じ方式：バケットの残りが0ならリセットまで待ち、429 なら Retry-After 後に再送する
+    def __init__(self, session, base):
+        self.session = session
+        self.base = base
+        self._buckets: dict = {}
+
+    async def request(self, method, path, json=None):
+        from outbound import route_key
+        key = route_key(method, path)
+        while True:
+            bucket = self._buckets.get(key)
+            if bucket is not None and bucket[0] <= 0 and bucket[1] > time.monotonic():
+                await asyncio.sleep(bucket[1] - time.monotonic())
+            async with self.session.request(method, self.base + path, json=json) as response:
+                headers = response.headers
+                if 'X-RateLimit-Remaining' in headers:
+                    self._buckets[key] = (
+                        int(headers['X-RateLimit-Remaining']),
+                        time.monotonic() + float(headers.get('X-RateLimit-Reset-After', 0))
+                    )
+                if response.status == 429:
+                    await asyncio.sleep(float(headers.get('Retry-After', 1)))
+                    continue
+                if response.status == 204:
+                    return None
+                return await response.json()
+
+
+class HttpChannel:
+    def __init__(self, client, channel_id):
+        self.client = client
+        self.id = channel_id
+
+    async def delete_messages(self, messages):
+        await self.client.request('POST', f'/api/v10/channels/{self.id}/messages/bulk-delete',
+                                  json={'messages': [str(m.id) for m in messages]})
+
+
+class HttpFlags:
+    ephemeral = False
+
+
+class HttpWebhookMessage:
+    # interaction.followup.send() が返すメッセージ
+    def __init__(self, client, channel, token, message_id):
+        self.client = client
+        self.channel = channel
+        self.token = token
+        self.id = int(message_id)
+        self.flags = HttpFlags()
+        self.created_at = datetime.now(timezone.utc)
+
+    async def delete(self):
+        await self.client.request('DELETE', f'/api/v10/webhooks/{APPLICATION_ID}/{self.token}/messages/{self.id}')
+
+
+async def run_mode(mode, args, base):
+    sys.path.insert(0, REPO_ROOT)
+    from messages import MessageLifecycleManager
+    from outbound import OutboundScheduler
+
+    scheduler = OutboundScheduler() if mode == 'scheduler' else None
+    trace_configs = [scheduler.trace_config()] if scheduler else None
+    rng = random.Random(args.seed)
+    interaction_ids = itertools.count(10 ** 18)
+    results = {'ack': [], 'done': []}
+
+    async with aiohttp.ClientSession(trace_configs=trace_configs) as session:
+        client = DiscordLikeClient(session, base)
+        channel = HttpChannel(client, 1)
+        manager = MessageLifecycleManager()
+        if mode == 'scheduler':
+            runner = asyncio.ensure_future(manager.run())
+        else:
+            # 以前の自動削除タスク（期限が来たものをそのまま削除する。clear_user は削除の完了を待つ）
+            async def auto_delete():
+                while True:
+                    await manager.delete_messages(manager.pop_due())
+                    await asyncio.sleep(0.05)
+            runner = asyncio.ensure_future(auto_delete())
+
+        async def click(user_id, delay, record):
+            await asyncio.sleep(delay)
+            started = time.monotonic()
+            interaction_id = next(interaction_ids)
+            token = f'token{interaction_id}'
+            # clear_previous_messages → defer → ステータス → 確認メッセージ（2分後に自動削除）
+            await manager.clear_user(user_id)
+            await client.request('POST', f'/api/v10/interactions/{interaction_id}/{token}/callback', json={'type': 5})
+            acked = time.monotonic()
+            for _ in range(2):
+                data = await client.request('POST', f'/api/v10/webhooks/{APPLICATION_ID}/{token}', json={'content': 'x'})
+                message = HttpWebhookMessage(client, channel, token, data['id'])
+                manager.track(user_id, message)
+            manager.schedule_delete(message, args.auto_delete)
+            if record:
+                results['ack'].append(acked - started)
+                results['done'].append(time.monotonic() - started)
+
+        user_ids = [str(10 ** 17 + i) for i in range(args.users)]
+        # 1回目：それぞれのユーザーに古いメッセージを作る
+        await asyncio.gather(*(click(user_id, rng.uniform(0, args.window), False) for user_id in user_ids))
+        # 2回目（計測）：全員がほぼ同時に押す
+        started = time.monotonic()
+        await asyncio.gather(*(click(user_id, rng.uniform(0, args.window), True) for user_id in user_ids))
+        responses = time.monotonic() - started
+        # 自動削除・後片付けが終わるまで
+        while manager.pending_deletes:
+            await asyncio.sleep(0.05)
+        drained = time.monotonic() - started
+        runner.cancel()
+    return results, responses, drained, scheduler
+
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else 0.0
+
+
+async def main_async(args):
+    rows = []
+    for mode in ('baseline', 'scheduler'):
+        fake = FakeDiscord(args.latency)
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', fake.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        results, responses, drained, scheduler = await run_mode(mode, args, f'http://127.0.0.1:{port}')
+        await runner.cleanup()
+        rows.append((mode, results, responses, drained, fake, scheduler))
+
+    print(f"users={args.users} window={args.window}s latency={args.latency * 1000:.0f}ms auto_delete={args.auto_delete}s")
+    print(f"{'mode':<11}{'ack p50':>9}{'ack p95':>9}{'ack max':>9}{'>3s':>5}{'done p50':>10}{'done p95':>10}"
+          f"{'responses':>11}{'drained':>9}{'requests':>10}{'429':>6}")
+    for mode, results, responses, drained, fake, scheduler in rows:
+        ack = results['ack']
+        done = results['done']
+        late = sum(1 for value in ack if value > ACK_DEADLINE)
+        print(f"{mode:<11}{pct(ack, 50):>9.3f}{pct(ack, 95):>9.3f}{max(ack):>9.3f}{late:>5}{pct(done, 50):>10.3f}"
+              f"{pct(done, 95):>10.3f}{responses:>11.2f}{drained:>9.2f}{fake.requests:>10}{fake.rate_limited:>6}")
+        if scheduler is not None:
+            print(f"  scheduler: {scheduler.counters}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Discord への送信のベンチマーク（偽 API サーバー）')
+    parser.add_argument('--users', type=int, default=40)
+    parser.add_argument('--window', type=float, default=1.0, help='全員が押し終わるまでの秒数')
+    parser.add_argument('--latency', type=float, default=0.03, help='偽サーバーの応答時間（秒）')
+    parser.add_argument('--auto-delete', type=float, default=3.0, help='確認メッセージを自動削除するまでの秒数')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
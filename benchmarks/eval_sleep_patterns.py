@@ -0,0 +1,148 @@
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+# 自動就寝・自動起床の判断を、過去の記録に対してオフラインで評価する。
+#   python -m benchmarks.eval_sleep_patterns --data sleep_data.json
+#   python -m benchmarks.eval_sleep_patterns --users 200 --records 120
+# ユーザーごとに記録を古い順にたどり、それより前の記録だけで判断したものを、その記録と比べる。
+#  - 就寝：実際の就寝時刻にオフラインになった → 寝たとみなすべき。就寝の6時間前・12時間後 → みなすべきでない
+#  - 起床：実際の起床時刻にオンラインになった → 起きたとみなすべき。寝て1時間後・睡眠の途中 → みなすべきでない
+# legacy は以前の判断（オフラインなら常に就寝、平均睡眠時間 ±60分なら起床）。
+# --data がなければ、曜日で就寝時刻がずれる（週末は遅い）データを --seed から生成する。
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JST = timezone(timedelta(hours=9))
+START = datetime(2024, 1, 1, tzinfo=JST)
+LEGACY_WINDOW_MINUTES = 60
+
+
+def generate_records(rng, count):
+    # 平日の就寝時刻・週末のずれ・睡眠時間の平均がユーザーごとに違う記録
+    bedtime = rng.uniform(-120, 120)
+    weekend_shift = rng.uniform(0, 150)
+    jitter = rng.uniform(15, 60)
+    duration_mean = rng.uniform(330, 510)
+    records = []
+    for day in range(count):
+        night = START + timedelta(days=day)
+        weekend = night.weekday() in (4, 5)
+        start = night + timedelta(days=1, minutes=bedtime + (weekend_shift if weekend else 0) + rng.gauss(0, jitter))
+        duration = max(60, int(rng.gauss(duration_mean + (60 if weekend else 0), 40)))
+        end = start + timedelta(minutes=duration)
+        records.append({'sleep_start': start.isoformat(), 'sleep_end': end.isoformat(), 'duration_minutes': duration})
+    return records
+
+
+def load_users(args):
+    from sleep_store import JsonSleepStore
+    if args.data:
+        store = JsonSleepStore(args.data)
+        store.load()
+        users = {user_id: store.get_records(user_id) for user_id in store.user_ids()}
+        store.close()
+        return users
+    rng = random.Random(args.seed)
+    return {str(10 ** 17 + i): generate_records(rng, rng.randint(args.records // 2, args.records)) for i in range(args.users)}
+
+
+class Score:
+    def __init__(self):
+        self.tp = self.fp = self.tn = self.fn = 0
+
+    def add(self, predicted: bool, actual: bool):
+        if predicted and actual:
+            self.tp += 1
+        elif predicted:
+            self.fp += 1
+        elif actual:
+            self.fn += 1
+        else:
+            self.tn += 1
+
+    def line(self, name):
+        total = self.tp + self.fp + self.tn + self.fn
+        accuracy = (self.tp + self.tn) / total if total else 0.0
+        precision = self.tp / (self.tp + self.fp) if self.tp + self.fp else 0.0
+        recall = self.tp / (self.tp + self.fn) if self.tp + self.fn else 0.0
+        return f'{name:<18}{total:>8}{accuracy:>10.3f}{precision:>11.3f}{recall:>9.3f}{self.fp:>7}{self.fn:>7}'
+
+
+def evaluate(users):
+    from sleep_patterns import UserSleepPattern
+    from sleep_records import parse_iso
+    from sleep_store import MAX_VALID_SLEEP_MINUTES
+
+    offset_us = 9 * 3600 * 1_000_000
+    hour_us = 3600 * 1_000_000
+    scores = {name: Score() for name in ('sleep legacy', 'sleep pattern', 'wake legacy', 'wake pattern')}
+    decisions = 0
+    decision_seconds = 0.0
+    for records in users.values():
+        pattern = UserSleepPattern()
+        count = 0
+        total = 0
+        rows = []
+        for record in records:
+            try:
+                start_us, _ = parse_iso(record['sleep_start'])
+                end_us, _ = parse_iso(record['sleep_end'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            rows.append((start_us + offset_us, end_us + offset_us, record['duration_minutes']))
+        rows.sort()
+        for start, end, duration in rows:
+            if duration >= MAX_VALID_SLEEP_MINUTES or end <= start:
+                continue
+            average = total / count if count else 0
+            # (時刻, 寝たとみなすべきか)
+            for when, actual in ((start, True), (start - 6 * hour_us, False), (start + 12 * hour_us, False)):
+                started = time.perf_counter()
+                decision = pattern.should_sleep(when)
+                decision_seconds += time.perf_counter() - started
+                decisions += 1
+                scores['sleep legacy'].add(True, actual)
+                scores['sleep pattern'].add(True if decision is None else decision, actual)
+            for when, actual in ((end, True), (start + hour_us, False), ((start + end) // 2, False)):
+                if when >= end and not actual:
+                    continue
+                elapsed = (when - start) / 60_000_000
+                legacy = average > 0 and average - LEGACY_WINDOW_MINUTES <= elapsed <= average + LEGACY_WINDOW_MINUTES
+                started = time.perf_counter()
+                decision = pattern.should_wake(start, when)
+                decision_seconds += time.perf_counter() - started
+                decisions += 1
+                scores['wake legacy'].add(legacy, actual)
+                scores['wake pattern'].add(legacy if decision is None else decision, actual)
+            pattern.add(start, end, duration)
+            count += 1
+            total += duration
+    return scores, decisions, decision_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='自動就寝・自動起床の判断のオフライン評価')
+    parser.add_argument('--data', help='sleep_data.json（省略時は生成したデータを使う）')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--records', type=int, default=120, help='生成するユーザーあたりの最大記録数')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    users = load_users(args)
+    scores, decisions, decision_seconds = evaluate(users)
+
+    source = args.data or f'generated users={args.users} records<={args.records} seed={args.seed}'
+    print(f'data: {source} ({sum(len(records) for records in users.values())} records)')
+    print(f"{'decision':<18}{'cases':>8}{'accuracy':>10}{'precision':>11}{'recall':>9}{'FP':>7}{'FN':>7}")
+    for name, score in scores.items():
+        print(score.line(name))
+    if decisions:
+        print(f'pattern decision: {decision_seconds / decisions * 1e6:.2f} us/call ({decisions} calls)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import itertools
+from datetime import datetime, timezone
+
+import discord
+
+# ネットワークを使わずにハンドラを動かすための Interaction / Member / Guild の代用品
+
+_message_ids = itertools.count(10 ** 17)
+
+
+class FakeFlags:
+    def __init__(self, ephemeral=False):
+        self.ephemeral = ephemeral
+
+
+class FakeChannel:
+    def __init__(self, channel_id=1, stats=None):
+        self.id = channel_id
+        self.stats = stats if stats is not None else HttpStats()
+
+    async def delete_messages(self, messages):
+        self.stats.record('bulk_delete')
+
+    async def send(self, content=None, embed=None, **kwargs):
+        self.stats.record('send')
+        return FakeMessage(self, embed)
+
+    def get_partial_message(self, message_id):
+        message = FakeMessage(self)
+        message.id = message_id
+        return message
+
+
+class FakeMessage:
+    def __init__(self, channel, embed=None, ephemeral=False):
+        self.id = next(_message_ids)
+        self.channel = channel
+        self.embed = embed
+        self.flags = FakeFlags(ephemeral)
+        self.created_at = datetime.now(timezone.utc)
+
+    async def delete(self):
+        self.channel.stats.record('delete')
+
+    async def edit(self, **kwargs):
+        self.channel.stats.record('edit')
+        if 'embed' in kwargs:
+            self.embed = kwargs['embed']
+        return self
+
+
+class HttpStats:
+    # 送られるはずだった HTTP リクエストの種類ごとの回数
+    def __init__(self):
+        self.calls = {}
+
+    def record(self, kind):
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    @property
+    def total(self):
+        return sum(self.calls.values())
+
+
+class FakeMember:
+    def __init__(self, member_id, display_name, status=discord.Status.online, bot=False, system=False):
+        self.id = member_id
+        self.display_name = display_name
+        self.name = display_name
+        self.mention = f'<@{member_id}>'
+        self.status = status
+        self.bot = bot
+        self.system = system
+        self.guild = None
+
+    def with_status(self, status):
+        member = FakeMember(self.id, self.display_name, status, self.bot, self.system)
+        member.guild = self.guild
+        return member
+
+
+class FakeGuild:
+    def __init__(self, guild_id, members):
+        self.id = guild_id
+        self.members = members
+        self.filesize_limit = 25 * 1024 * 1024
+        for member in members:
+            member.guild = self
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, **kwargs):
+        self._done = True
+        self.interaction.stats.record('defer')
+
+    async def send_message(self, content=None, embed=None, ephemeral=False, **kwargs):
+        self._done = True
+        self.interaction.stats.record('send_message')
+        self.interaction._original = FakeMessage(self.interaction.channel, embed, ephemeral)
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, embed=None, ephemeral=False, **kwargs):
+        self.interaction.stats.record('followup')
+        return FakeMessage(self.interaction.channel, embed, ephemeral)
+
+
+class FakeInteraction:
+    def __init__(self, user, guild, channel, stats):
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel = channel
+        self.channel_id = channel.id
+        self.stats = stats
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self._original = None
+
+    async def original_response(self):
+        return self._original
+
+
+class VirtualClock:
+    # time.time の代わりに渡す時計。advance_to() で進めるまで止まっている
+    def __init__(self, start: float):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance_to(self, when: float):
+        if when > self.now:
+            self.now = when
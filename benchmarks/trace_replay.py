@@ -0,0 +1,371 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+# イベントのトレース（event_trace.py の形式）を、ネットワークなしのボットに仮想時計でリプレイする。
+#   python -m benchmarks.trace_replay generate --users 300 --nights 9 --output trace.ndjson.gz
+#   python -m benchmarks.trace_replay replay trace.ndjson.gz --budget benchmarks/replay_budget.json
+#   python -m benchmarks.trace_replay replay trace.ndjson.gz --output after.json --compare before.json
+# 本番のトレースは SLEEP_TRACE_FILE=trace.ndjson.gz を設定してボットを動かすと記録される。
+# リプレイはイベントを1つずつ待たずに実行し、その前に仮想時計をイベントの時刻まで進めて
+# 150時間・200時間のルール、2分後の自動削除、プレゼンスの反映、ステータス掲示板の編集、ストアの保存（5秒ごと）を
+# その場で実行する。
+# 同じトレースと引数なら、状態・書き込みバイト数・HTTP 呼び出し数は毎回同じになる（時間の計測値だけが変わる）。
+# --budget の上限（と --compare の結果との比）を超えたら終了コード 1 で終わる。
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JST = timezone(timedelta(hours=9))
+# 生成するトレースの開始（月曜の夕方）
+GENERATED_START = datetime(2024, 1, 1, 18, 0, tzinfo=JST)
+# ストアの保存間隔（JsonSleepStore の flush_delay と同じ）
+FLUSH_SECONDS = 5.0
+# 最後のイベントの後、自動削除などを実行しきるまで進める秒数
+DRAIN_SECONDS = 300.0
+
+
+def generate_trace(args):
+    # 夕方のプレゼンスの変化、ボタンでの就寝/起床（押さずにオフライン/オンラインになるだけの人もいる）、
+    # ステータスの確認、管理者の /setstatus を毎晩。起床を押し忘れたまま（150時間）・
+    # 最初の朝から来なくなる（200時間）ユーザーも混ぜる
+    from event_trace import PRESENCE, SET_STATUS, SLEEP_BUTTON, STATS_BUTTON, WAKE_BUTTON, write_trace
+
+    rng = random.Random(args.seed)
+    events = []
+    admin = args.users
+
+    def at(minutes, kind, user, arg=None):
+        events.append((minutes * 60, kind, user, arg))
+
+    for user in range(args.users):
+        role = rng.random()
+        bedtime = rng.gauss(330, 45)
+        for night in range(args.nights):
+            base = night * 24 * 60
+            weekend = (GENERATED_START + timedelta(days=night)).weekday() in (4, 5)
+            if role < 0.05 and night > 0:
+                # 就寝を押したまま来なくなった
+                break
+            for _ in range(rng.randint(0, 3)):
+                flap = base + rng.uniform(0, 270)
+                at(flap, PRESENCE, user, 1)
+                at(flap + rng.uniform(1, 20), PRESENCE, user, 0)
+            if rng.random() < 0.2:
+                at(base + rng.uniform(0, 300), STATS_BUTTON, user)
+            sleep_at = base + bedtime + (60 if weekend else 0) + rng.gauss(0, 40)
+            if rng.random() < 0.3:
+                at(sleep_at - 5, STATS_BUTTON, user)
+            if role < 0.05 or rng.random() < 0.85:
+                at(sleep_at, SLEEP_BUTTON, user)
+            at(sleep_at + rng.uniform(0.5, 5), PRESENCE, user, 1)
+            if role < 0.05:
+                continue
+            wake_at = sleep_at + max(120, rng.gauss(420 + (60 if weekend else 0), 60))
+            at(wake_at, PRESENCE, user, 0)
+            if rng.random() < 0.8:
+                at(wake_at + rng.uniform(1, 15), WAKE_BUTTON, user)
+                if rng.random() < 0.3:
+                    at(wake_at + rng.uniform(16, 30), STATS_BUTTON, user)
+            if 0.05 <= role < 0.1:
+                # 最初の朝で来なくなった
+                break
+    for night in range(args.nights):
+        for _ in range(2):
+            at(night * 24 * 60 + rng.uniform(0, 24 * 60), SET_STATUS, admin,
+               [rng.randrange(args.users), rng.choice(('sleep', 'wake'))])
+
+    events.sort(key=lambda event: event[0])
+    write_trace(args.output, events, GENERATED_START.timestamp(), users=args.users + 1)
+    print(f'{args.output}: {len(events)} events, {args.users + 1} users, {args.nights} nights')
+
+
+def trace_users(events) -> int:
+    # トレースに出てくるユーザー（/setstatus の対象を含む）の数
+    users = [user for _, _, user, _ in events] + [arg[0] for _, kind, _, arg in events if kind == '/setstatus']
+    return max(users, default=-1) + 1
+
+
+class Replay:
+    def __init__(self, main, header, events, args):
+        from benchmarks.fakes import FakeChannel, FakeGuild, FakeMember, HttpStats, VirtualClock
+        self.main = main
+        self.events = events
+        self.args = args
+        self.start = header['started']
+        self.clock = VirtualClock(self.start)
+        main.clock = self.clock
+        main.partitions.clock = self.clock
+        main.message_manager.clock = self.clock
+        main.status_boards.clock = self.clock
+        main.load_state()
+
+        users = trace_users(events)
+        self.http = HttpStats()
+        self.channel = FakeChannel(stats=self.http)
+        self.members = [FakeMember(10 ** 17 + i, f'user{i}', main.discord.Status.online) for i in range(users)]
+        self.guild = FakeGuild(1, self.members)
+        self.partition = main.partitions.for_guild(self.guild)
+        store = self.partition.store
+        if hasattr(store, 'flush_delay'):
+            # 保存は実時間のタイマーではなく、仮想時計で FLUSH_SECONDS ごとに行う
+            store.flush_delay = 10 ** 9
+        self.samples: dict = {}
+        self.fired: dict = {}
+        self.auto_deleted = 0
+        self.flushes = 0
+        self._last_flush = self.start
+
+    def _bytes_written(self):
+        store = self.partition.store
+        if hasattr(store, 'bytes_written'):
+            return store.bytes_written
+        total = 0
+        for suffix in ('', '-wal'):
+            path = store.path + suffix
+            if os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+
+    def interaction(self, member):
+        from benchmarks.fakes import FakeInteraction
+        return FakeInteraction(member, self.guild, self.channel, self.http)
+
+    async def advance(self, when):
+        # 仮想時計を進め、その時刻までに期限が来たものを実行する
+        self.clock.advance_to(when)
+        started = time.perf_counter()
+        did_work = False
+        for _, kind in self.partition.expiry_scheduler.run_due():
+            self.fired[kind] = self.fired.get(kind, 0) + 1
+            did_work = True
+        manager = self.main.message_manager
+        due = manager.pop_due()
+        if due:
+            await manager.delete_messages(due)
+            self.auto_deleted += len(due)
+            did_work = True
+        if self.partition.presence_pipeline.flush_due():
+            did_work = True
+        if await self.main.status_boards.flush_due():
+            did_work = True
+        if self.clock() - self._last_flush >= FLUSH_SECONDS:
+            self._last_flush = self.clock()
+            await self.partition.store.flush_async()
+            self.flushes += 1
+            did_work = True
+        if did_work:
+            self.samples.setdefault('timers', []).append(time.perf_counter() - started)
+
+    async def dispatch(self, kind, user, arg, view):
+        main = self.main
+        member = self.members[user]
+        if kind == 'presence':
+            # arg は 1 ならオフラインになった、0 ならオンラインになった
+            offline, online = main.discord.Status.offline, main.discord.Status.online
+            before = member.with_status(online if arg else offline)
+            member.status = offline if arg else online
+            await main.on_presence_update(before, member)
+        elif kind == '/setstatus':
+            await main.set_status_slash.callback(self.interaction(member), self.members[arg[0]], arg[1])
+        else:
+            button = getattr(view, kind)
+            await button.callback(self.interaction(member))
+
+    async def run(self):
+        view = self.main.SleepTrackerView()
+        bytes_before = self._bytes_written()
+        handler_seconds = 0.0
+        started = time.perf_counter()
+        for seconds, kind, user, arg in self.events:
+            await self.advance(self.start + seconds)
+            t0 = time.perf_counter()
+            await self.dispatch(kind, user, arg, view)
+            elapsed = time.perf_counter() - t0
+            handler_seconds += elapsed
+            self.samples.setdefault(kind, []).append(elapsed)
+        last = self.events[-1][0] if self.events else 0.0
+        await self.advance(self.start + last + DRAIN_SECONDS)
+        await self.partition.store.flush_async()
+        wall = time.perf_counter() - started
+        return self.report(wall, handler_seconds, last, self._bytes_written() - bytes_before)
+
+    def state_digest(self):
+        # 最終的な状態のハッシュ（同じトレースなら毎回同じになる）
+        store = self.partition.store
+        digest = hashlib.sha256()
+        for user_id in sorted(store.user_ids()):
+            digest.update(json.dumps([user_id, store.get_state(user_id), store.get_records(user_id)],
+                                     sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        return digest.hexdigest()
+
+    def report(self, wall, handler_seconds, virtual_seconds, bytes_written):
+        from benchmarks.bench_handlers import summarize
+        events = len(self.events)
+        handled = [sample for kind, samples in self.samples.items() if kind != 'timers' for sample in samples]
+        return {
+            'params': {'trace': os.path.basename(self.args.trace), 'records': self.args.records,
+                       'seed': self.args.seed, 'backend': self.args.backend},
+            'events': events,
+            'users': len(self.members),
+            'virtual_seconds': virtual_seconds,
+            'wall_seconds': wall,
+            'speedup': virtual_seconds / wall if wall else 0.0,
+            'throughput_per_s': events / wall if wall else 0.0,
+            'overall': summarize(handled, handler_seconds),
+            'kinds': {kind: summarize(samples, sum(samples)) for kind, samples in sorted(self.samples.items())},
+            'bytes_written': bytes_written,
+            'bytes_per_event': bytes_written / events if events else 0.0,
+            'http_calls': self.http.total,
+            'http_per_event': self.http.total / events if events else 0.0,
+            'http': dict(sorted(self.http.calls.items())),
+            'fired': dict(sorted(self.fired.items())),
+            'auto_deleted': self.auto_deleted,
+            'flushes': self.flushes,
+            'presence': dict(self.partition.presence_pipeline.counters),
+            'status_board': dict(self.main.status_boards.counters),
+            'state_digest': self.state_digest()
+        }
+
+
+def check_budget(report, budget, baseline=None) -> list:
+    # 予算を超えた項目の説明を返す（空なら合格）
+    violations = []
+
+    def at_most(name, value, limit):
+        if limit is not None and value > limit:
+            violations.append(f'{name}: {value:.3f} > {limit}')
+
+    def at_least(name, value, limit):
+        if limit is not None and value < limit:
+            violations.append(f'{name}: {value:.3f} < {limit}')
+
+    at_least('throughput_per_s', report['throughput_per_s'], budget.get('min_throughput_per_s'))
+    at_most('p99_ms', report['overall']['p99_ms'], budget.get('max_p99_ms'))
+    at_most('bytes_per_event', report['bytes_per_event'], budget.get('max_bytes_per_event'))
+    at_most('http_per_event', report['http_per_event'], budget.get('max_http_per_event'))
+    for kind, limits in budget.get('kinds', {}).items():
+        result = report['kinds'].get(kind)
+        if result is not None:
+            at_most(f'{kind} p99_ms', result['p99_ms'], limits.get('max_p99_ms'))
+            at_most(f'{kind} max_ms', result['max_ms'], limits.get('max_max_ms'))
+
+    compare = budget.get('compare', {})
+    if baseline is not None and compare:
+        def ratio(value, base):
+            return value / base if base else 1.0
+        at_least('throughput ratio', ratio(report['throughput_per_s'], baseline['throughput_per_s']),
+                 compare.get('min_throughput_ratio'))
+        at_most('p99 ratio', ratio(report['overall']['p99_ms'], baseline['overall']['p99_ms']),
+                compare.get('max_p99_ratio'))
+        at_most('bytes_per_event ratio', ratio(report['bytes_per_event'], baseline['bytes_per_event']),
+                compare.get('max_bytes_per_event_ratio'))
+        at_most('http_per_event ratio', ratio(report['http_per_event'], baseline['http_per_event']),
+                compare.get('max_http_per_event_ratio'))
+    return violations
+
+
+def print_report(report, baseline=None):
+    print(f"{report['params']['trace']}: {report['events']} events, {report['users']} users, "
+          f"{report['virtual_seconds'] / 3600:.1f}h virtual in {report['wall_seconds']:.2f}s "
+          f"({report['speedup']:.0f}x) backend={report['params']['backend']}")
+    print(f"throughput {report['throughput_per_s']:.1f} events/s  storage {report['bytes_per_event']:.1f} B/event  "
+          f"http {report['http_per_event']:.2f}/event  flushes {report['flushes']}")
+    print(f"fired {report['fired']}  auto_deleted {report['auto_deleted']}  presence {report['presence']}")
+    if 'status_board' in report:
+        print(f"status board {report['status_board']}")
+    print(f"http {report['http']}")
+    print(f"state {report['state_digest'][:16]}")
+    print(f"{'kind':<16}{'ops':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    rows = list(report['kinds'].items()) + [('overall', report['overall'])]
+    for kind, r in rows:
+        line = f"{kind:<16}{r['ops']:>8}{r['p50_ms']:>10.3f}{r['p90_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['max_ms']:>10.3f}"
+        base = (baseline['overall'] if kind == 'overall' else baseline['kinds'].get(kind)) if baseline else None
+        if base and base['p99_ms']:
+            line += f"  p99 {r['p99_ms'] / base['p99_ms']:.2f}x"
+        print(line)
+    if baseline and baseline.get('state_digest') != report['state_digest']:
+        print('注意: 比較対象と最終的な状態が異なります（トレースか引数が違う、またはボットの動作が変わった）')
+
+
+def replay(args):
+    from event_trace import read_trace
+    trace = os.path.abspath(args.trace)
+    output = os.path.abspath(args.output) if args.output else None
+    budget_path = os.path.abspath(args.budget) if args.budget else None
+    compare = os.path.abspath(args.compare) if args.compare else None
+    header, events = read_trace(trace)
+
+    # 記録が増えるほど重くなる処理も見るため、トレースの開始より前の記録を持つデータを用意する
+    from benchmarks.bench_handlers import generate_dataset
+    users = trace_users(events)
+    workdir = tempfile.mkdtemp(prefix='sleepreplay-')
+    generate_dataset(os.path.join(workdir, 'sleep_data.json'), users, args.records, args.seed,
+                     base_time=datetime.fromtimestamp(header['started'], JST))
+    os.environ['SLEEP_STORAGE_BACKEND'] = args.backend
+    os.environ.pop('SLEEP_TRACE_FILE', None)
+    os.chdir(workdir)
+    import main as bot_main
+
+    async def run():
+        return await Replay(bot_main, header, events, args).run()
+
+    # ハンドラの print はそのまま実行する（本番と同じ負荷）が、画面には出さない
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        report = asyncio.run(run())
+        bot_main.partitions.close()
+
+    baseline = None
+    if compare:
+        with open(compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if budget_path:
+        with open(budget_path, 'r', encoding='utf-8') as f:
+            budget = json.load(f)
+        violations = check_budget(report, budget, baseline)
+        if violations:
+            print('予算超過:')
+            for violation in violations:
+                print(f'  {violation}')
+            return 1
+        print('予算内です。')
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='イベントのトレースの生成とリプレイ')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    gen = subparsers.add_parser('generate', help='本番に近いトレースを生成する')
+    gen.add_argument('--users', type=int, default=300)
+    gen.add_argument('--nights', type=int, default=9)
+    gen.add_argument('--seed', type=int, default=42)
+    gen.add_argument('--output', default='trace.ndjson.gz')
+    rep = subparsers.add_parser('replay', help='トレースをリプレイして計測する')
+    rep.add_argument('trace')
+    rep.add_argument('--records', type=int, default=60, help='リプレイ前のデータの1ユーザーあたりの最大記録数')
+    rep.add_argument('--seed', type=int, default=42)
+    rep.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    rep.add_argument('--budget', help='回帰の予算 (JSON)。超えたら終了コード 1')
+    rep.add_argument('--output', help='結果を JSON で保存するファイル')
+    rep.add_argument('--compare', help='比較する以前の結果 (JSON)')
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    if args.command == 'generate':
+        generate_trace(args)
+        return
+    sys.exit(replay(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import gzip
+import json
+import time
+from typing import Optional
+
+# ボタン操作・/setstatus・プレゼンスの変化を、あとでリプレイできるトレースファイルに記録する。
+# 1行目がヘッダー、以降は1イベント1行の [前のイベントからの経過ミリ秒, 種類, ユーザー, 引数]。
+# ユーザーは最初に現れた順の番号に置き換える（ID は残さない）。名前が .gz で終わるファイルは gzip で書く。
+# プレゼンスはオフラインかどうかが変わったものだけを記録する（それ以外はパイプラインが捨てるので）。
+
+TRACE_VERSION = 1
+
+SLEEP_BUTTON = 'sleep_button'
+WAKE_BUTTON = 'wake_button'
+STATS_BUTTON = 'stats_button'
+SET_STATUS = '/setstatus'
+PRESENCE = 'presence'
+# 種類 -> ファイル上の1文字
+KIND_CODES = {SLEEP_BUTTON: 's', WAKE_BUTTON: 'w', STATS_BUTTON: 't', SET_STATUS: 'S', PRESENCE: 'p'}
+_CODE_KINDS = {code: kind for kind, code in KIND_CODES.items()}
+
+
+def _open(path: str, mode: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class TraceRecorder:
+    def __init__(self, path: str, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._file = None
+        self._users: dict = {}
+        self._last = None
+        self.events = 0
+
+    def _user(self, user_id) -> int:
+        user_id = str(user_id)
+        index = self._users.get(user_id)
+        if index is None:
+            index = self._users[user_id] = len(self._users)
+        return index
+
+    def record(self, kind: str, user_id, arg=None):
+        now = self.clock()
+        if self._file is None:
+            self._file = _open(self.path, 'w')
+            self._file.write(json.dumps({'trace': TRACE_VERSION, 'started': now}) + '\n')
+            self._last = now
+        delta = max(0, int(round((now - self._last) * 1000)))
+        self._last += delta / 1000
+        row = [delta, KIND_CODES[kind], self._user(user_id)]
+        if arg is not None:
+            row.append(arg)
+        # 書き込みはバッファに溜まるだけで、ファイルへは数KBごとにまとめて出る
+        self._file.write(json.dumps(row, separators=(',', ':')) + '\n')
+        self.events += 1
+
+    def record_interaction(self, interaction):
+        # on_interaction から。記録する種類のボタン・コマンドだけを残す
+        data = interaction.data or {}
+        custom_id = data.get('custom_id')
+        if custom_id in (SLEEP_BUTTON, WAKE_BUTTON, STATS_BUTTON):
+            self.record(custom_id, interaction.user.id)
+        elif data.get('name') == SET_STATUS[1:]:
+            options = {option.get('name'): option.get('value') for option in data.get('options', ())}
+            if 'member' in options:
+                self.record(SET_STATUS, interaction.user.id, [self._user(options['member']), str(options.get('status'))])
+
+    def record_presence(self, user_id, was_offline: bool, is_offline: bool):
+        if was_offline != is_offline:
+            self.record(PRESENCE, user_id, int(is_offline))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_trace(path: str):
+    # (ヘッダー, [(開始からの秒, 種類, ユーザー番号, 引数)]) を返す
+    with _open(path, 'r') as f:
+        header = json.loads(f.readline())
+        if header.get('trace') != TRACE_VERSION:
+            raise ValueError(f'対応していないトレースの形式です: {header.get("trace")}')
+        events = []
+        elapsed_ms = 0
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            elapsed_ms += row[0]
+            events.append((elapsed_ms / 1000, _CODE_KINDS[row[1]], row[2], row[3] if len(row) > 3 else None))
+    return header, events
+
+
+def write_trace(path: str, events, started: float, users: Optional[int] = None):
+    # read_trace と同じ形の (秒, 種類, ユーザー番号, 引数) の列を書き出す（生成したトレース用）
+    with _open(path, 'w') as f:
+        header = {'trace': TRACE_VERSION, 'started': started}
+        if users is not None:
+            header['users'] = users
+        f.write(json.dumps(header) + '\n')
+        previous_ms = 0
+        for seconds, kind, user, arg in events:
+            elapsed_ms = int(round(seconds * 1000))
+            row = [elapsed_ms - previous_ms, KIND_CODES[kind], user]
+            previous_ms = elapsed_ms
+            if arg is not None:
+                row.append(arg)
+            f.write(json.dumps(row, separators=(',', ':')) + '\n')
@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+import time
+from datetime import datetime
+from typing import Optional
+
+from sleep_store import SleepStore
+
+AUTO_WAKE_SECONDS = 150 * 3600
+AWAKE_RESET_SECONDS = 200 * 3600
+
+AUTO_WAKE = 'auto_wake'
+AWAKE_RESET = 'awake_reset'
+
+
+class ExpiryScheduler:
+    # 150時間の自動起床と200時間の起床リセットを期限のヒープで管理し、期限が来たときに1回だけ実行する。
+    # 読み取り側（ステータス表示など）はストアに書き込まない。
+    # clock はエポック秒を返す関数で、テストやベンチマークでは差し替えられる。
+
+    def __init__(self, store: SleepStore, tz, clock=time.time, max_sleep: float = 60.0):
+        self.store = store
+        self.tz = tz
+        self.clock = clock
+        self.max_sleep = max_sleep
+        self._heap = []
+        # user_id -> (deadline, kind)。ヒープ内の古いエントリはこれと一致しなければ捨てる
+        self._deadlines: dict = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        store.add_listener(self._on_store_change)
+
+    def load(self):
+        self._heap = []
+        self._deadlines = {}
+        for user_id in list(self.store.user_ids()):
+            self._reschedule(user_id)
+
+    def _on_store_change(self, user_id, op, record):
+        if op == 'clear':
+            self._deadlines.pop(user_id, None)
+        else:
+            self._reschedule(user_id)
+
+    def _reschedule(self, user_id):
+        user_id = str(user_id)
+        state = self.store.get_state(user_id) or {}
+        entry = None
+        try:
+            if state.get('is_sleeping', False) and 'sleep_start' in state:
+                entry = (_parse_ts(state['sleep_start']) + AUTO_WAKE_SECONDS, AUTO_WAKE)
+            elif not state.get('is_sleeping', False) and 'sleep_end' in state:
+                entry = (_parse_ts(state['sleep_end']) + AWAKE_RESET_SECONDS, AWAKE_RESET)
+        except (TypeError, ValueError):
+            # ストアは読めない時刻もそのまま残している。そのユーザーには期限を設けない
+            print(f'User {user_id} has an unreadable sleep time. Skipping expiry scheduling.')
+            entry = None
+
+        if entry is None:
+            self._deadlines.pop(user_id, None)
+            return
+        if self._deadlines.get(user_id) == entry:
+            return
+        self._deadlines[user_id] = entry
+        heapq.heappush(self._heap, (entry[0], user_id, entry[1]))
+        if self._wakeup is not None and self._heap[0][1] == user_id:
+            self._wakeup.set()
+
+    def next_deadline(self) -> Optional[float]:
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def _drop_stale(self):
+        while self._heap:
+            deadline, user_id, kind = self._heap[0]
+            if self._deadlines.get(user_id) == (deadline, kind):
+                return
+            heapq.heappop(self._heap)
+
+    def run_due(self) -> list:
+        # 期限を過ぎたものをすべて実行し、[(user_id, kind)] を返す
+        now = self.clock()
+        fired = []
+        while True:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            deadline, user_id, kind = heapq.heappop(self._heap)
+            del self._deadlines[user_id]
+            self._fire(user_id, kind, now)
+            fired.append((user_id, kind))
+        return fired
+
+    def fire_if_due(self, user_id) -> Optional[str]:
+        # ボタン操作の直前に、そのユーザーの期限だけを確認して実行する
+        user_id = str(user_id)
+        entry = self._deadlines.get(user_id)
+        now = self.clock()
+        if entry is None or entry[0] > now:
+            return None
+        del self._deadlines[user_id]
+        self._fire(user_id, entry[1], now)
+        return entry[1]
+
+    def _fire(self, user_id, kind, now):
+        state = self.store.get_state(user_id) or {}
+        if kind == AUTO_WAKE:
+            try:
+                sleep_start_ts = _parse_ts(state['sleep_start'])
+            except (KeyError, TypeError, ValueError):
+                # 期限を決めた後に状態が変わっていた
+                return
+            print(f"User {user_id} has been 'sleeping' for over 150 hours. Auto-waking them up.")
+            self.store.end_sleep(
+                user_id,
+                datetime.fromtimestamp(now, self.tz).isoformat(),
+                int((now - sleep_start_ts) / 60),
+                mark_wake=False
+            )
+        elif kind == AWAKE_RESET:
+            print(f"User {user_id} has been 'awake' for over 200 hours. Resetting their status.")
+            self.store.clear_wake(user_id)
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            self.run_due()
+            deadline = self.next_deadline()
+            timeout = self.max_sleep
+            if deadline is not None:
+                timeout = min(timeout, max(0.0, deadline - self.clock()))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+def _parse_ts(value: str) -> float:
+    return datetime.fromisoformat(value).timestamp()
@@ -0,0 +1,272 @@
+import argparse
+import csv
+import json
+import os
+from typing import Optional
+
+from sleep_records import parse_iso
+from sleep_store import SleepStore
+
+# 睡眠記録を CSV / NDJSON で書き出し・読み込みする。
+# 1ユーザーずつ（読み込みは CHUNK_SIZE 件ずつ）処理するので、履歴の大きさによらずメモリ使用量は一定。
+# ボットからは *_async を使う。ファイルとアーカイブの読み書きは I/O スレッドで、ストアの読み書きはイベントループで行う。
+
+FORMATS = ('csv', 'ndjson')
+CSV_FIELDS = ('user_id', 'sleep_start', 'sleep_end', 'duration_minutes')
+CHUNK_SIZE = 1000
+# エラーとして報告する行数の上限
+MAX_REPORTED_ERRORS = 20
+
+
+def format_of(path: str, default: str = 'csv') -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.ndjson', '.jsonl'):
+        return 'ndjson'
+    if extension == '.csv':
+        return 'csv'
+    return default
+
+
+def hot_records(store: SleepStore, user_ids=None) -> list:
+    # ストアにある記録の (user_id, SleepRecords のコピー) の一覧。イベントループで取り、書き出しは I/O スレッドで行う
+    if user_ids is None:
+        user_ids = list(store.user_ids())
+    return [(str(user_id), store.get_record_columns(user_id).copy()) for user_id in user_ids]
+
+
+def iter_records(store: SleepStore, user_ids=None, hot=None):
+    # (user_id, 記録) を1件ずつ返す。user_ids を省略すると全ユーザー。
+    # アーカイブ済みの記録（月の順）を先に、ストアの記録（hot を渡せばそれ）を後に返す
+    if store.archive is not None:
+        yield from store.archive.iter_records(user_ids)
+    if hot is None:
+        hot = ((str(user_id), store.get_record_columns(user_id))
+               for user_id in (list(store.user_ids()) if user_ids is None else user_ids))
+    for user_id, records in hot:
+        for record in records:
+            yield user_id, record
+
+
+def export_records(store: SleepStore, f, fmt: str, user_ids=None, hot=None) -> int:
+    # テキストモードのファイルに書き出し、書いた件数を返す
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(CSV_FIELDS)
+        for user_id, record in iter_records(store, user_ids, hot):
+            writer.writerow((user_id, record.get('sleep_start'), record.get('sleep_end'), record.get('duration_minutes')))
+            count += 1
+    else:
+        for user_id, record in iter_records(store, user_ids, hot):
+            f.write(json.dumps({'user_id': user_id, **record}, ensure_ascii=False))
+            f.write('\n')
+            count += 1
+    return count
+
+
+def export_to_file(store: SleepStore, path: str, fmt: Optional[str] = None, user_ids=None, hot=None) -> int:
+    fmt = fmt or format_of(path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        count = export_records(store, f, fmt, user_ids, hot)
+    os.replace(tmp_path, path)
+    return count
+
+
+async def export_to_file_async(store: SleepStore, path: str, io, fmt: Optional[str] = None, user_ids=None) -> int:
+    # export_to_file と同じ。ストアの記録はここで写し取り、アーカイブの読み込みとファイルへの書き込みは io のスレッドで行う
+    return await io.run(export_to_file, store, path, fmt, user_ids, hot_records(store, user_ids))
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.errors = []
+        self.error_count = 0
+
+    def error(self, line_no: int, message: str):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f'{line_no}行目: {message}')
+
+
+def _read_rows(f, fmt: str):
+    # (行番号, dict) を返す。形式が壊れている行は (行番号, エラー文字列)
+    if fmt == 'csv':
+        reader = csv.DictReader(f)
+        missing = [field for field in CSV_FIELDS if field not in (reader.fieldnames or ())]
+        if missing:
+            raise ValueError(f"CSV の列が足りません: {', '.join(missing)}")
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_no, f'JSON として読めません ({e})'
+                continue
+            if not isinstance(row, dict):
+                yield line_no, 'オブジェクトではありません'
+                continue
+            yield line_no, row
+
+
+def validate_row(row: dict):
+    # 取り込める記録なら (user_id, 記録, 就寝時刻のエポックマイクロ秒) を返す。不正なら ValueError
+    user_id = str(row.get('user_id') or '').strip()
+    if not user_id.isdigit():
+        raise ValueError('user_id が不正です')
+    sleep_start = row.get('sleep_start')
+    sleep_end = row.get('sleep_end')
+    try:
+        start_us, _ = parse_iso(sleep_start)
+        end_us, _ = parse_iso(sleep_end)
+    except (TypeError, ValueError):
+        raise ValueError('日時の形式が不正です')
+    if end_us < start_us:
+        raise ValueError('起床時刻が就寝時刻より前です')
+    try:
+        duration = int(row.get('duration_minutes'))
+    except (TypeError, ValueError):
+        raise ValueError('duration_minutes が数値ではありません')
+    if duration < 0:
+        raise ValueError('duration_minutes が負の値です')
+    record = {'sleep_start': sleep_start, 'sleep_end': sleep_end, 'duration_minutes': duration}
+    return user_id, record, start_us
+
+
+def _chunks(f, fmt: str, user_ids, result: ImportResult):
+    # 1行ずつ検証し、CHUNK_SIZE 件ごとに user_id -> {就寝時刻: 記録} にまとめて返す（ファイル内の重複はここで除く）。
+    # user_ids を渡すと、それ以外のユーザーの行は取り込まない
+    allowed = None if user_ids is None else set(str(user_id) for user_id in user_ids)
+    pending: dict = {}
+    pending_count = 0
+    for line_no, row in _read_rows(f, fmt):
+        if isinstance(row, str):
+            result.error(line_no, row)
+            continue
+        try:
+            user_id, record, start_us = validate_row(row)
+        except ValueError as e:
+            result.error(line_no, str(e))
+            continue
+        if allowed is not None and user_id not in allowed:
+            result.skipped += 1
+            continue
+
+        records = pending.setdefault(user_id, {})
+        if start_us in records:
+            result.skipped += 1
+            continue
+        records[start_us] = record
+        pending_count += 1
+        if pending_count >= CHUNK_SIZE:
+            yield pending
+            pending = {}
+            pending_count = 0
+    if pending:
+        yield pending
+
+
+def _stored_starts(store: SleepStore, pending: dict) -> dict:
+    # pending の就寝時刻のうち、ストアに既にあるものを user_id -> set で返す
+    return {user_id: records.keys() & set(store.get_record_columns(user_id).start_us) for user_id, records in pending.items()}
+
+
+def _add_archived_starts(archive, pending: dict, existing: dict):
+    # pending の就寝時刻のうち、アーカイブにあるものを existing に足す
+    if archive is None:
+        return
+    wanted: dict = {}
+    for user_id, records in pending.items():
+        found = existing[user_id]
+        # アーカイブは起床時刻の月ごと。同じ就寝時刻の記録は就寝・起床のどちらかの月にある
+        months: dict = {}
+        for start_us, record in records.items():
+            if start_us in found:
+                continue
+            for month in {record['sleep_start'][:7], record['sleep_end'][:7]}:
+                months.setdefault(month, set()).add(start_us)
+        if months:
+            wanted[user_id] = months
+    if wanted:
+        for user_id, starts in archive.find_starts(wanted).items():
+            existing[user_id] |= starts
+
+
+def _add_chunk(store: SleepStore, pending: dict, existing: dict, result: ImportResult):
+    with store.batch():
+        for user_id, records in pending.items():
+            known = existing.get(user_id, ())
+            fresh = [record for start_us, record in records.items() if start_us not in known]
+            result.skipped += len(records) - len(fresh)
+            result.imported += len(fresh)
+            store.add_records(user_id, fresh)
+
+
+def import_records(store: SleepStore, f, fmt: str, user_ids=None) -> ImportResult:
+    # CHUNK_SIZE 件ずつストアに追加する。
+    # 同じユーザーに同じ就寝時刻の記録が既にあれば取り込まない（同じファイルを2回読み込んでも重複しない）。
+    # 重複の確認はチャンクごとに、そのチャンクのユーザー・月の分だけストアとアーカイブに問い合わせる
+    result = ImportResult()
+    for pending in _chunks(f, fmt, user_ids, result):
+        existing = _stored_starts(store, pending)
+        _add_archived_starts(store.archive, pending, existing)
+        _add_chunk(store, pending, existing, result)
+    return result
+
+
+def import_from_file(store: SleepStore, path: str, fmt: Optional[str] = None, user_ids=None) -> ImportResult:
+    fmt = fmt or format_of(path)
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        return import_records(store, f, fmt, user_ids)
+
+
+async def import_from_file_async(store: SleepStore, path: str, io, fmt: Optional[str] = None, user_ids=None) -> ImportResult:
+    # import_from_file と同じ。ファイルの読み込み・検証とアーカイブでの重複の確認は io のスレッドで、
+    # ストアでの重複の確認と追加はイベントループで、チャンクごとに交互に行う
+    fmt = fmt or format_of(path)
+    result = ImportResult()
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        chunks = _chunks(f, fmt, user_ids, result)
+        while True:
+            pending = await io.run(next, chunks, None)
+            if pending is None:
+                break
+            existing = _stored_starts(store, pending)
+            await io.run(_add_archived_starts, store.archive, pending, existing)
+            _add_chunk(store, pending, existing, result)
+    return result
+
+
+def run_cli(store: SleepStore, argv) -> int:
+    # python main.py export|import ... から呼ぶ。store は読み込み済みのもの
+    parser = argparse.ArgumentParser(prog='main.py', description='睡眠記録の書き出し・読み込み')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='睡眠記録を書き出す')
+    export_parser.add_argument('output', help='書き出すファイル（.csv / .ndjson）')
+    export_parser.add_argument('--format', choices=FORMATS)
+    export_parser.add_argument('--user', action='append', help='書き出すユーザーID（複数指定可、省略すると全員）')
+    import_parser = subparsers.add_parser('import', help='睡眠記録を読み込む')
+    import_parser.add_argument('input', help='読み込むファイル（.csv / .ndjson）')
+    import_parser.add_argument('--format', choices=FORMATS)
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        count = export_to_file(store, args.output, args.format, args.user)
+        print(f'{count}件の睡眠記録を {args.output} に書き出しました。')
+        return 0
+
+    try:
+        result = import_from_file(store, args.input, args.format)
+    except ValueError as e:
+        print(f'エラー: {e}')
+        return 1
+    print(f'{result.imported}件の睡眠記録を読み込みました（重複などでスキップ: {result.skipped}件、エラー: {result.error_count}件）。')
+    for error in result.errors:
+        print(f'  {error}')
+    return 0
@@ -0,0 +1,73 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# ストアの保存やアーカイブへの書き込みなど、ディスクに触る重い処理を専用のスレッドで実行する。
+# スレッドは1本なので、同じファイルへの書き込みは投入した順に1つずつ行われる。
+# 待ち行列は max_pending 件までで、それ以上は空きができるまで投入する側が（イベントループを止めずに）待つ。
+
+
+class IOExecutor:
+    def __init__(self, max_pending: int = 64, name: str = 'sleep-io'):
+        self.max_pending = max_pending
+        self.name = name
+        self._executor = None
+        self._slots = None
+        # key -> まだ始まっていない保存 / 実行中の保存（Future）
+        self._queued: dict = {}
+        self._running: dict = {}
+        # 待ち行列に入っている（実行中を含む）処理の数と、合流した保存の数
+        self.pending = 0
+        self.coalesced = 0
+
+    async def run(self, func, *args):
+        # func(*args) を I/O スレッドで実行し、終わるまで待つ
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
+        async with self._slots:
+            self.pending += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+            finally:
+                self.pending -= 1
+
+    async def save(self, key, save):
+        # save は「その時点の最新の状態を保存する」コルーチン関数。
+        # 同じ key の保存がまだ始まっていなければそれに合流し、実行中なら終わるのを待ってからもう1回だけ実行する
+        # （その間に来た要求はすべてその1回にまとめる）
+        queued = self._queued.get(key)
+        if queued is not None:
+            self.coalesced += 1
+            return await asyncio.shield(queued)
+        queued = self._queued[key] = asyncio.get_running_loop().create_future()
+        # 誰も待っていない場合に「例外が取り出されなかった」警告を出さない
+        queued.add_done_callback(lambda future: future.cancelled() or future.exception())
+        try:
+            running = self._running.get(key)
+            if running is not None:
+                await asyncio.wait([running])
+            del self._queued[key]
+            self._running[key] = queued
+            result = await save()
+        except BaseException as e:
+            if not queued.done():
+                if isinstance(e, asyncio.CancelledError):
+                    queued.cancel()
+                else:
+                    queued.set_exception(e)
+            raise
+        finally:
+            if self._queued.get(key) is queued:
+                del self._queued[key]
+            if self._running.get(key) is queued:
+                del self._running[key]
+        queued.set_result(result)
+        return result
+
+    def shutdown(self):
+        # 実行中・待ち行列の処理が終わるまで待つ（終了時、ストアを閉じる前に呼ぶ）
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._slots = None
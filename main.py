@@ -1,154 +1,192 @@
+import time
+STARTED_AT = time.perf_counter()
+
 import discord
 from discord.ext import commands
 from discord import app_commands
-import json
 import os
+import shutil
+import sys
+import tempfile
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import asyncio
-import pytz
-
-JST = pytz.timezone('Asia/Tokyo')
+from sleep_store import build_sleep_info
+from status_render import build_status_fields
+from expiry import AUTO_WAKE
+from messages import MessageLifecycleManager
+from status_board import BOARD_FILE as STATUS_BOARD_FILE, StatusBoardManager
+from outbound import OutboundScheduler
+from analytics import format_clock, format_minutes
+from rollups import DAY, MONTH, WEEK
+from partitions import PartitionManager
+from startup import StartupTimer, sync_tree_if_changed
+from metrics import instrument_http, metrics, monitor_loop_lag, serve as serve_metrics
+from event_trace import TraceRecorder
+import history
+
+# 日本はサマータイムがないので固定のオフセットで十分（pytz の読み込みを省く）
+JST = timezone(timedelta(hours=9), 'JST')
+startup_timer = StartupTimer(STARTED_AT)
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True 
 intents.presences = True
-bot = commands.Bot(command_prefix='!', intents=intents)
 
-DATA_FILE = 'sleep_data.json'
-user_messages = {}
-auto_delete_tasks = {}
+# 'json' または 'sqlite'。sqlite の初回起動時は sleep_data.json から自動で移行する
+STORAGE_BACKEND = os.getenv('SLEEP_STORAGE_BACKEND', 'json')
+# 保持期間（日）。これより前の記録は archive/ に月ごとの gzip で移す。0 なら移さない
+SLEEP_RETENTION_DAYS = int(os.getenv('SLEEP_RETENTION_DAYS', '0'))
+# 同じユーザーのオンライン/オフラインの変化をまとめる秒数
+PRESENCE_COALESCE_SECONDS = float(os.getenv('PRESENCE_COALESCE_SECONDS', '30'))
+# シャードの数と、このプロセスが受け持つシャード（例: SHARD_COUNT=4 SHARD_IDS=0,1）。
+# 未設定なら1プロセスで Discord の推奨数のシャードを受け持つ
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()] or None
+# '1' ならギルドごとに guilds/<guild_id>/ にデータを分ける。複数プロセスでシャードを分ける場合は常に分ける
+PARTITION_BY_GUILD = os.getenv('SLEEP_PARTITION_BY_GUILD', '0') == '1' or SHARD_IDS is not None
+# メトリクスを Prometheus のテキスト形式で公開するポート。0 なら公開しない（/metrics コマンドは常に使える）
+METRICS_PORT = int(os.getenv('SLEEP_METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('SLEEP_METRICS_HOST', '127.0.0.1')
+# ボタン操作・/setstatus・プレゼンスの変化を記録するトレースファイル（benchmarks/trace_replay.py でリプレイできる）。空なら記録しない
+TRACE_FILE = os.getenv('SLEEP_TRACE_FILE', '')
+
+# 現在時刻（エポック秒）。リプレイでは仮想時計に差し替える
+clock = time.time
+
+
+def now_jst():
+    return datetime.fromtimestamp(clock(), JST)
+
+
+partitions = PartitionManager(
+    STORAGE_BACKEND, JST,
+    per_guild=PARTITION_BY_GUILD,
+    presence_window=PRESENCE_COALESCE_SECONDS,
+    retention_days=SLEEP_RETENTION_DAYS
+)
+
+
+def on_partition_loaded(partition, seconds):
+    startup_timer.record(f"データの読み込み ({partition.guild_id or '共有'})", seconds)
+    # 記録が変わったら、そのギルド（共有なら全ギルド）のステータス掲示板を更新する
+    guild_id = int(partition.guild_id) if partition.guild_id is not None else None
+    partition.store.add_listener(lambda user_id, op, record: status_boards.request_guild(guild_id))
+
+partitions.on_loaded = on_partition_loaded
+
+
+def load_state():
+    partitions.load_shared()
+
+
+class SleepTrackerBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        startup_timer.mark('モジュールの読み込み')
+        # ボタンは接続直後から受け付ける。データはその間にバックグラウンドで読み込む
+        self.add_view(SleepTrackerView())
+        instrument_http(self.http)
+        partitions.start(self.loop)
+        self.warm_up_task = self.loop.create_task(partitions.warm_up())
+        self.message_task = self.loop.create_task(message_manager.run())
+        self.status_board_task = self.loop.create_task(status_boards.run())
+        self.loop_lag_task = self.loop.create_task(monitor_loop_lag(metrics))
+        if METRICS_PORT:
+            self.metrics_task = self.loop.create_task(serve_metrics(metrics, METRICS_HOST, METRICS_PORT))
+
+    async def close(self):
+        # 保留中の睡眠データを書き出してから終了する
+        for name in ('warm_up_task', 'message_task', 'status_board_task', 'loop_lag_task', 'metrics_task'):
+            task = getattr(self, name, None)
+            if task is not None:
+                task.cancel()
+        partitions.close()
+        if trace_recorder is not None:
+            trace_recorder.close()
+        await super().close()
+
+
+# Discord への送信の順番とペース（インタラクションへの応答を後片付けの削除より先に送る）
+outbound = OutboundScheduler()
+bot = SleepTrackerBot(
+    command_prefix='!', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+    http_trace=outbound.trace_config()
+)
+
+# ボットが送ったメッセージの持ち主と自動削除の予定
+message_manager = MessageLifecycleManager()
+trace_recorder = TraceRecorder(TRACE_FILE) if TRACE_FILE else None
 # ステータスクリアボタンの確認状態を保持するための辞書
 clear_status_confirmations = {}
 
-def load_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
-
-def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-def get_user_latest_sleep_info(user_id):
-    data = load_data()
-    user_data = data.get(str(user_id), {})
-
-    is_sleeping = user_data.get('is_sleeping', False)
-
-    last_sleep_start_str = None
-    last_sleep_end_str = None
-    average_sleep_minutes = 0
-
-    sleep_records = user_data.get('sleep_records', [])
-
-    valid_sleep_records = [
-        record for record in sleep_records 
-        if record.get('duration_minutes', 0) < 200 * 60
-    ]
-
-    if valid_sleep_records:
-        total_minutes = sum(record['duration_minutes'] for record in valid_sleep_records)
-        average_sleep_minutes = total_minutes / len(valid_sleep_records)
-
-        latest_record = valid_sleep_records[-1]
-        last_sleep_start_str = latest_record.get('sleep_start')
-        last_sleep_end_str = latest_record.get('sleep_end')
-
-    if is_sleeping and 'sleep_start' in user_data:
-        sleep_start_dt = datetime.fromisoformat(user_data['sleep_start']).astimezone(JST)
-        current_time_jst = datetime.now(JST)
-
-        duration_since_sleep_start = current_time_jst - sleep_start_dt
-
-        if duration_since_sleep_start.total_seconds() > 150 * 3600:
-            print(f"User {user_id} has been 'sleeping' for over 150 hours. Auto-waking them up.")
-            sleep_record_auto_wake = {
-                'sleep_start': user_data['sleep_start'],
-                'sleep_end': current_time_jst.isoformat(),
-                'duration_minutes': int(duration_since_sleep_start.total_seconds() / 60)
-            }
-            user_data['sleep_records'].append(sleep_record_auto_wake)
-            user_data['is_sleeping'] = False
-            if 'sleep_start' in user_data:
-                del user_data['sleep_start']
-            save_data(data)
-            is_sleeping = False
-            last_sleep_start_str = sleep_record_auto_wake['sleep_start']
-            last_sleep_end_str = sleep_record_auto_wake['sleep_end']
-
-            valid_records_after_auto = [
-                record for record in user_data['sleep_records'] 
-                if record.get('duration_minutes', 0) < 200 * 60
-            ]
-            if valid_records_after_auto:
-                total_minutes = sum(record['duration_minutes'] for record in valid_records_after_auto)
-                average_sleep_minutes = total_minutes / len(valid_records_after_auto)
-
-    if is_sleeping and 'sleep_start' in user_data:
-        last_sleep_start_str = user_data['sleep_start']
-
-    # 200時間以上の起床中ステータスの自動リセット
-    if not is_sleeping and 'sleep_end' in user_data:
-        last_wake_up_dt = datetime.fromisoformat(user_data['sleep_end']).astimezone(JST)
-        current_time_jst = datetime.now(JST)
-        duration_since_last_wake_up = current_time_jst - last_wake_up_dt
-
-        if duration_since_last_wake_up.total_seconds() > 200 * 3600:
-            print(f"User {user_id} has been 'awake' for over 200 hours. Resetting their status.")
-            last_sleep_start_str = None
-            last_sleep_end_str = None
-            if 'sleep_end' in user_data:
-                del user_data['sleep_end']
-            save_data(data)
-
-    return {
-        'is_sleeping': is_sleeping,
-        'last_sleep_start': last_sleep_start_str,
-        'last_sleep_end': last_sleep_end_str,
-        'average_sleep_minutes': average_sleep_minutes,
-        'raw_user_data': user_data
-    }
+def collect_runtime_metrics():
+    # メトリクスの取得時に呼ばれる。キューの長さ・ストアの読み書きバイト数など
+    yield 'gauge', 'auto_delete_pending', {}, message_manager.pending_deletes
+    yield 'gauge', 'tracked_messages', {}, len(message_manager)
+    yield 'gauge', 'partitions_loaded', {}, len(partitions)
+    yield 'gauge', 'io_pending', {}, partitions.io.pending
+    for name, count in outbound.counters.items():
+        yield 'counter', f'outbound_{name}_total', {}, count
+    yield 'gauge', 'status_boards', {}, len(status_boards)
+    for name, count in status_boards.counters.items():
+        yield 'counter', f'status_board_{name}_total', {}, count
+    yield 'counter', 'io_coalesced_saves_total', {}, partitions.io.coalesced
+    bytes_read = bytes_written = archive_written = presence_pending = 0
+    presence_events = {}
+    for partition in partitions:
+        bytes_read += getattr(partition.store, 'bytes_read', 0)
+        bytes_written += getattr(partition.store, 'bytes_written', 0)
+        archive_written += partition.archive.bytes_written
+        presence_pending += partition.presence_pipeline.pending
+        for result, count in partition.presence_pipeline.counters.items():
+            presence_events[result] = presence_events.get(result, 0) + count
+    yield 'gauge', 'presence_pending', {}, presence_pending
+    for result, count in presence_events.items():
+        yield 'counter', 'presence_events_total', {'result': result}, count
+    yield 'counter', 'storage_bytes_read_total', {'kind': 'store'}, bytes_read
+    yield 'counter', 'storage_bytes_written_total', {'kind': 'store'}, bytes_written
+    yield 'counter', 'storage_bytes_written_total', {'kind': 'archive'}, archive_written
+
+metrics.add_collector(collect_runtime_metrics)
+
+def get_user_latest_sleep_info(partition, user_id):
+    # 読み取り専用。150時間・200時間のルールは expiry_scheduler が期限に実行する
+    return build_sleep_info(partition.store.get_state(user_id), partition.store.get_sleep_summary(user_id))
 
 async def clear_previous_messages(user_id):
-    if user_id in user_messages:
-        for msg in user_messages[user_id]:
-            try:
-                await msg.delete()
-            except discord.NotFound:
-                pass
-            except discord.HTTPException:
-                pass
-        user_messages[user_id] = []
+    await message_manager.clear_user(user_id)
 
 async def schedule_auto_delete(message, delay_minutes=2):
-    async def delete_after_delay():
-        await asyncio.sleep(delay_minutes * 60)
-        try:
-            await message.delete()
-            for user_id_key, messages in user_messages.items():
-                if message in messages:
-                    messages.remove(message)
-                    break
-        except discord.NotFound:
-            pass
-        except discord.HTTPException:
-            pass
-
-    task = asyncio.create_task(delete_after_delay())
-    auto_delete_tasks[message.id] = task
-    return task
+    message_manager.schedule_delete(message, delay_minutes * 60)
+
+def get_status_icon(discord_status):
+    return "🟢" if discord_status == discord.Status.online else \
+           "🟠" if discord_status == discord.Status.idle else \
+           "🔴" if discord_status == discord.Status.dnd else \
+           "⚪"
 
 def add_user_message(user_id, message):
-    if user_id not in user_messages:
-        user_messages[user_id] = []
-    user_messages[user_id].append(message)
+    message_manager.track(user_id, message)
+
+async def ready_partition(interaction: discord.Interaction, ephemeral: bool = False):
+    # パーティションがまだ読み込み中なら、先に応答を遅延してから待つ（インタラクションの3秒の期限に間に合わせる）
+    partition = partitions.loaded(interaction.guild)
+    if partition is None:
+        if not interaction.response.is_done():
+            await interaction.response.defer(ephemeral=ephemeral)
+        partition = await partitions.ready(interaction.guild)
+    return partition
+
+async def respond(interaction: discord.Interaction, content=None, fetch: bool = False, **kwargs):
+    # 応答を遅延していれば followup で、まだなら通常の応答で送る。fetch なら送ったメッセージを返す
+    if interaction.response.is_done():
+        return await interaction.followup.send(content, **kwargs)
+    await interaction.response.send_message(content, **kwargs)
+    return await interaction.original_response() if fetch else None
 
 async def send_all_members_status(interaction: discord.Interaction, user_id_to_track: str):
-    current_time_jst = datetime.now(JST)
-    data = load_data()
+    current_time_jst = now_jst()
 
     embed = discord.Embed(
         title='📊 ステータス',
@@ -159,137 +197,81 @@ async def send_all_members_status(interaction: discord.Interaction, user_id_to_t
 
     members = interaction.guild.members
 
-    display_members = sorted([m for m in members if not m.bot and not m.system and str(m.id) in data], key=lambda m: m.display_name.lower())
-
-    if not display_members:
-        embed.description = "まだ睡眠記録があるメンバーがいません。「おやすみ」ボタンから記録を開始してください。"
-    else:
-        status_messages = []
-        for member in display_members:
-            member_info = get_user_latest_sleep_info(member.id)
-
-            discord_status = member.status
-            status_icon = "🟢" if discord_status == discord.Status.online else \
-                          "🟠" if discord_status == discord.Status.idle else \
-                          "🔴" if discord_status == discord.Status.dnd else \
-                          "⚪"
-
-            status_emoji = "😴" if member_info['is_sleeping'] else "☀️"
-            status_text = "睡眠中" if member_info['is_sleeping'] else "起床中"
-
-            time_since_status_change = ""
-            if member_info['is_sleeping'] and 'sleep_start' in member_info['raw_user_data']:
-                sleep_start_dt = datetime.fromisoformat(member_info['raw_user_data']['sleep_start']).astimezone(JST)
-                duration = current_time_jst - sleep_start_dt
-                hours = int(duration.total_seconds() // 3600)
-                minutes = int((duration.total_seconds() % 3600) // 60)
-                time_since_status_change = f" ({hours}時間{minutes}分睡眠中)"
-            elif not member_info['is_sleeping'] and 'sleep_end' in member_info['raw_user_data']:
-                last_wake_up_dt = datetime.fromisoformat(member_info['raw_user_data']['sleep_end']).astimezone(JST)
-                duration = current_time_jst - last_wake_up_dt
-                hours = int(duration.total_seconds() // 3600)
-                minutes = int((duration.total_seconds() % 3600) // 60)
-                if duration.total_seconds() < 200 * 3600:
-                    time_since_status_change = f" ({hours}時間{minutes}分起床中)"
-
-            last_sleep_start_display = "記録なし"
-            if member_info['last_sleep_start']:
-                try:
-                    last_sleep_start_dt = datetime.fromisoformat(member_info['last_sleep_start']).astimezone(JST)
-                    last_sleep_start_display = last_sleep_start_dt.strftime('%Y-%m-%d %H:%M')
-                except ValueError:
-                    last_sleep_start_display = "日付形式エラー"
-
-            last_sleep_end_display = "記録なし"
-            if member_info['last_sleep_end']:
-                try:
-                    last_sleep_end_dt = datetime.fromisoformat(member_info['last_sleep_end']).astimezone(JST)
-                    last_sleep_end_display = last_sleep_end_dt.strftime('%Y-%m-%d %H:%M')
-                except ValueError:
-                    last_sleep_end_display = "日付形式エラー"
-
-            avg_sleep_display = "記録なし"
-            if member_info['average_sleep_minutes'] > 0:
-                avg_hours = int(member_info['average_sleep_minutes'] // 60)
-                avg_minutes = int(member_info['average_sleep_minutes'] % 60)
-                avg_sleep_display = f"{avg_hours}時間{avg_minutes}分"
-
-            status_messages.append(
-                f"{member.mention} {status_emoji} **{status_text}** {time_since_status_change} {status_icon}\n"
-                f"  最後に寝た時間: {last_sleep_start_display}\n"
-                f"  最後に起きた時間: {last_sleep_end_display}\n"
-                f"  平均睡眠時間: {avg_sleep_display}"
-            )
+    partition = await partitions.ready(interaction.guild)
+    with metrics.span('render_seconds', part='status'):
+        display_members = sorted([m for m in members if not m.bot and not m.system], key=lambda m: m.display_name.lower())
+        status_messages = partition.status_renderer.render(
+            [(str(m.id), m.mention, get_status_icon(m.status)) for m in display_members],
+            current_time_jst
+        )
 
-        field_value = "\n\n".join(status_messages)
-
-        if len(field_value) > 1024:
-            chunks = []
-            current_chunk = []
-            current_chunk_len = 0
-            for msg in status_messages:
-                if current_chunk_len + len(msg) + 2 > 1024 and current_chunk:
-                    chunks.append("\n\n".join(current_chunk))
-                    current_chunk = [msg]
-                    current_chunk_len = len(msg) + 2
-                else:
-                    current_chunk.append(msg)
-                    current_chunk_len += len(msg) + 2
-            if current_chunk:
-                chunks.append("\n\n".join(current_chunk))
-
-            for i, chunk in enumerate(chunks):
-                embed.add_field(name=f'メンバーのステータス ({i+1}/{len(chunks)})', value=chunk, inline=False)
+        if not status_messages:
+            embed.description = "まだ睡眠記録があるメンバーがいません。「おやすみ」ボタンから記録を開始してください。"
         else:
-            embed.add_field(name='メンバーのステータス', value=field_value, inline=False)
+            for name, value in build_status_fields(status_messages):
+                embed.add_field(name=name, value=value, inline=False)
 
     status_message = await interaction.followup.send(embed=embed)
     add_user_message(user_id_to_track, status_message)
 
+async def render_status_board(guild):
+    # ステータス掲示板のフィールド。経過時間は相対時刻の表示にする（時間が経っても内容が変わらない）
+    partition = await partitions.ready(guild)
+    with metrics.span('render_seconds', part='board'):
+        display_members = sorted([m for m in guild.members if not m.bot and not m.system], key=lambda m: m.display_name.lower())
+        status_messages = partition.status_renderer.render(
+            [(str(m.id), m.mention, get_status_icon(m.status)) for m in display_members]
+        )
+        return build_status_fields(status_messages) if status_messages else []
+
+# チャンネルごとのステータス掲示板（1つのメッセージを書き換える）
+# 掲示板のメッセージ ID はギルドのデータと同じディレクトリに置く（シャードごとのプロセスが同じファイルを書かないように）
+status_boards = StatusBoardManager(
+    render_status_board,
+    path_of=lambda guild_id: os.path.join(partitions.directory_of(guild_id), STATUS_BOARD_FILE),
+    resolve_channel=bot.get_channel,
+)
+
+async def show_status(interaction: discord.Interaction, user_id: str):
+    # チャンネルのステータス掲示板の更新を予約する。掲示板を置けない場所では従来どおり embed を送る
+    if not status_boards.request(interaction.channel, interaction.guild):
+        await send_all_members_status(interaction, user_id)
+
 
 class SleepTrackerView(discord.ui.View):
     def __init__(self):
         super().__init__(timeout=None)
 
     @discord.ui.button(label='😴 おやすみ', style=discord.ButtonStyle.primary, custom_id='sleep_button')
+    @metrics.timed('handler_seconds', handler='sleep_button')
     async def sleep_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         user_id = str(interaction.user.id)
-        current_time_jst = datetime.now(JST)
-
         await clear_previous_messages(user_id)
+        # 読み込み中のパーティションを待つ前に応答しておく
         await interaction.response.defer()
+        partition = await partitions.ready(interaction.guild)
+        await self._sleep(interaction, partition, user_id)
 
-        data = load_data()
-        if user_id not in data:
-            data[user_id] = {'sleep_records': []}
-
-        if data[user_id].get('is_sleeping', False) and 'sleep_start' in data[user_id]:
-            sleep_start_dt = datetime.fromisoformat(data[user_id]['sleep_start']).astimezone(JST)
-            duration_since_sleep_start = current_time_jst - sleep_start_dt
-
-            if duration_since_sleep_start.total_seconds() > 150 * 3600:
-                sleep_record_auto_wake = {
-                    'sleep_start': data[user_id]['sleep_start'],
-                    'sleep_end': current_time_jst.isoformat(),
-                    'duration_minutes': int(duration_since_sleep_start.total_seconds() / 60)
-                }
-                data[user_id]['sleep_records'].append(sleep_record_auto_wake)
-                data[user_id]['is_sleeping'] = False
-                if 'sleep_start' in data[user_id]:
-                    del data[user_id]['sleep_start']
-                save_data(data)
-
-                embed_auto_wake = discord.Embed(
-                    title='⚠️ 自動起床処理',
-                    description=f'{interaction.user.mention} さんは150時間以上睡眠中と判断されたため、自動的に起床状態になりました。\n再度「おやすみ」を押して睡眠を開始してください。',
-                    color=0xffcc00
-                )
-                auto_wake_message = await interaction.followup.send(embed=embed_auto_wake)
-                add_user_message(user_id, auto_wake_message)
-                await schedule_auto_delete(auto_wake_message, 2)
-                return
+    async def _sleep(self, interaction: discord.Interaction, partition, user_id: str):
+        current_time_jst = now_jst()
+
+        # 確認と状態遷移は同期で終わるので、ロックはその間だけ持つ（応答・送信の間は同じユーザーの次の操作を待たせない）
+        async with partition.state_machine.locked(user_id):
+            auto_woke = partition.expiry_scheduler.fire_if_due(user_id) == AUTO_WAKE
+            transition = None if auto_woke else partition.state_machine.sleep(user_id, current_time_jst)
 
-        if data[user_id].get('is_sleeping', False):
+        if auto_woke:
+            embed_auto_wake = discord.Embed(
+                title='⚠️ 自動起床処理',
+                description=f'{interaction.user.mention} さんは150時間以上睡眠中と判断されたため、自動的に起床状態になりました。\n再度「おやすみ」を押して睡眠を開始してください。',
+                color=0xffcc00
+            )
+            auto_wake_message = await interaction.followup.send(embed=embed_auto_wake)
+            add_user_message(user_id, auto_wake_message)
+            await schedule_auto_delete(auto_wake_message, 2)
+            return
+
+        if not transition.ok:
             embed = discord.Embed(
                 title='😴 すでに睡眠中です',
                 description='先に「🌅 おはよう」で起床を記録してください',
@@ -299,11 +281,7 @@ class SleepTrackerView(discord.ui.View):
             add_user_message(user_id, already_sleeping_message)
             return
 
-        data[user_id]['is_sleeping'] = True
-        data[user_id]['sleep_start'] = current_time_jst.isoformat()
-        save_data(data)
-
-        await send_all_members_status(interaction, user_id)
+        await show_status(interaction, user_id)
 
         embed = discord.Embed(
             title='😴 おやすみなさい！',
@@ -321,15 +299,21 @@ class SleepTrackerView(discord.ui.View):
         await schedule_auto_delete(message, 2)
 
     @discord.ui.button(label='🌅 おはよう', style=discord.ButtonStyle.success, custom_id='wake_button')
+    @metrics.timed('handler_seconds', handler='wake_button')
     async def wake_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         user_id = str(interaction.user.id)
-        current_time_jst = datetime.now(JST)
-
         await clear_previous_messages(user_id)
+        # 読み込み中のパーティションを待つ前に応答しておく
         await interaction.response.defer()
+        partition = await partitions.ready(interaction.guild)
+        await self._wake(interaction, partition, user_id)
+
+    async def _wake(self, interaction: discord.Interaction, partition, user_id: str):
+        current_time_jst = now_jst()
 
-        data = load_data()
-        if user_id not in data or not data[user_id].get('is_sleeping', False):
+        async with partition.state_machine.locked(user_id):
+            transition = partition.state_machine.wake(user_id, current_time_jst)
+        if not transition.ok:
             embed = discord.Embed(
                 title='🌅 睡眠記録がありません',
                 description='先に「😴 おやすみ」で睡眠を開始してください',
@@ -339,23 +323,10 @@ class SleepTrackerView(discord.ui.View):
             add_user_message(user_id, no_record_message)
             return
 
-        sleep_start = datetime.fromisoformat(data[user_id]['sleep_start']).astimezone(JST)
-        sleep_duration = current_time_jst - sleep_start
+        sleep_start = transition.sleep_start
+        sleep_duration = transition.duration
 
-        sleep_record = {
-            'sleep_start': data[user_id]['sleep_start'],
-            'sleep_end': current_time_jst.isoformat(),
-            'duration_minutes': int(sleep_duration.total_seconds() / 60)
-        }
-
-        data[user_id]['sleep_records'].append(sleep_record)
-        data[user_id]['is_sleeping'] = False
-        if 'sleep_start' in data[user_id]:
-            del data[user_id]['sleep_start']
-        data[user_id]['sleep_end'] = current_time_jst.isoformat() 
-        save_data(data)
-
-        await send_all_members_status(interaction, user_id)
+        await show_status(interaction, user_id)
 
         hours = int(sleep_duration.total_seconds() // 3600)
         minutes = int((sleep_duration.total_seconds() % 3600) // 60)
@@ -378,121 +349,114 @@ class SleepTrackerView(discord.ui.View):
         await schedule_auto_delete(message, 2)
 
     @discord.ui.button(label='📊 ステータス', style=discord.ButtonStyle.secondary, custom_id='stats_button')
+    @metrics.timed('handler_seconds', handler='stats_button')
     async def stats_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         await clear_previous_messages(str(interaction.user.id))
         await interaction.response.defer()
-        await send_all_members_status(interaction, str(interaction.user.id))
+        await show_status(interaction, str(interaction.user.id))
 
     @discord.ui.button(label='💀 自分のステータスをクリア', style=discord.ButtonStyle.danger, custom_id='clear_my_status_button')
+    @metrics.timed('handler_seconds', handler='clear_my_status_button')
     async def clear_my_status_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         user_id = str(interaction.user.id)
         await clear_previous_messages(user_id)
+        partition = await ready_partition(interaction)
+        await self._clear_my_status(interaction, partition, user_id)
 
-        if user_id in clear_status_confirmations and clear_status_confirmations[user_id]:
-            # 2回目のクリック：データをクリア
-            data = load_data()
-            if user_id in data:
-                del data[user_id] # ユーザーの全データを削除
-                save_data(data)
+    async def _clear_my_status(self, interaction: discord.Interaction, partition, user_id: str):
+        # 確認状態はギルドごと（別のサーバーで押した確認で消さないように）
+        confirmation_key = (partition.guild_id, user_id)
+
+        async with partition.state_machine.locked(user_id):
+            confirmed = clear_status_confirmations.pop(confirmation_key, False)
+            cleared = confirmed and partition.state_machine.clear(user_id).ok # ユーザーの全データを削除
+            if not confirmed:
+                clear_status_confirmations[confirmation_key] = True
 
+        if confirmed:
+            # 2回目のクリック：データをクリア
+            if cleared:
                 embed = discord.Embed(
                     title='✅ ステータスがクリアされました',
                     description=f'{interaction.user.mention} さんのすべての睡眠データが削除されました。',
                     color=0x00ff00
                 )
-                response_message = await interaction.response.send_message(embed=embed)
             else:
                 embed = discord.Embed(
                     title='ℹ️ 睡眠データがありません',
                     description=f'{interaction.user.mention} さんにはクリアする睡眠データがありません。',
                     color=0x00aaff
                 )
-                response_message = await interaction.response.send_message(embed=embed)
 
-            del clear_status_confirmations[user_id] # 確認状態をリセット
-            add_user_message(user_id, await interaction.original_response())
+            response_message = await respond(interaction, embed=embed, fetch=True)
+            add_user_message(user_id, response_message)
             await schedule_auto_delete(response_message, 5) # 5秒後に削除
         else:
             # 1回目のクリック：確認を求める
-            clear_status_confirmations[user_id] = True
             embed = discord.Embed(
                 title='⚠️ ステータスクリアの確認',
                 description=f'{interaction.user.mention} さんの**すべての睡眠データを削除**します。\n本当に削除する場合は、**もう一度**「💀 自分のステータスをクリア」ボタンを押してください。',
                 color=0xffcc00
             )
-            response_message = await interaction.response.send_message(embed=embed, ephemeral=True)
-            add_user_message(user_id, await interaction.original_response())
+            add_user_message(user_id, await respond(interaction, embed=embed, ephemeral=True, fetch=True))
 
             # 10秒後に確認状態をリセットするタスク
             async def reset_confirmation():
                 await asyncio.sleep(10)
-                if user_id in clear_status_confirmations and clear_status_confirmations[user_id]:
-                    del clear_status_confirmations[user_id]
+                if confirmation_key in clear_status_confirmations and clear_status_confirmations[confirmation_key]:
+                    del clear_status_confirmations[confirmation_key]
                     print(f"User {user_id}'s clear status confirmation timed out.")
             asyncio.create_task(reset_confirmation())
 
 
 @bot.event
 async def on_ready():
+    # 再接続のたびにも呼ばれる
+    startup_timer.mark('接続完了')
     print(f'{bot.user} がログインしました！')
     print(f'ボットID: {bot.user.id}')
     print('新機能: タイムゾーン修正、オンライン/オフライン連携、自動就寝/起床、異常データ自動削除機能が追加されました')
 
-    try:
-        synced = await bot.tree.sync()
-        print(f'{len(synced)}個のコマンドを同期しました。')
-    except Exception as e:
-        print(f'コマンド同期中にエラーが発生しました: {e}')
+    # コマンドはグローバルなので、シャード 0 を受け持つプロセスだけが同期する
+    owns_commands = bot.shard_ids is None or 0 in bot.shard_ids
+    if owns_commands and not getattr(bot, 'tree_checked', False):
+        # コマンドの定義が前回の同期から変わっていなければ同期しない
+        try:
+            with startup_timer.phase('コマンドの確認・同期'):
+                synced = await sync_tree_if_changed(bot.tree, bot.application_id)
+            if synced is None:
+                print('コマンドに変更がないため同期を省略しました。')
+            else:
+                print(f'{synced}個のコマンドを同期しました。')
+            bot.tree_checked = True
+        except Exception as e:
+            print(f'コマンド同期中にエラーが発生しました: {e}')
 
-    bot.add_view(SleepTrackerView())
+    # このプロセスが受け持つギルドのデータを先に読み込んでおく（ギルドごとに分けている場合）
+    if partitions.per_guild:
+        bot.loop.create_task(partitions.warm_up(bot.guilds))
 
 @bot.event
+async def on_interaction(interaction: discord.Interaction):
+    startup_timer.mark('最初のインタラクション')
+    if trace_recorder is not None:
+        trace_recorder.record_interaction(interaction)
+
+@bot.event
+@metrics.timed('handler_seconds', handler='on_presence_update')
 async def on_presence_update(before: discord.Member, after: discord.Member):
     if after.bot or after.system:
         return
 
-    user_id = str(after.id)
-    data = load_data()
-
-    if user_id not in data:
-        return
-
-    user_data = data[user_id]
-    current_time_jst = datetime.now(JST)
-
-    if before.status != discord.Status.offline and after.status == discord.Status.offline:
-        if not user_data.get('is_sleeping', False):
-            print(f"User {after.display_name} went offline. Auto-sleeping them.")
-            user_data['is_sleeping'] = True
-            user_data['sleep_start'] = current_time_jst.isoformat()
-            save_data(data)
-
-    elif before.status == discord.Status.offline and after.status != discord.Status.offline:
-        if user_data.get('is_sleeping', False) and 'sleep_start' in user_data:
-            sleep_start_dt = datetime.fromisoformat(user_data['sleep_start']).astimezone(JST)
-            current_sleep_duration_minutes = (current_time_jst - sleep_start_dt).total_seconds() / 60
-
-            member_info = get_user_latest_sleep_info(user_id)
-            average_sleep_minutes = member_info['average_sleep_minutes']
-
-            if average_sleep_minutes > 0:
-                lower_bound = (average_sleep_minutes - 60)
-                upper_bound = (average_sleep_minutes + 60)
-
-                if lower_bound <= current_sleep_duration_minutes <= upper_bound:
-                    print(f"User {after.display_name} went online. Auto-waking them based on average sleep time.")
-                    sleep_record_auto_wake = {
-                        'sleep_start': user_data['sleep_start'],
-                        'sleep_end': current_time_jst.isoformat(),
-                        'duration_minutes': int(current_sleep_duration_minutes)
-                    }
-                    user_data['sleep_records'].append(sleep_record_auto_wake)
-                    user_data['is_sleeping'] = False
-                    del user_data['sleep_start']
-                    user_data['sleep_end'] = current_time_jst.isoformat() 
-                    save_data(data)
+    was_offline = before.status == discord.Status.offline
+    is_offline = after.status == discord.Status.offline
+    if trace_recorder is not None:
+        trace_recorder.record_presence(after.id, was_offline, is_offline)
+    # 判断と保存はギルドのパーティションの presence_pipeline がまとめて行う
+    (await partitions.ready(after.guild)).presence_pipeline.submit(after.id, after.display_name, was_offline, is_offline)
 
 @bot.tree.command(name='start', description='睡眠トラッカーを開始します。')
+@metrics.timed('handler_seconds', handler='/start')
 async def start_tracker_slash(interaction: discord.Interaction):
     user_id = str(interaction.user.id)
 
@@ -504,7 +468,7 @@ async def start_tracker_slash(interaction: discord.Interaction):
 
     embed.add_field(
         name='🐻使い方🐻',
-        value='😴 **おやすみ** - 睡眠開始を記録（ログは2分後自動で削除）\n🌅 **おはよう** - 起床を記録（ログは2分後自動で削除）\n📊 **ステータス** - 全員の睡眠ステータスを表示\n💀 **自分のステータスをクリア** - 自分の睡眠データをすべて削除（2回押しで確定）',
+        value='😴 **おやすみ** - 睡眠開始を記録（ログは2分後自動で削除）\n🌅 **おはよう** - 起床を記録（ログは2分後自動で削除）\n📊 **ステータス** - 全員の睡眠ステータスの掲示板を更新\n💀 **自分のステータスをクリア** - 自分の睡眠データをすべて削除（2回押しで確定）',
         inline=False
     )
 
@@ -513,77 +477,284 @@ async def start_tracker_slash(interaction: discord.Interaction):
     view = SleepTrackerView()
     await interaction.response.send_message(embed=embed, view=view)
 
+@bot.tree.command(name='stats', description='睡眠の統計を表示します。')
+@app_commands.guild_only()
+@app_commands.describe(member='統計を表示するユーザー（省略すると自分）')
+@metrics.timed('handler_seconds', handler='/stats')
+async def stats_slash(interaction: discord.Interaction, member: discord.Member = None):
+    target = member or interaction.user
+    current_time_jst = now_jst()
+    analytics = (await ready_partition(interaction)).analytics
+    member_ids = [m.id for m in interaction.guild.members if not m.bot and not m.system] if interaction.guild is not None else []
+    # アーカイブ済みの記録は I/O スレッドで読んでおく（イベントループで gzip を読まない）。読む間は応答を遅延しておく
+    archived_users = analytics.needs_archive([target.id] + member_ids, current_time_jst)
+    if archived_users:
+        if not interaction.response.is_done():
+            await interaction.response.defer()
+        await analytics.prefetch(archived_users, partitions.io, current_time_jst)
+    user_stats = analytics.user_stats(target.id, current_time_jst)
+
+    embed = discord.Embed(
+        title='📈 睡眠の統計',
+        description=f'{target.mention} さんの睡眠統計',
+        color=0x99ffff,
+        timestamp=current_time_jst
+    )
+    if user_stats is None:
+        embed.description = f'{target.mention} さんにはまだ睡眠記録がありません。'
+    else:
+        embed.add_field(
+            name='😴 睡眠時間',
+            value=(
+                f"平均: {format_minutes(user_stats['mean_minutes'])}\n"
+                f"中央値: {format_minutes(user_stats['median_minutes'])}\n"
+                f"10%〜90%: {format_minutes(user_stats['p10_minutes'])}〜{format_minutes(user_stats['p90_minutes'])}\n"
+                f"直近7日の平均: {format_minutes(user_stats['rolling_7d_minutes'])}\n"
+                f"直近30日の平均: {format_minutes(user_stats['rolling_30d_minutes'])}"
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name='🕰️ 規則正しさ',
+            value=(
+                f"就寝: {format_clock(user_stats['bedtime_mean'])} (±{format_minutes(user_stats['bedtime_spread_minutes'])})\n"
+                f"起床: {format_clock(user_stats['wake_mean'])} (±{format_minutes(user_stats['wake_spread_minutes'])})"
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name='📅 記録',
+            value=(
+                f"記録数: {user_stats['count']}回\n"
+                f"睡眠負債（直近14日）: {format_minutes(user_stats['sleep_debt_minutes'])}\n"
+                f"連続記録: {user_stats['current_streak_days']}日（最長 {user_stats['longest_streak_days']}日）"
+            ),
+            inline=False
+        )
+
+    if interaction.guild is not None:
+        guild_stats = analytics.guild_stats(interaction.guild.id, member_ids, current_time_jst)
+        if guild_stats is not None:
+            embed.add_field(
+                name='👥 サーバー全体',
+                value=(
+                    f"記録のあるメンバー: {guild_stats['users']}人\n"
+                    f"中央値: {format_minutes(guild_stats['median_minutes'])}\n"
+                    f"直近7日の平均: {format_minutes(guild_stats['rolling_7d_minutes'])}\n"
+                    f"睡眠負債の平均: {format_minutes(guild_stats['sleep_debt_minutes'])}\n"
+                    f"最長の連続記録: {guild_stats['longest_streak_days']}日"
+                ),
+                inline=False
+            )
+
+    stats_message = await respond(interaction, embed=embed, fetch=True)
+    add_user_message(str(interaction.user.id), stats_message)
+    await schedule_auto_delete(stats_message, 2)
+
+RANKING_PERIODS = {
+    DAY: ('今日', '%m/%d'),
+    WEEK: ('今週', '%m/%d〜'),
+    MONTH: ('今月', '%Y年%m月')
+}
+
+@bot.tree.command(name='ranking', description='睡眠時間のランキングを表示します。')
+@app_commands.guild_only()
+@app_commands.describe(period='集計する期間')
+@app_commands.choices(period=[
+    app_commands.Choice(name='今日', value=DAY),
+    app_commands.Choice(name='今週', value=WEEK),
+    app_commands.Choice(name='今月', value=MONTH)
+])
+@metrics.timed('handler_seconds', handler='/ranking')
+async def ranking_slash(interaction: discord.Interaction, period: app_commands.Choice[str] = None):
+    granularity = period.value if period else WEEK
+    rollups = (await ready_partition(interaction)).rollups
+    current_time_jst = now_jst()
+    bucket = rollups.bucket_of(granularity, current_time_jst)
+    label, date_format = RANKING_PERIODS[granularity]
+
+    member_ids = None
+    mentions = {}
+    if interaction.guild is not None:
+        members = [m for m in interaction.guild.members if not m.bot and not m.system]
+        member_ids = [m.id for m in members]
+        mentions = {str(m.id): m.mention for m in members}
+    ranking = rollups.top(granularity, bucket, n=10, user_ids=member_ids)
+
+    embed = discord.Embed(
+        title=f'🏆 {label}の睡眠時間ランキング',
+        description=f"集計期間: {rollups.bucket_start(granularity, bucket).strftime(date_format)}",
+        color=0xffcc66,
+        timestamp=current_time_jst
+    )
+    if not ranking:
+        embed.add_field(name='ランキング', value='この期間の睡眠記録はまだありません。', inline=False)
+    else:
+        lines = [
+            f"{rank}. {mentions.get(user_id, f'<@{user_id}>')} - {format_minutes(minutes)}"
+            for rank, (user_id, minutes) in enumerate(ranking, start=1)
+        ]
+        embed.add_field(name='ランキング', value='\n'.join(lines), inline=False)
+
+    ranking_message = await respond(interaction, embed=embed, fetch=True)
+    add_user_message(str(interaction.user.id), ranking_message)
+    await schedule_auto_delete(ranking_message, 2)
+
 @bot.tree.command(name='setstatus', description='プレイヤーの睡眠ステータスを変更します。')
 @app_commands.describe(member='ステータスを変更するユーザー', status='設定するステータス (sleep または wake)')
 @app_commands.checks.has_permissions(administrator=True)
 @app_commands.checks.has_role('Automaton')
+@metrics.timed('handler_seconds', handler='/setstatus')
 async def set_status_slash(interaction: discord.Interaction, member: discord.Member, status: str):
     user_id = str(member.id)
-    current_time_jst = datetime.now(JST)
-    data = load_data()
+    partition = await ready_partition(interaction)
+    await _set_status(interaction, partition, member, user_id, status)
 
-    if user_id not in data:
-        data[user_id] = {'sleep_records': []}
+async def _set_status(interaction: discord.Interaction, partition, member: discord.Member, user_id: str, status: str):
+    current_time_jst = now_jst()
 
     status_lower = status.lower()
 
+    # 状態遷移の間だけロックを持ち、応答はロックの外で送る
+    transition = None
+    async with partition.state_machine.locked(user_id):
+        if status_lower == 'sleep':
+            transition = partition.state_machine.sleep(user_id, current_time_jst)
+        elif status_lower == 'wake':
+            transition = partition.state_machine.wake(user_id, current_time_jst)
+
     if status_lower == 'sleep':
-        if data[user_id].get('is_sleeping', False):
-            await interaction.response.send_message(f'{member.mention} は既に睡眠中です。', ephemeral=True)
+        if not transition.ok:
+            await respond(interaction, f'{member.mention} は既に睡眠中です。', ephemeral=True)
             return
 
-        data[user_id]['is_sleeping'] = True
-        data[user_id]['sleep_start'] = current_time_jst.isoformat()
-        save_data(data)
         embed = discord.Embed(
             title='✅ ステータス変更',
             description=f'{member.mention} のステータスを **睡眠中** に設定しました。',
             color=0x9999ff
         )
-        await interaction.response.send_message(embed=embed)
+        await respond(interaction, embed=embed)
 
     elif status_lower == 'wake':
-        if not data[user_id].get('is_sleeping', False):
-            await interaction.response.send_message(f'{member.mention} は既に起床中です。または睡眠記録がありません。', ephemeral=True)
+        if not transition.ok:
+            await respond(interaction, f'{member.mention} は既に起床中です。または睡眠記録がありません。', ephemeral=True)
             return
 
-        if 'sleep_start' in data[user_id]:
-            sleep_start = datetime.fromisoformat(data[user_id]['sleep_start']).astimezone(JST)
-            sleep_duration = current_time_jst - sleep_start
-
-            sleep_record = {
-                'sleep_start': data[user_id]['sleep_start'],
-                'sleep_end': current_time_jst.isoformat(),
-                'duration_minutes': int(sleep_duration.total_seconds() / 60)
-            }
-            data[user_id]['sleep_records'].append(sleep_record)
-
-        data[user_id]['is_sleeping'] = False
-        if 'sleep_start' in data[user_id]:
-            del data[user_id]['sleep_start']
-        data[user_id]['sleep_end'] = current_time_jst.isoformat()
-        save_data(data)
-
         embed = discord.Embed(
             title='✅ ステータス変更',
             description=f'{member.mention} のステータスを **起床中** に設定しました。',
             color=0xffff99
         )
-        await interaction.response.send_message(embed=embed)
+        await respond(interaction, embed=embed)
 
     else:
-        await interaction.response.send_message('無効なステータスです。「sleep」または「wake」を指定してください。', ephemeral=True)
+        await respond(interaction, '無効なステータスです。「sleep」または「wake」を指定してください。', ephemeral=True)
 
 @set_status_slash.error
 async def set_status_slash_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
     if isinstance(error, app_commands.MissingPermissions):
-        await interaction.response.send_message('このコマンドを実行する権限がありません。「管理者」権限が必要です。', ephemeral=True)
+        await respond(interaction, 'このコマンドを実行する権限がありません。「管理者」権限が必要です。', ephemeral=True)
     elif isinstance(error, app_commands.MissingRole):
-        await interaction.response.send_message('このコマンドを実行する権限がありません。「Automaton」ロールが必要です。', ephemeral=True)
+        await respond(interaction, 'このコマンドを実行する権限がありません。「Automaton」ロールが必要です。', ephemeral=True)
+    else:
+        await respond(interaction, f'エラーが発生しました: {error}', ephemeral=True)
+
+@bot.tree.command(name='export', description='睡眠記録をファイルに書き出します。')
+@app_commands.describe(format='ファイル形式', member='書き出すユーザー（省略するとサーバー全員）')
+@app_commands.choices(format=[
+    app_commands.Choice(name='CSV', value='csv'),
+    app_commands.Choice(name='NDJSON', value='ndjson')
+])
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.checks.has_role('Automaton')
+@metrics.timed('handler_seconds', handler='/export')
+async def export_slash(interaction: discord.Interaction, format: app_commands.Choice[str] = None, member: discord.Member = None):
+    fmt = format.value if format else 'csv'
+    await interaction.response.defer(ephemeral=True)
+    store = (await partitions.ready(interaction.guild)).store
+    if member is not None:
+        user_ids = [member.id]
     else:
-        await interaction.response.send_message(f'エラーが発生しました: {error}', ephemeral=True)
+        user_ids = [m.id for m in interaction.guild.members if not m.bot and not m.system and m.id in store]
+
+    workdir = tempfile.mkdtemp(prefix='sleep-export-')
+    try:
+        filename = f"sleep_records_{now_jst().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+        path = os.path.join(workdir, filename)
+        count = await history.export_to_file_async(store, path, partitions.io, fmt, user_ids)
+        if os.path.getsize(path) > interaction.guild.filesize_limit:
+            await interaction.followup.send(
+                f'{count}件の記録はファイルの上限サイズを超えるため送信できません。サーバー上で `python main.py export` を使ってください。',
+                ephemeral=True
+            )
+            return
+        await interaction.followup.send(
+            f'{count}件の睡眠記録を書き出しました。',
+            file=discord.File(path, filename=filename),
+            ephemeral=True
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+@bot.tree.command(name='import', description='CSV / NDJSON ファイルから睡眠記録を読み込みます。')
+@app_commands.describe(file='読み込むファイル（/export で書き出した形式）')
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.checks.has_role('Automaton')
+@metrics.timed('handler_seconds', handler='/import')
+async def import_slash(interaction: discord.Interaction, file: discord.Attachment):
+    await interaction.response.defer(ephemeral=True)
+    member_ids = [m.id for m in interaction.guild.members if not m.bot and not m.system]
+    store = (await partitions.ready(interaction.guild)).store
+
+    workdir = tempfile.mkdtemp(prefix='sleep-import-')
+    try:
+        path = os.path.join(workdir, 'upload')
+        await file.save(path)
+        try:
+            result = await history.import_from_file_async(store, path, partitions.io, history.format_of(file.filename), member_ids)
+        except (ValueError, UnicodeDecodeError) as e:
+            await interaction.followup.send(f'ファイルを読み込めませんでした: {e}', ephemeral=True)
+            return
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    message = f'{result.imported}件の睡眠記録を読み込みました（重複・対象外でスキップ: {result.skipped}件、エラー: {result.error_count}件）。'
+    if result.errors:
+        message += '\n' + '\n'.join(result.errors[:10])
+    await interaction.followup.send(message[:2000], ephemeral=True)
+
+@bot.tree.command(name='metrics', description='処理時間・読み書きの量などの計測値を表示します。')
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.checks.has_role('Automaton')
+async def metrics_slash(interaction: discord.Interaction):
+    lines = []
+    length = 0
+    for line in metrics.summary_lines():
+        # メッセージの上限（2000文字）に収まる分だけ
+        if length + len(line) + 1 > 1900:
+            lines.append('…')
+            break
+        lines.append(line)
+        length += len(line) + 1
+    await interaction.response.send_message('```\n' + ('\n'.join(lines) or 'まだ計測値がありません。') + '\n```', ephemeral=True)
+
+export_slash.error(set_status_slash_error)
+import_slash.error(set_status_slash_error)
+metrics_slash.error(set_status_slash_error)
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ('export', 'import'):
+        # python main.py export sleep.csv / python main.py import sleep.ndjson
+        # ギルドごとに分けている場合は SLEEP_GUILD_ID で対象のギルドを指定する
+        guild_id = os.getenv('SLEEP_GUILD_ID')
+        if partitions.per_guild and not guild_id:
+            print('エラー: ギルドごとにデータを分けている場合は SLEEP_GUILD_ID を指定してください')
+            sys.exit(1)
+        partition = partitions.get(guild_id)
+        exit_code = history.run_cli(partition.store, sys.argv[1:])
+        partitions.close()
+        sys.exit(exit_code)
+
     TOKEN = ('MTMzNTU1NzM3NDEwMjA3NzUwMQ.GS94Gs.iJ1KlBFtZnw56L8fGLP4_BidGODj7Ri5t-FYBQ')
     if not TOKEN:
         print('エラー: DISCORD_BOT_TOKEN環境変数が設定されていません')
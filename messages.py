@@ -0,0 +1,184 @@
+import asyncio
+import heapq
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import discord
+
+from outbound import housekeeping
+
+# 一括削除 (bulk delete) の制約
+BULK_DELETE_MAX = 100
+BULK_DELETE_MAX_AGE = timedelta(days=14)
+
+
+class MessageLifecycleManager:
+    # ボットが送ったメッセージの持ち主と自動削除をまとめて管理する。
+    # message_id -> 持ち主 の索引で O(1) に追跡を外し、削除予定は1本のヒープで管理する。
+    # 削除はチャンネルごとにまとめ、可能なら一括削除 API を使う。削除済みのものは参照を残さない。
+    # ユーザーの古いメッセージの削除（clear_user）は待たずに後片付けの列に入れ、merge_window 秒の間に
+    # 来た削除とまとめて送る。削除は後片付け（outbound.housekeeping）として、インタラクションへの応答より後に回る。
+
+    def __init__(self, clock=time.monotonic, merge_window: float = 0.5):
+        self.clock = clock
+        self.merge_window = merge_window
+        self._messages: dict = {}
+        self._owners: dict = {}
+        self._by_user: dict = {}
+        self._heap = []
+        # すぐに削除するメッセージ（run() が merge_window ごとにまとめて削除する）
+        self._outbox = []
+        # 一括削除が Forbidden で失敗したチャンネル（以降は1件ずつ削除する）
+        self._no_bulk_channels: set = set()
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def __len__(self):
+        return len(self._messages)
+
+    @property
+    def pending_deletes(self) -> int:
+        return len(self._heap) + len(self._outbox)
+
+    def track(self, user_id, message):
+        if message is None:
+            return
+        user_id = str(user_id)
+        self._messages[message.id] = message
+        self._owners[message.id] = user_id
+        self._by_user.setdefault(user_id, {})[message.id] = None
+
+    def schedule_delete(self, message, delay_seconds: float):
+        if message is None:
+            return
+        self._messages.setdefault(message.id, message)
+        deadline = self.clock() + delay_seconds
+        heapq.heappush(self._heap, (deadline, message.id))
+        if self._wakeup is not None and self._heap[0][1] == message.id:
+            self._wakeup.set()
+
+    def _forget(self, message_id):
+        message = self._messages.pop(message_id, None)
+        owner = self._owners.pop(message_id, None)
+        if owner is not None:
+            owned = self._by_user.get(owner)
+            if owned is not None:
+                owned.pop(message_id, None)
+                if not owned:
+                    del self._by_user[owner]
+        return message
+
+    async def clear_user(self, user_id):
+        # そのユーザーに紐づくメッセージをすべて削除する（予約済みの自動削除も不要になる）。
+        # run() が動いていれば削除の列に入れるだけで、削除の完了は待たない
+        owned = self._by_user.pop(str(user_id), None)
+        if not owned:
+            return
+        messages = [self._forget(message_id) for message_id in owned]
+        messages = [message for message in messages if message is not None]
+        if self._wakeup is None:
+            await self.delete_messages(messages)
+            return
+        self._outbox.extend(messages)
+        self._wakeup.set()
+
+    def pop_due(self) -> list:
+        now = self.clock()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, message_id = heapq.heappop(self._heap)
+            message = self._forget(message_id)
+            if message is not None:
+                due.append(message)
+        return due
+
+    async def delete_messages(self, messages):
+        by_channel: dict = {}
+        singles = []
+        bulk_channels: dict = {}
+        for message in messages:
+            if _can_bulk_delete(message):
+                channel_id = message.channel.id
+                allowed = bulk_channels.get(channel_id)
+                if allowed is None:
+                    allowed = bulk_channels[channel_id] = (
+                        channel_id not in self._no_bulk_channels and _may_bulk_delete_in(message.channel)
+                    )
+                if allowed:
+                    by_channel.setdefault(channel_id, []).append(message)
+                    continue
+            singles.append(message)
+
+        for channel_messages in by_channel.values():
+            if len(channel_messages) == 1:
+                singles.extend(channel_messages)
+                continue
+            channel = channel_messages[0].channel
+            for i in range(0, len(channel_messages), BULK_DELETE_MAX):
+                chunk = channel_messages[i:i + BULK_DELETE_MAX]
+                try:
+                    await channel.delete_messages(chunk)
+                except discord.Forbidden:
+                    # 権限がない。このチャンネルでは次から一括削除を試さない
+                    self._no_bulk_channels.add(channel.id)
+                    singles.extend(chunk)
+                except discord.HTTPException:
+                    # 一部が削除済みなどの場合は1件ずつ削除する
+                    singles.extend(chunk)
+
+        for message in singles:
+            try:
+                await message.delete()
+            except discord.NotFound:
+                pass
+            except discord.HTTPException:
+                pass
+
+    async def run(self, max_sleep: float = 60.0):
+        self._wakeup = asyncio.Event()
+        # このタスクから送る削除はすべて後片付けとして扱う
+        with housekeeping():
+            while True:
+                if self._outbox:
+                    # 続けて来る削除をまとめるため少し待つ
+                    await asyncio.sleep(self.merge_window)
+                due = self._outbox + self.pop_due()
+                self._outbox = []
+                if due:
+                    try:
+                        await self.delete_messages(due)
+                    except Exception as e:
+                        print(f'メッセージの自動削除中にエラーが発生しました: {e}')
+                if self._outbox:
+                    continue
+                timeout = max_sleep
+                if self._heap:
+                    timeout = min(timeout, max(0.0, self._heap[0][0] - self.clock()))
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+
+def _may_bulk_delete_in(channel) -> bool:
+    # 一括削除には「メッセージの管理」の権限が要る（自分のメッセージを1件ずつ消すだけなら要らない）。
+    # 権限を確かめられないチャンネルでは試してみて、Forbidden なら覚えておく
+    guild = getattr(channel, 'guild', None)
+    me = getattr(guild, 'me', None)
+    if me is None or not hasattr(channel, 'permissions_for'):
+        return True
+    return channel.permissions_for(me).manage_messages
+
+
+def _can_bulk_delete(message) -> bool:
+    channel = getattr(message, 'channel', None)
+    if channel is None or not hasattr(channel, 'delete_messages'):
+        return False
+    flags = getattr(message, 'flags', None)
+    if flags is not None and flags.ephemeral:
+        return False
+    created_at = getattr(message, 'created_at', None)
+    if created_at is None:
+        return False
+    return datetime.now(timezone.utc) - created_at < BULK_DELETE_MAX_AGE
@@ -0,0 +1,248 @@
+import asyncio
+import bisect
+import functools
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+# 本番で常に有効にしておける軽さの計測（1回の計測は perf_counter 2回と辞書の更新1回）。
+# 処理時間はヒストグラム、件数・バイト数はカウンタ、キューの長さなどは取得時に呼ぶ collector で集める。
+# /metrics コマンドと、任意でローカルの HTTP エンドポイント（Prometheus のテキスト形式）から見られる。
+
+PREFIX = 'sleepbot_'
+# 秒。上限ごとの件数を数える（Prometheus の le）
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 処理時間を計るストアのメソッド
+STORE_OPS = (
+    'load', 'flush', 'compact', 'close',
+    'get_state', 'get_sleep_summary', 'get_record_columns', 'get_history_columns', 'get_status_snapshot',
+    'start_sleep', 'end_sleep', 'clear_wake', 'clear_user',
+    'add_records', 'records_before', 'fold_records'
+)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # 最後の要素は +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        # 区切りの中で線形補間した推定値（+Inf に入った分は最大値で置き換える）
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for i, count in enumerate(self.counts):
+            upper = self.buckets[i] if i < len(self.buckets) else self.max
+            if count and seen + count >= rank:
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+            lower = upper
+        return self.max
+
+
+class MetricsRegistry:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        # (名前, ラベル) -> Histogram / 値
+        self._histograms: dict = {}
+        self._counters: dict = {}
+        # 呼ぶと (種類, 名前, ラベル, 値) を返す関数。種類は 'counter' か 'gauge'
+        self._collectors = []
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        return histogram
+
+    def observe(self, name: str, seconds: float, **labels):
+        self.histogram(name, **labels).observe(seconds)
+
+    def inc(self, name: str, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        histogram = self.histogram(name, **labels)
+        started = self.clock()
+        try:
+            yield
+        except BaseException:
+            self.inc(name.replace('_seconds', '_errors_total'), **labels)
+            raise
+        finally:
+            histogram.observe(self.clock() - started)
+
+    def timed(self, name: str, **labels):
+        # コルーチン関数の実行時間を計るデコレータ（discord.py のボタン・コマンド・イベントにそのまま使える）
+        histogram = self.histogram(name, **labels)
+        clock = self.clock
+
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = clock()
+                try:
+                    return await func(*args, **kwargs)
+                except BaseException:
+                    self.inc(name.replace('_seconds', '_errors_total'), **labels)
+                    raise
+                finally:
+                    histogram.observe(clock() - started)
+            return wrapper
+        return decorator
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def samples(self):
+        # (種類, 名前, ラベル, 値) をすべて返す（ヒストグラムは除く）
+        for (name, labels), value in self._counters.items():
+            yield 'counter', name, labels, value
+        for collector in self._collectors:
+            try:
+                for kind, name, labels, value in collector():
+                    yield kind, name, tuple(sorted(labels.items())), value
+            except Exception as e:
+                print(f'メトリクスの収集中にエラーが発生しました: {e}')
+
+    def render_prometheus(self) -> str:
+        lines = []
+        typed = set()
+
+        def type_line(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {PREFIX}{name} {kind}')
+
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            type_line(name, 'histogram')
+            cumulative = 0
+            for i, count in enumerate(histogram.counts):
+                cumulative += count
+                le = repr(float(histogram.buckets[i])) if i < len(histogram.buckets) else '+Inf'
+                lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f'{PREFIX}{name}_sum{_labels(labels)} {histogram.sum!r}')
+            lines.append(f'{PREFIX}{name}_count{_labels(labels)} {histogram.count}')
+        for kind, name, labels, value in sorted(self.samples(), key=lambda sample: (sample[1], sample[2])):
+            type_line(name, kind)
+            lines.append(f'{PREFIX}{name}{_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary_lines(self, limit: Optional[int] = None) -> list:
+        # /metrics 用。合計時間の長い順に 件数 / p50 / p99 / 最大
+        histograms = sorted(
+            ((name, labels, h) for (name, labels), h in self._histograms.items() if h.count),
+            key=lambda item: item[2].sum, reverse=True
+        )
+        lines = []
+        for name, labels, h in histograms[:limit]:
+            label = ','.join(str(value) for _, value in labels)
+            lines.append(
+                f'{name}[{label}] n={h.count} p50={h.quantile(0.5) * 1000:.1f}ms '
+                f'p99={h.quantile(0.99) * 1000:.1f}ms max={h.max * 1000:.1f}ms'
+            )
+        for kind, name, labels, value in sorted(self.samples(), key=lambda sample: (sample[1], sample[2])):
+            label = ','.join(str(value) for _, value in labels)
+            lines.append(f'{name}[{label}] {value}' if label else f'{name} {value}')
+        return lines
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def instrument_store(store, registry: Optional['MetricsRegistry'] = None):
+    # ストアのメソッドをインスタンスごとに差し替えて storage_seconds{op=...} を計る
+    registry = registry or metrics
+    clock = registry.clock
+    for op in STORE_OPS:
+        method = getattr(store, op, None)
+        if method is None:
+            continue
+        histogram = registry.histogram('storage_seconds', op=op)
+
+        def timed_method(*args, _method=method, _histogram=histogram, **kwargs):
+            started = clock()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                _histogram.observe(clock() - started)
+        setattr(store, op, timed_method)
+    return store
+
+
+def instrument_http(http, registry: Optional['MetricsRegistry'] = None):
+    # discord.py の HTTPClient.request を包み、Discord API の往復時間をルート（テンプレートのパス）ごとに計る
+    registry = registry or metrics
+    request = http.request
+
+    async def timed_request(route, **kwargs):
+        with registry.span('discord_http_seconds', route=f'{route.method} {route.path}'):
+            return await request(route, **kwargs)
+    http.request = timed_request
+    return http
+
+
+async def monitor_loop_lag(registry: Optional['MetricsRegistry'] = None, interval: float = 0.25):
+    # interval 秒ごとに起き、予定より遅れた時間（イベントループが他の処理で止まっていた時間）を loop_lag_seconds に記録する
+    registry = registry or metrics
+    histogram = registry.histogram('loop_lag_seconds')
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, loop.time() - started - interval))
+
+
+async def serve(registry: 'MetricsRegistry', host: str = '127.0.0.1', port: int = 9108):
+    # GET /metrics に Prometheus のテキスト形式で答えるだけの小さな HTTP サーバー
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', registry.render_prometheus().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f'メトリクスを http://{host}:{port}/metrics で公開しています。')
+    async with server:
+        await server.serve_forever()
+
+
+# ボット全体で共有する既定のレジストリ
+metrics = MetricsRegistry()
@@ -0,0 +1,176 @@
+import asyncio
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+# Discord への HTTP リクエストの送り出しを調整する。
+# discord.py の aiohttp セッションにトレース（http_trace）として入り、すべてのリクエスト
+# （ボットの API と、インタラクションの応答・フォローアップの webhook）の送信直前と応答を見る。
+#  - 応答の X-RateLimit-* ヘッダーからバケットごとの残り回数とリセット時刻を覚え、使い切る前に送信を待たせる
+#  - 後片付け（housekeeping() の中で送るメッセージ削除など）はバケットに reserve 回分を残して待ち、
+#    インタラクションへの応答が送信中の間も待つ（最大 max_housekeeping_delay 秒）
+
+INTERACTIVE = 0
+HOUSEKEEPING = 1
+
+_priority = contextvars.ContextVar('outbound_priority', default=INTERACTIVE)
+
+# この ID ごとにレート制限が分かれる（major parameter）。webhook・インタラクションはトークンまで含める
+_MAJOR_RESOURCES = {'channels': 1, 'guilds': 1, 'webhooks': 2, 'interactions': 2}
+
+
+@contextmanager
+def housekeeping():
+    # この中（と、この中で作ったタスク）から送るリクエストを後片付けとして扱う
+    token = _priority.set(HOUSEKEEPING)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def route_key(method: str, path: str):
+    # ('DELETE /channels/{id}/messages/{id}', '123') のように、(ルート, major parameter) にする
+    parts = [part for part in path.split('/') if part]
+    if len(parts) >= 2 and parts[0] == 'api' and parts[1].startswith('v'):
+        parts = parts[2:]
+    major = ''
+    if parts and parts[0] in _MAJOR_RESOURCES:
+        count = _MAJOR_RESOURCES[parts[0]]
+        major = '/'.join(parts[1:1 + count])
+        parts = parts[:1] + ['{id}'] * len(parts[1:1 + count]) + parts[1 + count:]
+    template = '/'.join('{id}' if part.isdigit() else part for part in parts)
+    return f'{method.upper()} /{template}', major
+
+
+class _Bucket:
+    __slots__ = ('limit', 'remaining', 'reset_at', 'in_flight')
+
+    def __init__(self):
+        self.limit = 1
+        self.remaining = 1
+        self.reset_at = 0.0
+        self.in_flight = 0
+
+    def available(self, now: float) -> int:
+        # リセット時刻を過ぎていれば満タンに戻っているとみなす
+        remaining = self.limit if now >= self.reset_at else self.remaining
+        return remaining - self.in_flight
+
+
+class OutboundScheduler:
+    def __init__(self, reserve: int = 1, max_housekeeping_delay: float = 2.0, clock=time.monotonic):
+        self.reserve = reserve
+        self.max_housekeeping_delay = max_housekeeping_delay
+        self.clock = clock
+        # ルート -> X-RateLimit-Bucket（同じハッシュのルートは制限を共有する）
+        self._hashes: dict = {}
+        self._buckets: dict = {}
+        self._interactive = 0
+        self._idle: Optional[asyncio.Event] = None
+        self.counters = {'requests': 0, 'paced': 0, 'yielded': 0, 'rate_limited': 0}
+
+    def _bucket_id(self, route: str, major: str) -> str:
+        return f'{self._hashes.get(route, route)}:{major}'
+
+    def _idle_event(self) -> asyncio.Event:
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            self._idle.set()
+        return self._idle
+
+    async def before_request(self, method: str, path: str):
+        # 送信してよくなるまで待ち、after_request() に渡す値を返す
+        route, major = route_key(method, path)
+        priority = _priority.get()
+        idle = self._idle_event()
+        self.counters['requests'] += 1
+        if priority == HOUSEKEEPING:
+            if not idle.is_set():
+                self.counters['yielded'] += 1
+                try:
+                    await asyncio.wait_for(idle.wait(), self.max_housekeeping_delay)
+                except asyncio.TimeoutError:
+                    pass
+        else:
+            self._interactive += 1
+            idle.clear()
+
+        try:
+            paced = False
+            while True:
+                bucket = self._buckets.get(self._bucket_id(route, major))
+                if bucket is None:
+                    break
+                now = self.clock()
+                # 1回しか送れないバケット（一括削除など）では残さない
+                reserve = min(self.reserve, bucket.limit - 1) if priority == HOUSEKEEPING else 0
+                if bucket.available(now) > reserve:
+                    bucket.in_flight += 1
+                    break
+                if not paced:
+                    paced = True
+                    self.counters['paced'] += 1
+                # リセットを待つ。リセット済みなら送信中のリクエストの応答を待つ
+                await asyncio.sleep(bucket.reset_at - now if bucket.reset_at > now else 0.05)
+        except BaseException:
+            self._done(priority)
+            raise
+        return route, major, priority, bucket
+
+    def after_request(self, token, status: Optional[int] = None, headers=None):
+        route, major, priority, bucket = token
+        if bucket is not None:
+            bucket.in_flight -= 1
+        self._done(priority)
+        if status == 429:
+            self.counters['rate_limited'] += 1
+        if not headers or 'X-RateLimit-Remaining' not in headers:
+            return
+        bucket_hash = headers.get('X-RateLimit-Bucket')
+        if bucket_hash:
+            self._hashes[route] = bucket_hash
+        bucket_id = self._bucket_id(route, major)
+        updated = self._buckets.get(bucket_id)
+        if updated is None:
+            updated = self._buckets[bucket_id] = _Bucket()
+            if bucket is not None and bucket is not updated:
+                updated.in_flight = bucket.in_flight
+        updated.limit = int(headers.get('X-RateLimit-Limit', 1))
+        updated.remaining = int(headers.get('X-RateLimit-Remaining', 0))
+        updated.reset_at = self.clock() + float(headers.get('X-RateLimit-Reset-After', 0))
+        if status == 429 and 'Retry-After' in headers:
+            updated.remaining = 0
+            updated.reset_at = max(updated.reset_at, self.clock() + float(headers['Retry-After']))
+
+    def _done(self, priority: int):
+        if priority != HOUSEKEEPING:
+            self._interactive -= 1
+            if not self._interactive:
+                self._idle_event().set()
+
+    def trace_config(self):
+        # discord.Client(http_trace=...) に渡す aiohttp.TraceConfig
+        import aiohttp
+
+        async def on_request_start(session, context, params):
+            context.outbound = await self.before_request(params.method, params.url.path)
+
+        async def on_request_end(session, context, params):
+            token = getattr(context, 'outbound', None)
+            if token is not None:
+                context.outbound = None
+                self.after_request(token, params.response.status, params.response.headers)
+
+        async def on_request_exception(session, context, params):
+            token = getattr(context, 'outbound', None)
+            if token is not None:
+                context.outbound = None
+                self.after_request(token)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
@@ -0,0 +1,219 @@
+import asyncio
+import json
+import os
+import time
+from typing import Optional
+
+from analytics import SleepAnalytics
+from expiry import ExpiryScheduler
+from io_executor import IOExecutor
+from metrics import instrument_store
+from presence import PresencePipeline
+from retention import RetentionPolicy, SleepArchive
+from rollups import SleepRollups
+from sleep_patterns import SleepPatternModel
+from sleep_state import SleepStateMachine
+from sleep_store import JsonSleepStore, _atomic_write
+from sqlite_store import SqliteSleepStore
+from status_render import StatusRenderer
+
+DATA_FILE = 'sleep_data.json'
+SQLITE_FILE = 'sleep_data.db'
+ARCHIVE_DIR = 'archive'
+
+
+class GuildPartition:
+    # 1つのデータ置き場（ストア）と、それを使う集計・スケジューラ一式。
+    # ギルドごとに分ける場合は guilds/<guild_id>/ 以下、分けない場合はカレントディレクトリを使う
+
+    def __init__(self, guild_id, directory: str, backend: str, tz, presence_window: float = 30.0, retention_days: int = 0,
+                 io: Optional[IOExecutor] = None, clock=time.time):
+        self.guild_id = guild_id
+        self.directory = directory
+        data_file = os.path.join(directory, DATA_FILE)
+        if backend == 'sqlite':
+            self.store = SqliteSleepStore(os.path.join(directory, SQLITE_FILE), migrate_from=data_file)
+        else:
+            self.store = JsonSleepStore(data_file, io=io)
+        instrument_store(self.store)
+        self.status_renderer = StatusRenderer(self.store, tz)
+        self.expiry_scheduler = ExpiryScheduler(self.store, tz, clock=clock)
+        self.state_machine = SleepStateMachine(self.store, tz)
+        self.analytics = SleepAnalytics(self.store, tz)
+        self.rollups = SleepRollups(self.store, tz)
+        self.archive = SleepArchive(os.path.join(directory, ARCHIVE_DIR), io=io)
+        self.archive.attach(self.store)
+        self.retention = RetentionPolicy(self.store, self.archive, retention_days, clock=clock, io=io) if retention_days > 0 else None
+        self.patterns = SleepPatternModel(self.store, tz)
+        self.presence_pipeline = PresencePipeline(self.state_machine, window=presence_window, clock=clock, patterns=self.patterns)
+        self._tasks = []
+
+    def load(self):
+        self.store.load()
+        self.archive.load()
+        self.rollups.load()
+        self.patterns.load()
+        self.expiry_scheduler.load()
+        self.presence_pipeline.load()
+
+    def start(self, loop):
+        self._tasks.append(loop.create_task(self.expiry_scheduler.run()))
+        self._tasks.append(loop.create_task(self.presence_pipeline.run()))
+        if self.retention is not None:
+            self._tasks.append(loop.create_task(self.retention.run()))
+
+    def close(self):
+        # 保留中の睡眠データを書き出してから閉じる
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self.presence_pipeline.flush_due(force=True)
+        self.store.close()
+
+
+class PartitionManager:
+    # ギルド -> GuildPartition。per_guild=False なら全ギルドで1つのパーティションを共有する（従来の sleep_data.json）。
+    # パーティションは最初に使われたときに読み込むので、シャードごとのプロセスは自分が受け持つギルドのファイルしか開かない。
+    # ギルドごとのパーティションを初めて作るとき、従来の sleep_data.json があればそのギルドのメンバーの分を引き継ぐ
+    # （共有のファイルなので読むだけにし、引き継いだら手放す）。
+    # ハンドラからは ready() を使う。読み込みは I/O スレッド（io）で行い、その間もイベントループは止まらない
+    # （読み込みが終わるまでそのパーティションには誰も触らないので、ストアをスレッドから読み込んでも安全）。
+    # 読み込み後の保存・アーカイブへの書き込みも同じ I/O スレッドで行う
+
+    def __init__(self, backend: str, tz, per_guild: bool = False, root: str = 'guilds',
+                 presence_window: float = 30.0, retention_days: int = 0, legacy_path: str = DATA_FILE, clock=time.time):
+        self.backend = backend
+        self.tz = tz
+        self.per_guild = per_guild
+        self.root = root
+        self.presence_window = presence_window
+        self.retention_days = retention_days
+        self.legacy_path = legacy_path
+        # エポック秒を返す関数。期限・プレゼンス・保持期間の判断に使う（リプレイでは仮想時計に差し替える）
+        self.clock = clock
+        self._partitions: dict = {}
+        self._loading: dict = {}
+        self._loop = None
+        self.io = IOExecutor()
+        # 読み込みにかかった時間を (パーティション, 秒) で受け取る
+        self.on_loaded = None
+
+    def __iter__(self):
+        return iter(list(self._partitions.values()))
+
+    def __len__(self):
+        return len(self._partitions)
+
+    def key_of(self, guild_id):
+        return str(guild_id) if self.per_guild and guild_id is not None else None
+
+    def directory_of(self, guild_id) -> str:
+        # そのギルドのデータを置くディレクトリ（共有パーティションならカレントディレクトリ）
+        return self._directory(self.key_of(guild_id))
+
+    def _directory(self, key) -> str:
+        return '.' if key is None else os.path.join(self.root, key)
+
+    def _create(self, key, member_ids) -> GuildPartition:
+        started = time.perf_counter()
+        directory = self._directory(key)
+        if key is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._seed(directory, member_ids)
+        partition = GuildPartition(
+            key, directory, self.backend, self.tz,
+            presence_window=self.presence_window, retention_days=self.retention_days, io=self.io, clock=self.clock
+        )
+        partition.load()
+        if self.on_loaded is not None:
+            self.on_loaded(partition, time.perf_counter() - started)
+        return partition
+
+    def _register(self, key, partition: GuildPartition) -> GuildPartition:
+        self._partitions[key] = partition
+        if self._loop is not None:
+            partition.start(self._loop)
+        return partition
+
+    def get(self, guild_id, member_ids=None) -> GuildPartition:
+        # 同期版（CLI・ベンチマーク用）。まだなければその場で読み込む
+        key = self.key_of(guild_id)
+        partition = self._partitions.get(key)
+        if partition is not None:
+            return partition
+        return self._register(key, self._create(key, member_ids))
+
+    def for_guild(self, guild) -> GuildPartition:
+        # discord.Guild から。新しいパーティションの引き継ぎにメンバー一覧を使う
+        if guild is None:
+            return self.get(None)
+        if self.key_of(guild.id) in self._partitions:
+            return self._partitions[self.key_of(guild.id)]
+        return self.get(guild.id, [m.id for m in guild.members])
+
+    def loaded(self, guild) -> Optional[GuildPartition]:
+        # 読み込み済みならそのパーティション、まだなら None（読み込みは始めない）
+        return self._partitions.get(self.key_of(guild.id if guild is not None else None))
+
+    async def ready(self, guild) -> GuildPartition:
+        # パーティションを返す。読み込み中なら終わるまで待ち、未読み込みなら別スレッドで読み込む
+        guild_id = guild.id if guild is not None else None
+        key = self.key_of(guild_id)
+        partition = self._partitions.get(key)
+        if partition is not None:
+            return partition
+        loading = self._loading.get(key)
+        if loading is None:
+            member_ids = [m.id for m in guild.members] if guild is not None and key is not None else None
+            loading = self._loading[key] = asyncio.ensure_future(self._load_in_thread(key, member_ids))
+        return await asyncio.shield(loading)
+
+    async def _load_in_thread(self, key, member_ids) -> GuildPartition:
+        try:
+            partition = await self.io.run(self._create, key, member_ids)
+            return self._register(key, partition)
+        finally:
+            self._loading.pop(key, None)
+
+    async def warm_up(self, guilds=()):
+        # 起動直後にバックグラウンドで読み込んでおく
+        if not self.per_guild:
+            await self.ready(None)
+            return
+        await asyncio.gather(*(self.ready(guild) for guild in guilds))
+
+    def _seed(self, directory: str, member_ids):
+        data_file = os.path.join(directory, DATA_FILE)
+        if (member_ids is None or os.path.exists(data_file)
+                or os.path.exists(os.path.join(directory, SQLITE_FILE)) or not os.path.exists(self.legacy_path)):
+            return
+        # シャードごとのプロセスが同時に読むことがあるので、書き直し（ジャーナルの取り込み）はしない
+        legacy = JsonSleepStore(self.legacy_path)
+        legacy.load(read_only=True)
+        seed = {}
+        for member_id in member_ids:
+            user_data = legacy.get_user_data(member_id)
+            if user_data is not None:
+                seed[str(member_id)] = user_data
+        del legacy
+        if seed:
+            _atomic_write(data_file, json.dumps(seed, ensure_ascii=False, indent=2).encode('utf-8'))
+            print(f'{self.legacy_path} から {len(seed)}人分の睡眠データをギルド {os.path.basename(directory)} に引き継ぎました。')
+
+    def load_shared(self):
+        # ギルドごとに分けない場合の共有パーティションをその場で読み込む（CLI・ベンチマーク用）
+        if not self.per_guild:
+            self.get(None)
+
+    def start(self, loop):
+        self._loop = loop
+        for partition in self._partitions.values():
+            partition.start(loop)
+
+    def close(self):
+        # I/O スレッドで書き出し中の保存を終わらせてから、各ストアを閉じる
+        self.io.shutdown()
+        for partition in self._partitions.values():
+            partition.close()
+        self._partitions = {}
+        self._loop = None
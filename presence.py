@@ -0,0 +1,130 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Optional
+
+from sleep_patterns import SleepPatternModel
+from sleep_state import SleepStateMachine
+
+
+class _PendingPresence:
+    __slots__ = ('display_name', 'was_offline', 'is_offline', 'changed_at', 'first_seen', 'events')
+
+    def __init__(self, display_name, was_offline, is_offline, changed_at):
+        self.display_name = display_name
+        self.was_offline = was_offline
+        self.is_offline = is_offline
+        self.changed_at = changed_at
+        self.first_seen = changed_at
+        self.events = 1
+
+
+class PresencePipeline:
+    # on_presence_update のイベントを受け取り、記録のあるユーザーのオンライン/オフラインの変化だけを残す。
+    # 同じユーザーの変化は window 秒の間まとめ、最初と最後の状態だけを見て自動就寝/自動起床を判断する。
+    # 判断はまとめて適用し、ストアへの書き込みは1バッチ（1コミット）にする。
+    # ボタン操作などでロック中のユーザーは次の反映まで持ち越す。
+    # 寝た・起きたとみなすかは、そのユーザーの曜日ごとの睡眠パターン（patterns）で決める。
+
+    def __init__(self, machine: SleepStateMachine, window: float = 30.0, clock=time.time,
+                 patterns: Optional[SleepPatternModel] = None):
+        self.machine = machine
+        self.store = machine.store
+        self.tz = machine.tz
+        self.window = window
+        self.clock = clock
+        self.patterns = patterns or SleepPatternModel(self.store, self.tz)
+        self._pending: dict = {}
+        self._tracked = set()
+        self.counters = {'received': 0, 'dropped': 0, 'coalesced': 0, 'applied': 0, 'rejected': 0}
+        self.store.add_listener(self._on_store_change)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def load(self):
+        self._tracked = set(str(user_id) for user_id in self.store.user_ids())
+
+    def _on_store_change(self, user_id, op, record):
+        if op == 'clear':
+            self._tracked.discard(user_id)
+            self._pending.pop(user_id, None)
+        else:
+            self._tracked.add(user_id)
+
+    def submit(self, user_id, display_name: str, was_offline: bool, is_offline: bool) -> bool:
+        # 取り込んだ場合は True。記録のないユーザーやオフライン状態が変わらないイベントは捨てる
+        self.counters['received'] += 1
+        user_id = str(user_id)
+        if user_id not in self._tracked or was_offline == is_offline:
+            self.counters['dropped'] += 1
+            return False
+
+        now = self.clock()
+        pending = self._pending.get(user_id)
+        if pending is None:
+            self._pending[user_id] = _PendingPresence(display_name, was_offline, is_offline, now)
+        else:
+            self.counters['coalesced'] += 1
+            pending.display_name = display_name
+            pending.is_offline = is_offline
+            pending.changed_at = now
+            pending.events += 1
+        return True
+
+    def flush_due(self, force: bool = False) -> int:
+        # window を過ぎたユーザーの判断をまとめて適用し、適用した件数を返す
+        now = self.clock()
+        due = [
+            user_id for user_id, pending in self._pending.items()
+            if force or (now - pending.first_seen >= self.window and not self.machine.is_locked(user_id))
+        ]
+        if not due:
+            return 0
+
+        applied = 0
+        with self.store.batch():
+            for user_id in due:
+                pending = self._pending.pop(user_id)
+                if pending.was_offline == pending.is_offline:
+                    # 窓の中で元に戻った（一瞬のオフラインなど）
+                    continue
+                if self._apply(user_id, pending):
+                    applied += 1
+        self.counters['applied'] += applied
+        return applied
+
+    def _apply(self, user_id, pending: _PendingPresence) -> bool:
+        state = self.store.get_state(user_id)
+        if state is None:
+            return False
+        changed_at = datetime.fromtimestamp(pending.changed_at, self.tz)
+
+        if pending.is_offline:
+            if state.get('is_sleeping', False):
+                return False
+            if not self.patterns.should_sleep(user_id, changed_at):
+                # いつもの就寝時刻から離れている（昼間にオフラインになっただけなど）
+                self.counters['rejected'] += 1
+                return False
+            transition = self.machine.sleep(user_id, changed_at)
+            if transition.ok:
+                print(f"User {pending.display_name} went offline. Auto-sleeping them.")
+            return transition.ok
+
+        if state.get('is_sleeping', False) and 'sleep_start' in state:
+            sleep_start_dt = datetime.fromisoformat(state['sleep_start']).astimezone(self.tz)
+            if self.patterns.should_wake(user_id, sleep_start_dt, changed_at):
+                print(f"User {pending.display_name} went online. Auto-waking them based on their sleep pattern.")
+                return self.machine.wake(user_id, changed_at).ok
+            self.counters['rejected'] += 1
+        return False
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.window / 2)
+            try:
+                self.flush_due()
+            except Exception as e:
+                print(f'プレゼンスの反映中にエラーが発生しました: {e}')
@@ -0,0 +1,255 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+from typing import Optional
+
+from sleep_records import parse_iso
+from sleep_store import SleepStore
+
+# 保持期間より古い sleep_records を、月ごとの gzip NDJSON（archive/YYYY-MM.ndjson.gz）に移す。
+# ストアには保持期間内の記録だけが残り、件数・合計は集計に残るので平均は変わらない。
+# アーカイブは追記のたびに gzip のメンバーを1つ足す（gzip は連結したメンバーをそのまま読める）。
+
+US_PER_DAY = 24 * 3600 * 1_000_000
+# 今月・先月のランキング（起動時にストアの記録から作る）が欠けないよう、これより短くはしない
+MIN_RETENTION_DAYS = 62
+# 1回にまとめて処理するユーザー数（取り出した記録をメモリに置く量の上限）
+USERS_PER_PASS = 500
+
+
+class SleepArchive:
+    # io（IOExecutor）を渡すと、ユーザー削除に合わせた書き直しを I/O スレッドで行う
+    # （追記も RetentionPolicy が同じスレッドで行うので、ファイルへの書き込みが重ならない）
+
+    def __init__(self, directory: str, io=None):
+        self.directory = directory
+        self.io = io
+        self.index_path = os.path.join(directory, 'index.json')
+        # user_id -> その人の記録がある月の一覧
+        self._index: dict = {}
+        # 追記した gzip のバイト数
+        self.bytes_written = 0
+
+    def attach(self, store: SleepStore):
+        # store.get_history_columns() がアーカイブも読むようにし、ユーザーの削除に合わせてアーカイブからも消す
+        store.archive = self
+        store.add_listener(self._on_store_change)
+
+    def _on_store_change(self, user_id, op, record):
+        if op != 'clear':
+            return
+        if self.io is not None:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+            else:
+                asyncio.ensure_future(self.io.run(self.forget_user, user_id))
+                return
+        self.forget_user(user_id)
+
+    def load(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self._index = json.load(f)
+
+    def segment_path(self, month: str) -> str:
+        return os.path.join(self.directory, f'{month}.ndjson.gz')
+
+    def months_of(self, user_id) -> list:
+        return self._index.get(str(user_id), [])
+
+    def append(self, rows):
+        # rows は (user_id, 記録) の列。月ごとにまとめて追記し、書き込みを確定してから索引を更新する
+        by_month: dict = {}
+        for user_id, record in rows:
+            by_month.setdefault(record['sleep_end'][:7], []).append((str(user_id), record))
+        if not by_month:
+            return 0
+        os.makedirs(self.directory, exist_ok=True)
+        count = 0
+        for month, month_rows in sorted(by_month.items()):
+            lines = ''.join(
+                json.dumps({'user_id': user_id, **record}, ensure_ascii=False) + '\n'
+                for user_id, record in month_rows
+            )
+            member = gzip.compress(lines.encode('utf-8'))
+            with open(self.segment_path(month), 'ab') as f:
+                f.write(member)
+                f.flush()
+                os.fsync(f.fileno())
+            self.bytes_written += len(member)
+            for user_id, _ in month_rows:
+                months = self._index.setdefault(user_id, [])
+                if month not in months:
+                    months.append(month)
+                    months.sort()
+            count += len(month_rows)
+        self._write_index()
+        return count
+
+    def _write_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+
+    def _scan(self, month: str, user_ids: Optional[set] = None):
+        path = self.segment_path(month)
+        if not os.path.exists(path):
+            return
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                user_id = row.pop('user_id')
+                if user_ids is None or user_id in user_ids:
+                    yield user_id, row
+
+    def read_user(self, user_id) -> list:
+        # そのユーザーのアーカイブ済みの記録（古い順）
+        return self.read_users([user_id]).get(str(user_id), [])
+
+    def read_users(self, user_ids) -> dict:
+        # user_id -> アーカイブ済みの記録（古い順）。必要な月のファイルを1回ずつ読む。
+        # 移動の途中で止まった場合に同じ記録が2回書かれていることがあるので、就寝時刻で重複を除く
+        wanted = set(str(user_id) for user_id in user_ids)
+        months = sorted(set(month for user_id in wanted for month in self.months_of(user_id)))
+        records: dict = {}
+        seen: dict = {}
+        for month in months:
+            for user_id, record in self._scan(month, wanted):
+                starts = seen.setdefault(user_id, set())
+                if record['sleep_start'] in starts:
+                    continue
+                starts.add(record['sleep_start'])
+                records.setdefault(user_id, []).append(record)
+        return records
+
+    def find_starts(self, wanted: dict) -> dict:
+        # wanted は user_id -> {月: {就寝時刻のエポックマイクロ秒}}。そのうちアーカイブに既にある就寝時刻を
+        # user_id -> set で返す（インポートの重複確認用。必要な月のファイルだけを1回ずつ読む）
+        by_month: dict = {}
+        for user_id, months in wanted.items():
+            archived = self.months_of(user_id)
+            for month, starts in months.items():
+                if month in archived:
+                    by_month.setdefault(month, {}).setdefault(user_id, set()).update(starts)
+        found: dict = {}
+        for month, users in sorted(by_month.items()):
+            for user_id, record in self._scan(month, set(users)):
+                try:
+                    start_us, _ = parse_iso(record['sleep_start'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if start_us in users[user_id]:
+                    found.setdefault(user_id, set()).add(start_us)
+        return found
+
+    def iter_records(self, user_ids=None):
+        # (user_id, 記録) を月の順に返す（全ユーザーの書き出し用）
+        wanted = None if user_ids is None else set(str(user_id) for user_id in user_ids)
+        months = sorted(set(month for months in self._index.values() for month in months))
+        seen = set()
+        for month in months:
+            for user_id, record in self._scan(month, wanted):
+                key = (user_id, record['sleep_start'])
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield user_id, record
+
+    def forget_user(self, user_id):
+        # ユーザーの記録をアーカイブからも消す（その人の記録がある月のファイルだけを書き直す）
+        user_id = str(user_id)
+        months = self._index.pop(user_id, None)
+        if not months:
+            return
+        for month in months:
+            path = self.segment_path(month)
+            if not os.path.exists(path):
+                continue
+            tmp_path = path + '.tmp'
+            with gzip.open(path, 'rt', encoding='utf-8') as src, gzip.open(tmp_path, 'wt', encoding='utf-8') as dst:
+                for line in src:
+                    if line.strip() and json.loads(line).get('user_id') != user_id:
+                        dst.write(line)
+            os.replace(tmp_path, path)
+        self._write_index()
+
+
+class RetentionPolicy:
+    # retention_days より前に起床した記録を定期的にアーカイブへ移す。
+    # アーカイブへの書き込み（fsync）が終わってからストアから取り除くので、途中で止まっても記録は失われない
+
+    def __init__(self, store: SleepStore, archive: SleepArchive, retention_days: int, clock=time.time, io=None):
+        self.store = store
+        self.archive = archive
+        self.retention_days = max(MIN_RETENTION_DAYS, retention_days)
+        self.clock = clock
+        self.io = io
+
+    def cutoff_us(self) -> int:
+        return int(self.clock()) * 1_000_000 - self.retention_days * US_PER_DAY
+
+    def _passes(self, cutoff_us: int):
+        # USERS_PER_PASS 人ずつ、user_id -> 移す記録 を返す
+        user_ids = list(self.store.user_ids())
+        for i in range(0, len(user_ids), USERS_PER_PASS):
+            old = {}
+            for user_id in user_ids[i:i + USERS_PER_PASS]:
+                records = self.store.records_before(user_id, cutoff_us)
+                if records:
+                    old[user_id] = records
+            if old:
+                yield old
+
+    def _fold(self, old: dict, cutoff_us: int):
+        with self.store.batch():
+            for user_id, records in old.items():
+                # アーカイブに書いている間に古い記録が取り込まれていたら、そのユーザーは次回に回す
+                if len(self.store.records_before(user_id, cutoff_us)) == len(records):
+                    self.store.fold_records(user_id, cutoff_us)
+
+    def run_once(self) -> int:
+        # 移した記録の件数を返す
+        cutoff_us = self.cutoff_us()
+        moved = 0
+        for old in self._passes(cutoff_us):
+            moved += self.archive.append(_rows(old))
+            self._fold(old, cutoff_us)
+        if moved:
+            self.store.flush()
+        return moved
+
+    async def run_once_async(self) -> int:
+        # run_once() と同じ。アーカイブへの書き込み（gzip・fsync）は I/O スレッドで行い、ストアの変更はイベントループで行う
+        if self.io is None:
+            return self.run_once()
+        cutoff_us = self.cutoff_us()
+        moved = 0
+        for old in self._passes(cutoff_us):
+            moved += await self.io.run(self.archive.append, list(_rows(old)))
+            self._fold(old, cutoff_us)
+        if moved:
+            await self.store.flush_async()
+        return moved
+
+    async def run(self, interval: float = 24 * 3600):
+        while True:
+            try:
+                moved = await self.run_once_async()
+                if moved:
+                    print(f'{moved}件の古い睡眠記録をアーカイブに移しました。')
+            except Exception as e:
+                print(f'睡眠記録のアーカイブ中にエラーが発生しました: {e}')
+            await asyncio.sleep(interval)
+
+
+def _rows(old: dict):
+    return ((user_id, record) for user_id, records in old.items() for record in records)
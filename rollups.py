@@ -0,0 +1,185 @@
+import heapq
+from datetime import datetime
+from functools import lru_cache
+from typing import Optional
+
+from sleep_records import parse_iso
+from sleep_store import MAX_VALID_SLEEP_MINUTES, SleepStore
+
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+GRANULARITIES = (DAY, WEEK, MONTH)
+
+US_PER_DAY = 24 * 3600 * 1_000_000
+# 1970-01-01 は木曜日。週は月曜始まり
+_WEEK_SHIFT = 3
+_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+
+def week_of_day(day: int) -> int:
+    return (day + _WEEK_SHIFT) // 7
+
+
+@lru_cache(maxsize=4096)
+def month_of_day(day: int) -> int:
+    date = datetime.fromordinal(_EPOCH_ORDINAL + day)
+    return date.year * 12 + date.month - 1
+
+
+def day_of_month(month: int) -> int:
+    # その月の1日（ローカル日付の通し番号）
+    return datetime(month // 12, month % 12 + 1, 1).toordinal() - _EPOCH_ORDINAL
+
+
+class SleepRollups:
+    # ユーザーごとの睡眠時間を、ローカル日付（日・週・月）のバケットに集計しておく。
+    # バケット -> {user_id: 分} と user_id -> {バケット: 分} の両方を持ち、
+    # ランキングは1バケット分、期間の合計はバケット数分だけを見ればよい（記録の総数によらない）。
+    # 記録が追加されたとき（ストアの通知）に差分だけ足す。日付をまたぐ記録は実際の時間の割合で分ける。
+    # 集計は最初の問い合わせのときに作る（起動を遅くしないため）。作るまでの通知は無視してよい
+
+    def __init__(self, store: SleepStore, tz):
+        self.store = store
+        self.tz = tz
+        self.utc_offset = int(datetime.now(tz).utcoffset().total_seconds())
+        self._by_bucket = {granularity: {} for granularity in GRANULARITIES}
+        self._by_user = {granularity: {} for granularity in GRANULARITIES}
+        self._built = False
+        store.add_listener(self._on_store_change)
+
+    def load(self):
+        self._built = False
+
+    def _ensure_built(self):
+        if self._built:
+            return
+        for granularity in GRANULARITIES:
+            self._by_bucket[granularity] = {}
+            self._by_user[granularity] = {}
+        self._built = True
+        for user_id in list(self.store.user_ids()):
+            columns = self.store.get_record_columns(user_id)
+            for i in range(len(columns)):
+                if columns.raw(i) is not None:
+                    continue
+                self._add(user_id, columns.start_us[i], columns.end_us[i], columns.durations[i])
+
+    def _on_store_change(self, user_id, op, record):
+        if not self._built:
+            return
+        if op == 'clear':
+            self._remove_user(user_id)
+        elif op in ('wake', 'import') and record is not None:
+            try:
+                start_us, _ = parse_iso(record['sleep_start'])
+                end_us, _ = parse_iso(record['sleep_end'])
+            except (KeyError, TypeError, ValueError):
+                return
+            self._add(user_id, start_us, end_us, record['duration_minutes'])
+
+    def _local_day(self, epoch_us: int) -> int:
+        return (epoch_us + self.utc_offset * 1_000_000) // US_PER_DAY
+
+    def _split_days(self, start_us: int, end_us: int, duration_minutes: float):
+        # 記録を日ごとに分け、(日, 分) を返す。分は duration_minutes を実時間の割合で配分する
+        if end_us <= start_us:
+            return [(self._local_day(end_us), duration_minutes)]
+        offset_us = self.utc_offset * 1_000_000
+        local_start = start_us + offset_us
+        local_end = end_us + offset_us
+        span = local_end - local_start
+        parts = []
+        day = local_start // US_PER_DAY
+        cursor = local_start
+        while cursor < local_end:
+            boundary = min(local_end, (day + 1) * US_PER_DAY)
+            parts.append((day, duration_minutes * (boundary - cursor) / span))
+            cursor = boundary
+            day += 1
+        return parts
+
+    def _add(self, user_id: str, start_us: int, end_us: int, duration_minutes):
+        if duration_minutes >= MAX_VALID_SLEEP_MINUTES:
+            return
+        for day, minutes in self._split_days(start_us, end_us, duration_minutes):
+            self._bump(DAY, day, user_id, minutes)
+            self._bump(WEEK, week_of_day(day), user_id, minutes)
+            self._bump(MONTH, month_of_day(day), user_id, minutes)
+
+    def _bump(self, granularity: str, bucket: int, user_id: str, minutes: float):
+        users = self._by_bucket[granularity].setdefault(bucket, {})
+        users[user_id] = users.get(user_id, 0) + minutes
+        buckets = self._by_user[granularity].setdefault(user_id, {})
+        buckets[bucket] = buckets.get(bucket, 0) + minutes
+
+    def _remove_user(self, user_id: str):
+        for granularity in GRANULARITIES:
+            buckets = self._by_user[granularity].pop(user_id, None)
+            if not buckets:
+                continue
+            by_bucket = self._by_bucket[granularity]
+            for bucket in buckets:
+                users = by_bucket.get(bucket)
+                if users is None:
+                    continue
+                users.pop(user_id, None)
+                if not users:
+                    del by_bucket[bucket]
+
+    # ---- 問い合わせ ----
+
+    def bucket_of(self, granularity: str, when: Optional[datetime] = None) -> int:
+        when = when or datetime.now(self.tz)
+        day = self._local_day(int(when.timestamp()) * 1_000_000)
+        if granularity == DAY:
+            return day
+        if granularity == WEEK:
+            return week_of_day(day)
+        return month_of_day(day)
+
+    def bucket_start(self, granularity: str, bucket: int) -> datetime:
+        # バケットの始まり（ローカル時刻の0時）
+        if granularity == WEEK:
+            day = bucket * 7 - _WEEK_SHIFT
+        elif granularity == MONTH:
+            day = day_of_month(bucket)
+        else:
+            day = bucket
+        return datetime.fromtimestamp(day * 86400 - self.utc_offset, self.tz)
+
+    def user_total(self, user_id, granularity: str, first_bucket: int, last_bucket: int) -> float:
+        self._ensure_built()
+        buckets = self._by_user[granularity].get(str(user_id))
+        if not buckets:
+            return 0
+        if last_bucket - first_bucket + 1 > len(buckets):
+            return sum(minutes for bucket, minutes in buckets.items() if first_bucket <= bucket <= last_bucket)
+        return sum(buckets.get(bucket, 0) for bucket in range(first_bucket, last_bucket + 1))
+
+    def user_series(self, user_id, granularity: str, first_bucket: int, last_bucket: int) -> list:
+        self._ensure_built()
+        buckets = self._by_user[granularity].get(str(user_id), {})
+        return [(bucket, buckets.get(bucket, 0)) for bucket in range(first_bucket, last_bucket + 1)]
+
+    def totals(self, granularity: str, first_bucket: int, last_bucket: int, user_ids=None) -> dict:
+        # 期間内のユーザーごとの合計。user_ids を渡すとそのユーザーだけに絞る
+        self._ensure_built()
+        by_bucket = self._by_bucket[granularity]
+        allowed = None if user_ids is None else set(str(user_id) for user_id in user_ids)
+        totals: dict = {}
+        for bucket in range(first_bucket, last_bucket + 1):
+            users = by_bucket.get(bucket)
+            if not users:
+                continue
+            for user_id, minutes in users.items():
+                if allowed is None or user_id in allowed:
+                    totals[user_id] = totals.get(user_id, 0) + minutes
+        return totals
+
+    def top(self, granularity: str, first_bucket: int, last_bucket: Optional[int] = None, n: int = 10, user_ids=None) -> list:
+        # 期間内の合計睡眠時間の上位 n 人を [(user_id, 分), ...] で返す
+        if last_bucket is None:
+            last_bucket = first_bucket
+        totals = self.totals(granularity, first_bucket, last_bucket, user_ids)
+        return heapq.nlargest(n, totals.items(), key=lambda item: item[1])
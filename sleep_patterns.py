@@ -0,0 +1,188 @@
+import math
+from datetime import datetime
+from typing import Optional
+
+from analytics import MINUTES_PER_DAY, US_PER_DAY, US_PER_MINUTE, circular_from_sums
+from sleep_records import parse_iso
+from sleep_store import MAX_VALID_SLEEP_MINUTES, SleepStore
+
+# 自動就寝・自動起床の判断に使う、ユーザーごとの睡眠のパターン。
+# 「夜」（就寝時刻から12時間引いたローカル日付。月曜23時も火曜1時も月曜の夜）の曜日ごとに、
+# 就寝時刻・起床時刻の円周平均とばらつき、睡眠時間の平均と標準偏差を、合計値だけで持つ。
+# 記録が増えたとき（ストアの通知）に合計へ足すだけなので、プレゼンスのイベントごとの判断は O(1)。
+
+# モデルを使い始める記録数（それまでは以前の「平均睡眠時間 ±60分」の判断）
+MIN_SAMPLES = 5
+# 曜日ごとの値を使う記録数（足りなければ全曜日の値を使う）
+MIN_WEEKDAY_SAMPLES = 3
+# 許容する幅 = ばらつき × WINDOW_SPREADS を [MIN_WINDOW_MINUTES, MAX_WINDOW_MINUTES] に収めたもの
+WINDOW_SPREADS = 2.0
+MIN_WINDOW_MINUTES = 60
+MAX_WINDOW_MINUTES = 180
+# 以前の判断の幅（平均睡眠時間 ±60分）
+LEGACY_WINDOW_MINUTES = 60
+NIGHT_SHIFT_US = 12 * 60 * US_PER_MINUTE
+_SCALE = 2 * math.pi / MINUTES_PER_DAY
+# 全曜日をまとめた値の添字
+ALL_DAYS = 7
+
+
+def _window(spread: float) -> float:
+    return min(MAX_WINDOW_MINUTES, max(MIN_WINDOW_MINUTES, spread * WINDOW_SPREADS))
+
+
+def _distance(a: float, b: float) -> float:
+    # 時刻（0時からの分）どうしの、日付をまたいだ近い方の差
+    diff = abs(a - b) % MINUTES_PER_DAY
+    return min(diff, MINUTES_PER_DAY - diff)
+
+
+def night_of(local_us: int) -> int:
+    # その時刻が属する夜の曜日（月曜 = 0）。1970-01-01 は木曜日
+    return ((local_us - NIGHT_SHIFT_US) // US_PER_DAY + 3) % 7
+
+
+class _PatternCell:
+    # 1つの曜日（または全曜日）の合計値。平均やばらつきは使うときに1回だけ計算して覚えておく
+    __slots__ = ('count', 'bed_sin', 'bed_cos', 'wake_sin', 'wake_cos', 'duration_sum', 'duration_sq', '_derived')
+
+    def __init__(self):
+        self.count = 0
+        self.bed_sin = self.bed_cos = 0.0
+        self.wake_sin = self.wake_cos = 0.0
+        self.duration_sum = 0.0
+        self.duration_sq = 0.0
+        self._derived = None
+
+    def add(self, bed_minute: float, wake_minute: float, duration: float):
+        self.count += 1
+        self.bed_sin += math.sin(bed_minute * _SCALE)
+        self.bed_cos += math.cos(bed_minute * _SCALE)
+        self.wake_sin += math.sin(wake_minute * _SCALE)
+        self.wake_cos += math.cos(wake_minute * _SCALE)
+        self.duration_sum += duration
+        self.duration_sq += duration * duration
+        self._derived = None
+
+    def derived(self):
+        # (就寝の平均, 就寝の幅, 起床の平均, 起床の幅, 睡眠時間の平均, 睡眠時間の幅)
+        if self._derived is None:
+            bed_mean, bed_spread = circular_from_sums(self.bed_sin, self.bed_cos, self.count)
+            wake_mean, wake_spread = circular_from_sums(self.wake_sin, self.wake_cos, self.count)
+            duration_mean = self.duration_sum / self.count
+            duration_std = math.sqrt(max(0.0, self.duration_sq / self.count - duration_mean * duration_mean))
+            self._derived = (
+                bed_mean, _window(bed_spread), wake_mean, _window(wake_spread), duration_mean, _window(duration_std)
+            )
+        return self._derived
+
+
+class UserSleepPattern:
+    # 1ユーザー分。時刻はすべてローカル時刻のエポックマイクロ秒（UTC + オフセット）で受け取る
+    __slots__ = ('cells',)
+
+    def __init__(self):
+        self.cells = [_PatternCell() for _ in range(ALL_DAYS + 1)]
+
+    @property
+    def count(self) -> int:
+        return self.cells[ALL_DAYS].count
+
+    def add(self, local_start_us: int, local_end_us: int, duration_minutes):
+        if duration_minutes >= MAX_VALID_SLEEP_MINUTES or local_end_us <= local_start_us:
+            return
+        bed = (local_start_us % US_PER_DAY) / US_PER_MINUTE
+        wake = (local_end_us % US_PER_DAY) / US_PER_MINUTE
+        self.cells[night_of(local_start_us)].add(bed, wake, duration_minutes)
+        self.cells[ALL_DAYS].add(bed, wake, duration_minutes)
+
+    def _cell(self, night: int) -> Optional[_PatternCell]:
+        if self.cells[ALL_DAYS].count < MIN_SAMPLES:
+            return None
+        cell = self.cells[night]
+        return cell if cell.count >= MIN_WEEKDAY_SAMPLES else self.cells[ALL_DAYS]
+
+    def should_sleep(self, local_us: int) -> Optional[bool]:
+        # その時刻にオフラインになったら寝たとみなすか。記録が足りなければ None
+        cell = self._cell(night_of(local_us))
+        if cell is None:
+            return None
+        bed_mean, bed_window = cell.derived()[:2]
+        return _distance((local_us % US_PER_DAY) / US_PER_MINUTE, bed_mean) <= bed_window
+
+    def should_wake(self, local_start_us: int, local_us: int) -> Optional[bool]:
+        # local_start_us に寝たユーザーが local_us にオンラインになったら起きたとみなすか。記録が足りなければ None
+        cell = self._cell(night_of(local_start_us))
+        if cell is None:
+            return None
+        _, _, wake_mean, wake_window, duration_mean, duration_window = cell.derived()
+        duration = (local_us - local_start_us) / US_PER_MINUTE
+        if duration < duration_mean - duration_window:
+            # 夜中にスマホを見ただけなど
+            return False
+        if duration > duration_mean + duration_window:
+            # いつもより長く寝ている。オンラインになったなら起きている
+            return True
+        return _distance((local_us % US_PER_DAY) / US_PER_MINUTE, wake_mean) <= wake_window
+
+
+class SleepPatternModel:
+    # ストアの記録から作った UserSleepPattern のキャッシュ。ユーザーごとに最初に判断するときに記録から作り、
+    # その後は記録が追加されたとき（ストアの通知）に1件ずつ足す。まだ作っていないユーザーの通知は無視してよい
+
+    def __init__(self, store: SleepStore, tz):
+        self.store = store
+        self.tz = tz
+        self.utc_offset = int(datetime.now(tz).utcoffset().total_seconds())
+        self._patterns: dict = {}
+        store.add_listener(self._on_store_change)
+
+    def load(self):
+        self._patterns = {}
+
+    def _on_store_change(self, user_id, op, record):
+        if op == 'clear':
+            self._patterns.pop(user_id, None)
+            return
+        pattern = self._patterns.get(user_id)
+        if pattern is None or op not in ('wake', 'import') or record is None:
+            return
+        try:
+            start_us, _ = parse_iso(record['sleep_start'])
+            end_us, _ = parse_iso(record['sleep_end'])
+        except (KeyError, TypeError, ValueError):
+            return
+        offset_us = self.utc_offset * 1_000_000
+        pattern.add(start_us + offset_us, end_us + offset_us, record['duration_minutes'])
+
+    def pattern(self, user_id) -> UserSleepPattern:
+        user_id = str(user_id)
+        pattern = self._patterns.get(user_id)
+        if pattern is None:
+            pattern = self._patterns[user_id] = UserSleepPattern()
+            columns = self.store.get_record_columns(user_id)
+            offset_us = self.utc_offset * 1_000_000
+            for i in range(len(columns)):
+                if columns.raw(i) is None:
+                    pattern.add(columns.start_us[i] + offset_us, columns.end_us[i] + offset_us, columns.durations[i])
+        return pattern
+
+    def _local_us(self, when: datetime) -> int:
+        return int(when.timestamp() * 1_000_000) + self.utc_offset * 1_000_000
+
+    def should_sleep(self, user_id, when: datetime) -> bool:
+        decision = self.pattern(user_id).should_sleep(self._local_us(when))
+        # 記録が少ないうちは以前と同じく、オフラインになったら寝たとみなす
+        return True if decision is None else decision
+
+    def should_wake(self, user_id, sleep_start: datetime, now: datetime) -> bool:
+        decision = self.pattern(user_id).should_wake(self._local_us(sleep_start), self._local_us(now))
+        if decision is not None:
+            return decision
+        # 記録が少ないうちは以前と同じく、平均睡眠時間 ±60分なら起きたとみなす
+        summary = self.store.get_sleep_summary(user_id)
+        if not summary['count']:
+            return False
+        average = summary['total_minutes'] / summary['count']
+        duration = (now - sleep_start).total_seconds() / 60
+        return average > 0 and average - LEGACY_WINDOW_MINUTES <= duration <= average + LEGACY_WINDOW_MINUTES
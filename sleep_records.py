@@ -0,0 +1,296 @@
+import json
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+# 記録を1件ずつ dict + ISO 文字列で持つ代わりに、ユーザーごとに列 (array) で持つ。
+# 時刻はエポックからのマイクロ秒と UTC オフセット（秒）に分けて保存し、
+# ISO 文字列は JSON への書き出しと表示のときだけ作る（元の文字列をそのまま復元できる）。
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_NAIVE_EPOCH = datetime(1970, 1, 1)
+_ONE_US = timedelta(microseconds=1)
+# タイムゾーンなしの ISO 文字列を表すオフセット
+NAIVE_OFFSET = 1 << 30
+
+_timezones: dict = {}
+_offset_suffixes: dict = {}
+
+
+def parse_iso(value: str):
+    # ISO 8601 文字列を (エポックマイクロ秒, オフセット秒) にする
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        return (dt - _NAIVE_EPOCH) // _ONE_US, NAIVE_OFFSET
+    return (dt - EPOCH) // _ONE_US, int(dt.utcoffset().total_seconds())
+
+
+def to_datetime(epoch_us: int, offset: int) -> datetime:
+    if offset == NAIVE_OFFSET:
+        return _NAIVE_EPOCH + timedelta(microseconds=epoch_us)
+    tz = _timezones.get(offset)
+    if tz is None:
+        tz = _timezones[offset] = timezone(timedelta(seconds=offset))
+    return (EPOCH + timedelta(microseconds=epoch_us)).astimezone(tz)
+
+
+def format_iso(epoch_us: int, offset: int) -> str:
+    # to_datetime(...).isoformat() と同じ。ローカル時刻を作ってオフセットの文字列を付け足す
+    if offset == NAIVE_OFFSET:
+        return (_NAIVE_EPOCH + timedelta(microseconds=epoch_us)).isoformat()
+    suffix = _offset_suffixes.get(offset)
+    if suffix is None:
+        tz = timezone(timedelta(seconds=offset))
+        suffix = _offset_suffixes[offset] = datetime(2000, 1, 1, tzinfo=tz).isoformat()[19:]
+    return (_NAIVE_EPOCH + timedelta(microseconds=epoch_us + offset * 1_000_000)).isoformat() + suffix
+
+
+class OpenSession:
+    # 進行中の睡眠（sleep_start だけがある状態）
+    __slots__ = ('start_us', 'start_offset')
+
+    def __init__(self, start_us: int, start_offset: int):
+        self.start_us = start_us
+        self.start_offset = start_offset
+
+    @classmethod
+    def from_iso(cls, value: str) -> 'OpenSession':
+        return cls(*parse_iso(value))
+
+    @property
+    def start_ts(self) -> float:
+        return self.start_us / 1e6
+
+    def isoformat(self) -> str:
+        return format_iso(self.start_us, self.start_offset)
+
+
+class SleepRecords:
+    # 1ユーザー分の sleep_records。列ごとの array で持つ。
+    # 解析できない日時の記録は元の dict を _raw に残し、列には 0 を入れる。
+    __slots__ = ('start_us', 'start_offset', 'end_us', 'end_offset', 'durations', '_raw')
+
+    def __init__(self):
+        self.start_us = array('q')
+        self.start_offset = array('i')
+        self.end_us = array('q')
+        self.end_offset = array('i')
+        self.durations = array('q')
+        self._raw: Optional[dict] = None
+
+    @classmethod
+    def from_dicts(cls, records) -> 'SleepRecords':
+        columns = cls()
+        for record in records:
+            columns.append_dict(record)
+        return columns
+
+    def __len__(self):
+        return len(self.durations)
+
+    def append(self, start_us, start_offset, end_us, end_offset, duration_minutes):
+        self.start_us.append(start_us)
+        self.start_offset.append(start_offset)
+        self.end_us.append(end_us)
+        self.end_offset.append(end_offset)
+        self.durations.append(duration_minutes)
+
+    def append_dict(self, record: dict):
+        duration = record.get('duration_minutes', 0)
+        try:
+            if type(duration) is not int or len(record) != 3:
+                raise ValueError(duration)
+            start_us, start_offset = parse_iso(record['sleep_start'])
+            end_us, end_offset = parse_iso(record['sleep_end'])
+        except (KeyError, TypeError, ValueError):
+            if self._raw is None:
+                self._raw = {}
+            self._raw[len(self)] = record
+            self.append(0, 0, 0, 0, int(duration) if isinstance(duration, (int, float)) else 0)
+            return
+        self.append(start_us, start_offset, end_us, end_offset, duration)
+
+    def raw(self, index: int) -> Optional[dict]:
+        # 列に入らなかった記録なら元の dict を返す
+        if self._raw is None:
+            return None
+        return self._raw.get(index)
+
+    def __getitem__(self, index: int) -> dict:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        if self._raw is not None and index in self._raw:
+            return self._raw[index]
+        return {
+            'sleep_start': format_iso(self.start_us[index], self.start_offset[index]),
+            'sleep_end': format_iso(self.end_us[index], self.end_offset[index]),
+            'duration_minutes': self.durations[index]
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def extend(self, other: 'SleepRecords'):
+        base = len(self)
+        self.start_us.extend(other.start_us)
+        self.start_offset.extend(other.start_offset)
+        self.end_us.extend(other.end_us)
+        self.end_offset.extend(other.end_offset)
+        self.durations.extend(other.durations)
+        if other._raw:
+            if self._raw is None:
+                self._raw = {}
+            for index, record in other._raw.items():
+                self._raw[base + index] = record
+
+    def copy(self) -> 'SleepRecords':
+        columns = SleepRecords()
+        columns.extend(self)
+        return columns
+
+    def sorted_by_start(self) -> 'SleepRecords':
+        # 就寝時刻の順に並べたもの（既に並んでいれば self）。日時を解析できなかった記録は先頭に寄せる
+        keys = [(self.raw(i) is None, self.start_us[i]) for i in range(len(self))]
+        if all(keys[i] <= keys[i + 1] for i in range(len(keys) - 1)):
+            return self
+        columns = SleepRecords()
+        for i in sorted(range(len(self)), key=keys.__getitem__):
+            raw = self.raw(i)
+            if raw is not None:
+                columns.append_dict(raw)
+            else:
+                columns.append(self.start_us[i], self.start_offset[i], self.end_us[i], self.end_offset[i], self.durations[i])
+        return columns
+
+    def split_before(self, cutoff_us: int, keep_index: Optional[int] = None):
+        # 起床時刻が cutoff_us より前の記録を取り出し、(取り出した記録の dict のリスト, 残りの SleepRecords) を返す。
+        # keep_index の記録と、日時を解析できなかった記録は残す
+        old = []
+        rest = SleepRecords()
+        for i in range(len(self)):
+            raw = self.raw(i)
+            if raw is None and i != keep_index and self.end_us[i] < cutoff_us:
+                old.append(self[i])
+            elif raw is not None:
+                rest.append_dict(raw)
+            else:
+                rest.append(self.start_us[i], self.start_offset[i], self.end_us[i], self.end_offset[i], self.durations[i])
+        return old, rest
+
+    def to_dicts(self) -> list:
+        return list(self)
+
+
+class UserSleepData:
+    # sleep_data.json の1ユーザー分。記録は SleepRecords、進行中の睡眠は OpenSession で持つ
+    __slots__ = ('is_sleeping', 'session', 'sleep_end', 'records', 'archived', 'extra')
+
+    def __init__(self):
+        self.is_sleeping = False
+        self.session: Optional[OpenSession] = None
+        self.sleep_end: Optional[str] = None
+        self.records = SleepRecords()
+        # アーカイブに移した記録の集計 {'count', 'total_minutes'}（平均の計算に含める）
+        self.archived: Optional[dict] = None
+        # 知らないキーや解析できない値は書き出し時にそのまま戻す
+        self.extra: Optional[dict] = None
+
+    @classmethod
+    def from_json(cls, user_data: dict) -> 'UserSleepData':
+        user = cls()
+        for key, value in user_data.items():
+            if key == 'sleep_records':
+                user.records = SleepRecords.from_dicts(value)
+            elif key == 'is_sleeping':
+                user.is_sleeping = bool(value)
+            elif key == 'sleep_end':
+                user.sleep_end = value
+            elif key == 'archived_summary':
+                user.archived = value
+            elif key == 'sleep_start':
+                try:
+                    user.session = OpenSession.from_iso(value)
+                except (TypeError, ValueError):
+                    user._set_extra(key, value)
+            else:
+                user._set_extra(key, value)
+        return user
+
+    def copy(self) -> 'UserSleepData':
+        user = UserSleepData()
+        user.is_sleeping = self.is_sleeping
+        user.session = self.session
+        user.sleep_end = self.sleep_end
+        user.records = self.records.copy()
+        user.archived = self.archived
+        user.extra = dict(self.extra) if self.extra is not None else None
+        return user
+
+    def _set_extra(self, key, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def sleep_start_iso(self) -> Optional[str]:
+        if self.session is not None:
+            return self.session.isoformat()
+        if self.extra is not None:
+            return self.extra.get('sleep_start')
+        return None
+
+    def to_state(self) -> dict:
+        state = {'is_sleeping': self.is_sleeping}
+        if self.extra is not None:
+            state.update(self.extra)
+        sleep_start = self.sleep_start_iso()
+        if sleep_start is not None:
+            state['sleep_start'] = sleep_start
+        if self.sleep_end is not None:
+            state['sleep_end'] = self.sleep_end
+        return state
+
+    def to_json(self) -> dict:
+        user_data = {'sleep_records': self.records.to_dicts()}
+        user_data.update(self.to_state())
+        if self.archived is not None:
+            user_data['archived_summary'] = self.archived
+        return user_data
+
+    def dump_json(self, indent: str = '') -> str:
+        # json.dumps(self.to_json(), ensure_ascii=False, indent=2) と同じ文字列を、記録の dict を作らずに組み立てる。
+        # indent は2行目以降の先頭に付ける（入れ子にして書き出すとき用）
+        inner = indent + '  '
+        item = inner + '  '
+        field = item + '  '
+        records = self.records
+        if len(records):
+            parts = []
+            for i in range(len(records)):
+                raw = records.raw(i)
+                if raw is not None:
+                    parts.append(item + _dumps_indented(raw, item))
+                    continue
+                parts.append(
+                    f'{item}{{\n'
+                    f'{field}"sleep_start": "{format_iso(records.start_us[i], records.start_offset[i])}",\n'
+                    f'{field}"sleep_end": "{format_iso(records.end_us[i], records.end_offset[i])}",\n'
+                    f'{field}"duration_minutes": {records.durations[i]}\n'
+                    f'{item}}}'
+                )
+            records_text = '[\n' + ',\n'.join(parts) + '\n' + inner + ']'
+        else:
+            records_text = '[]'
+        lines = [f'{inner}"sleep_records": {records_text}']
+        items = list(self.to_state().items())
+        if self.archived is not None:
+            items.append(('archived_summary', self.archived))
+        for key, value in items:
+            lines.append(f'{inner}{json.dumps(key, ensure_ascii=False)}: {_dumps_indented(value, inner)}')
+        return '{\n' + ',\n'.join(lines) + '\n' + indent + '}'
+
+
+def _dumps_indented(value, indent: str) -> str:
+    return json.dumps(value, ensure_ascii=False, indent=2).replace('\n', '\n' + indent)
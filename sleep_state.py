@@ -0,0 +1,108 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sleep_store import SleepStore
+
+SLEEPING = 'sleeping'
+AWAKE = 'awake'
+NO_DATA = 'no_data'
+
+
+class Transition:
+    # 状態遷移の結果。ok が False のときは reason に理由が入る
+    __slots__ = ('ok', 'reason', 'record', 'sleep_start', 'duration')
+
+    def __init__(self, ok: bool, reason: Optional[str] = None, record: Optional[dict] = None,
+                 sleep_start: Optional[datetime] = None, duration: Optional[timedelta] = None):
+        self.ok = ok
+        self.reason = reason
+        self.record = record
+        self.sleep_start = sleep_start
+        self.duration = duration
+
+
+class _UserLock:
+    __slots__ = ('lock', 'users')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class SleepStateMachine:
+    # ユーザーごとの睡眠/起床の状態遷移。確認と更新は1回の同期呼び出しで行うので途中に await が挟まらない。
+    # locked(user_id) で同じユーザーのハンドラを直列化し、別のユーザーは並行に動かす。
+
+    def __init__(self, store: SleepStore, tz):
+        self.store = store
+        self.tz = tz
+        self._locks: dict = {}
+
+    def locked(self, user_id):
+        return _LockContext(self, str(user_id))
+
+    def is_locked(self, user_id) -> bool:
+        entry = self._locks.get(str(user_id))
+        return entry is not None and entry.lock.locked()
+
+    def state_of(self, user_id) -> str:
+        state = self.store.get_state(user_id)
+        if state is None:
+            return NO_DATA
+        return SLEEPING if state.get('is_sleeping', False) else AWAKE
+
+    def sleep(self, user_id, now: datetime) -> Transition:
+        if self.state_of(user_id) == SLEEPING:
+            return Transition(False, 'already_sleeping')
+        self.store.start_sleep(user_id, now.isoformat())
+        return Transition(True, sleep_start=now)
+
+    def wake(self, user_id, now: datetime, mark_wake: bool = True) -> Transition:
+        state = self.store.get_state(user_id)
+        if state is None or not state.get('is_sleeping', False):
+            return Transition(False, 'not_sleeping')
+
+        sleep_start = None
+        duration = timedelta(0)
+        if 'sleep_start' in state:
+            sleep_start = datetime.fromisoformat(state['sleep_start']).astimezone(self.tz)
+            duration = now - sleep_start
+        record = self.store.end_sleep(user_id, now.isoformat(), int(duration.total_seconds() / 60), mark_wake=mark_wake)
+        return Transition(True, record=record, sleep_start=sleep_start, duration=duration)
+
+    def clear(self, user_id) -> Transition:
+        if not self.store.clear_user(user_id):
+            return Transition(False, 'no_data')
+        return Transition(True)
+
+
+class _LockContext:
+    def __init__(self, machine: SleepStateMachine, user_id: str):
+        self.machine = machine
+        self.user_id = user_id
+        self.entry = None
+
+    async def __aenter__(self):
+        locks = self.machine._locks
+        self.entry = locks.get(self.user_id)
+        if self.entry is None:
+            self.entry = locks[self.user_id] = _UserLock()
+        self.entry.users += 1
+        try:
+            await self.entry.lock.acquire()
+        except BaseException:
+            self._release_entry()
+            raise
+        return self.machine
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.entry.lock.release()
+        self._release_entry()
+        return False
+
+    def _release_entry(self):
+        # 待っている人がいなくなったロックは捨て、辞書が増え続けないようにする
+        self.entry.users -= 1
+        if self.entry.users == 0:
+            self.machine._locks.pop(self.user_id, None)
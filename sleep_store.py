@@ -0,0 +1,718 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+from typing import Optional
+
+from sleep_records import OpenSession, SleepRecords, UserSleepData, parse_iso
+
+# 平均睡眠時間の計算から除外する異常な記録の閾値
+MAX_VALID_SLEEP_MINUTES = 200 * 60
+# ジャーナルのチェックポイントの行（イベントは 'op' を先頭のキーにして書く）
+CHECKPOINT_PREFIX = b'{"op":"checkpoint"'
+
+
+class SleepAggregate:
+    # ユーザーごとの有効な記録の件数・合計・最新の記録。記録の追加・削除のたびに O(1) で更新する
+    __slots__ = ('count', 'total_minutes', 'latest_record')
+
+    def __init__(self):
+        self.count = 0
+        self.total_minutes = 0
+        self.latest_record = None
+
+    @classmethod
+    def from_records(cls, records) -> 'SleepAggregate':
+        aggregate = cls()
+        for record in records:
+            aggregate.add(record)
+        return aggregate
+
+    @staticmethod
+    def is_valid(record: dict) -> bool:
+        return record.get('duration_minutes', 0) < MAX_VALID_SLEEP_MINUTES
+
+    def add(self, record: dict):
+        if not self.is_valid(record):
+            return
+        self.count += 1
+        self.total_minutes += record['duration_minutes']
+        self.latest_record = record
+
+    @property
+    def average_minutes(self) -> float:
+        return self.total_minutes / self.count if self.count else 0
+
+    def as_summary(self) -> dict:
+        return {
+            'count': self.count,
+            'total_minutes': self.total_minutes,
+            'latest_record': self.latest_record
+        }
+
+
+def build_sleep_info(state: Optional[dict], summary: dict) -> dict:
+    # get_user_latest_sleep_info と同じ形の dict を、副作用なしで状態と集計から組み立てる
+    user_data = state or {}
+    is_sleeping = user_data.get('is_sleeping', False)
+    last_sleep_start_str = None
+    last_sleep_end_str = None
+    average_sleep_minutes = 0
+
+    if summary['count']:
+        average_sleep_minutes = summary['total_minutes'] / summary['count']
+        latest_record = summary['latest_record']
+        last_sleep_start_str = latest_record.get('sleep_start')
+        last_sleep_end_str = latest_record.get('sleep_end')
+
+    if is_sleeping and 'sleep_start' in user_data:
+        last_sleep_start_str = user_data['sleep_start']
+
+    return {
+        'is_sleeping': is_sleeping,
+        'last_sleep_start': last_sleep_start_str,
+        'last_sleep_end': last_sleep_end_str,
+        'average_sleep_minutes': average_sleep_minutes,
+        'raw_user_data': user_data
+    }
+
+
+class SleepStore:
+    # ストレージの共通インターフェース。ハンドラはこのメソッドだけを使う。
+    # 返す dict はストア内部のものの場合があるので、呼び出し側で変更しないこと
+
+    def __init__(self):
+        self._listeners = []
+        # 古い記録の移動先（retention.SleepArchive）。None ならアーカイブを使わない
+        self.archive = None
+
+    def add_listener(self, listener):
+        # listener(user_id, op, record) をユーザーの状態が変わるたびに呼ぶ。
+        # op は 'sleep' / 'wake' / 'clear_wake' / 'clear' / 'import' / 'fold'、
+        # record は wake で追加された記録（import では追加された記録ごとに1回ずつ呼ぶ）。
+        # fold は古い記録をアーカイブに移したとき（集計は変わらない）
+        self._listeners.append(listener)
+
+    def _notify(self, user_id: str, op: str, record: Optional[dict] = None):
+        for listener in self._listeners:
+            listener(user_id, op, record)
+
+    def load(self):
+        raise NotImplementedError
+
+    def flush(self):
+        raise NotImplementedError
+
+    async def flush_async(self):
+        # イベントループから保存するとき用。既定では flush() をそのまま呼ぶ
+        self.flush()
+
+    def close(self):
+        raise NotImplementedError
+
+    def __contains__(self, user_id) -> bool:
+        raise NotImplementedError
+
+    def user_ids(self):
+        raise NotImplementedError
+
+    def get_state(self, user_id) -> Optional[dict]:
+        # is_sleeping / sleep_start / sleep_end を含む dict。記録のないユーザーは None
+        raise NotImplementedError
+
+    def get_sleep_summary(self, user_id) -> dict:
+        # 異常値を除いた有効な記録の件数・合計分数・最新の記録
+        raise NotImplementedError
+
+    def get_records(self, user_id) -> list:
+        raise NotImplementedError
+
+    def get_record_columns(self, user_id) -> SleepRecords:
+        # 記録を列形式で返す（集計・分析用）
+        return SleepRecords.from_dicts(self.get_records(user_id))
+
+    def get_history_columns(self, user_id, archived: Optional[list] = None) -> SleepRecords:
+        # アーカイブに移した記録も含めたすべての記録（古い順）。
+        # archived に I/O スレッドで先に読んでおいたアーカイブの記録を渡すと、ここではファイルを読まない
+        if self.archive is None:
+            return self.get_record_columns(user_id)
+        records = self.get_record_columns(user_id)
+        if archived is None:
+            archived = self.archive.read_user(user_id)
+        if not archived:
+            return records
+        # アーカイブへの移動の途中で止まった場合、同じ記録が両方にあることがある
+        history = SleepRecords.from_dicts(archived)
+        hot_starts = set(records.start_us)
+        if any(start in hot_starts for start in history.start_us):
+            history = SleepRecords.from_dicts(
+                record for record, start in zip(archived, history.start_us) if start not in hot_starts
+            )
+        history.extend(records)
+        return history
+
+    def get_status_snapshot(self, user_ids) -> dict:
+        # ステータス表示用に複数ユーザーの (状態, 集計) をまとめて取得する。記録のないユーザーは含まない
+        snapshot = {}
+        for user_id in user_ids:
+            state = self.get_state(user_id)
+            if state is not None:
+                snapshot[str(user_id)] = (state, self.get_sleep_summary(user_id))
+        return snapshot
+
+    def is_sleeping(self, user_id) -> bool:
+        state = self.get_state(user_id)
+        return bool(state and state.get('is_sleeping', False))
+
+    def start_sleep(self, user_id, sleep_start: str):
+        raise NotImplementedError
+
+    def end_sleep(self, user_id, sleep_end: str, duration_minutes: int, mark_wake: bool = True) -> Optional[dict]:
+        # 睡眠中なら記録を追加して起床状態にする。mark_wake=False は自動起床用（sleep_end を残さない）
+        raise NotImplementedError
+
+    def clear_wake(self, user_id):
+        raise NotImplementedError
+
+    def clear_user(self, user_id) -> bool:
+        raise NotImplementedError
+
+    def add_records(self, user_id, records: list):
+        # 過去の記録をまとめて追加する（インポート用）。睡眠中かどうかなどの状態は変えない。
+        # 既存の記録より古い記録を追加しても、最新の記録は起床時刻が最も後のもののまま
+        raise NotImplementedError
+
+    def records_before(self, user_id, cutoff_us: int) -> list:
+        # fold_records で取り除かれる記録（起床時刻が cutoff_us より前。最新の有効な記録は除く）
+        raise NotImplementedError
+
+    def fold_records(self, user_id, cutoff_us: int):
+        # records_before の記録をストアから取り除く。件数・合計は集計に残す
+        raise NotImplementedError
+
+    def batch(self):
+        # with store.batch(): の中の複数の更新を1回の書き込みにまとめる
+        return contextlib.nullcontext()
+
+
+class JsonSleepStore(SleepStore):
+    # sleep_data.json を起動時に一度だけ読み込み、以降はメモリ上で読み書きする。
+    # 変更は1件ずつ追記専用のジャーナル (<path>.journal) に書き、定期的にスナップショット
+    # (sleep_data.json 本体) へ圧縮する。スナップショットは一時ファイル + rename で差し替えるため、
+    # 書き込み途中でクラッシュしても既存のデータが壊れることはない。
+    #
+    # ジャーナルの先頭行には元になったスナップショットのハッシュを記録しておき、
+    # 起動時にハッシュが一致する場合だけ再生する（圧縮直後のクラッシュで二重適用しないため）。
+    #
+    # メモリ上では各ユーザーを UserSleepData（記録は列形式）で持ち、ISO 文字列は書き出し時に作る。
+    #
+    # io（IOExecutor）を渡すと、定期的な保存（fsync・スナップショットの書き出し）を I/O スレッドで行う。
+    # 書き出し中に変更されるユーザーはコピーしてから変更する（コピーオンライト）ので、スナップショットは
+    # 書き出しを始めた時点の内容になる。それ以降のイベントはジャーナルのチェックポイントで区別する。
+
+    def __init__(self, path: str, flush_delay: float = 5.0, compact_every: int = 1000, io=None):
+        super().__init__()
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.flush_delay = flush_delay
+        self.compact_every = compact_every
+        self.io = io
+        self._users: dict = {}
+        self._aggregates: dict = {}
+        # I/O スレッドで書き出し中のスナップショット（user_id -> UserSleepData）
+        self._frozen: Optional[dict] = None
+        self._journal = None
+        self._journal_events = 0
+        self._journal_size = 0
+        self._batch_depth = 0
+        # ディスクから読んだ・ディスクに書いたバイト数（ジャーナル + スナップショット）
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._dirty = False
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def load(self, read_only: bool = False):
+        # read_only なら読むだけで、ジャーナルの取り込み（スナップショットの書き直し）もジャーナルを開くこともしない
+        # （他のプロセスと共有しているファイルから引き継ぐとき用。この場合は更新できない）
+        snapshot_hash = None
+        self._users = {}
+        self._aggregates = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+            self.bytes_read += len(raw)
+            snapshot_hash = hashlib.sha1(raw).hexdigest()
+            data = json.loads(raw.decode('utf-8')) if raw.strip() else {}
+            del raw
+            for user_id, user_data in data.items():
+                user = self._users[user_id] = UserSleepData.from_json(user_data)
+                aggregate = self._aggregates[user_id] = SleepAggregate.from_records(user_data.get('sleep_records', []))
+                if user.archived:
+                    aggregate.count += user.archived.get('count', 0)
+                    aggregate.total_minutes += user.archived.get('total_minutes', 0)
+            del data
+
+        replayed = self._replay_journal(snapshot_hash)
+        if read_only:
+            return
+        if replayed or self._journal_base() != snapshot_hash or snapshot_hash is None:
+            # 再生したイベントをスナップショットに取り込み、空のジャーナルから始める
+            self.compact()
+        else:
+            self._open_journal()
+        self._dirty = False
+
+    def _journal_base(self) -> Optional[str]:
+        if not os.path.exists(self.journal_path):
+            return None
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            try:
+                return json.loads(f.readline()).get('base')
+            except ValueError:
+                return None
+
+    def _replay_journal(self, snapshot_hash: Optional[str]) -> int:
+        if not os.path.exists(self.journal_path):
+            return 0
+        replayed = 0
+        self.bytes_read += os.path.getsize(self.journal_path)
+        with open(self.journal_path, 'rb') as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                return 0
+            if header.get('base') != snapshot_hash:
+                # スナップショットに取り込み済みのジャーナル。
+                # I/O スレッドでの書き出しの途中で止まった場合は、チェックポイント以降のイベントだけを再生する
+                offset = _find_checkpoint(f, snapshot_hash)
+                if offset is None:
+                    return 0
+                f.seek(offset)
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # 書きかけの末尾行は捨てる
+                    print(f'ジャーナルの不完全な行を無視しました: {self.journal_path}')
+                    break
+                if event.get('op') == 'checkpoint':
+                    continue
+                self._apply(event)
+                replayed += 1
+        return replayed
+
+    # ---- 読み取り ----
+
+    def __contains__(self, user_id) -> bool:
+        return str(user_id) in self._users
+
+    def user_ids(self):
+        return self._users.keys()
+
+    def get_state(self, user_id) -> Optional[dict]:
+        user = self._users.get(str(user_id))
+        if user is None:
+            return None
+        return user.to_state()
+
+    def get_sleep_summary(self, user_id) -> dict:
+        aggregate = self._aggregates.get(str(user_id))
+        if aggregate is None:
+            return SleepAggregate().as_summary()
+        return aggregate.as_summary()
+
+    def get_records(self, user_id) -> list:
+        user = self._users.get(str(user_id))
+        if user is None:
+            return []
+        return user.records.to_dicts()
+
+    def get_record_columns(self, user_id) -> SleepRecords:
+        user = self._users.get(str(user_id))
+        if user is None:
+            return SleepRecords()
+        return user.records
+
+    def get_user_data(self, user_id) -> Optional[dict]:
+        # sleep_data.json に書き出す形の1ユーザー分（移行用）
+        user = self._users.get(str(user_id))
+        if user is None:
+            return None
+        return user.to_json()
+
+    # ---- 更新 ----
+
+    def start_sleep(self, user_id, sleep_start: str):
+        self._commit({'op': 'sleep', 'user_id': str(user_id), 'sleep_start': sleep_start})
+
+    def end_sleep(self, user_id, sleep_end: str, duration_minutes: int, mark_wake: bool = True) -> Optional[dict]:
+        return self._commit({
+            'op': 'wake',
+            'user_id': str(user_id),
+            'sleep_end': sleep_end,
+            'duration_minutes': duration_minutes,
+            'mark_wake': mark_wake
+        })
+
+    def clear_wake(self, user_id):
+        user = self._users.get(str(user_id))
+        if user is not None and user.sleep_end is not None:
+            self._commit({'op': 'clear_wake', 'user_id': str(user_id)})
+
+    def clear_user(self, user_id) -> bool:
+        if str(user_id) not in self._users:
+            return False
+        self._commit({'op': 'clear', 'user_id': str(user_id)})
+        return True
+
+    def add_records(self, user_id, records: list):
+        if not records:
+            return
+        event = {'op': 'import', 'user_id': str(user_id), 'records': records}
+        self._apply(event)
+        self._append(event)
+        for record in records:
+            self._notify(event['user_id'], 'import', record)
+
+    def records_before(self, user_id, cutoff_us: int) -> list:
+        user = self._users.get(str(user_id))
+        if user is None:
+            return []
+        return user.records.split_before(cutoff_us, _latest_valid_index(user.records))[0]
+
+    def fold_records(self, user_id, cutoff_us: int):
+        user = self._users.get(str(user_id))
+        if user is None or not len(user.records):
+            return
+        self._commit({'op': 'fold', 'user_id': str(user_id), 'before': cutoff_us})
+
+    def _commit(self, event: dict):
+        result = self._apply(event)
+        self._append(event)
+        self._notify(event['user_id'], event['op'], result)
+        return result
+
+    def _apply(self, event: dict):
+        op = event['op']
+        user_id = event['user_id']
+
+        if op == 'clear':
+            self._users.pop(user_id, None)
+            self._aggregates.pop(user_id, None)
+            return None
+
+        user = self._users.get(user_id)
+        if user is None:
+            if op == 'clear_wake':
+                return None
+            user = self._users[user_id] = UserSleepData()
+            self._aggregates[user_id] = SleepAggregate()
+        elif self._frozen is not None and self._frozen.get(user_id) is user:
+            # 書き出し中のスナップショットにあるユーザーは、コピーしてから変更する
+            user = self._users[user_id] = user.copy()
+
+        if op == 'sleep':
+            user.is_sleeping = True
+            try:
+                user.session = OpenSession.from_iso(event['sleep_start'])
+            except (TypeError, ValueError):
+                user.session = None
+                user._set_extra('sleep_start', event['sleep_start'])
+        elif op == 'wake':
+            record = None
+            sleep_start = user.sleep_start_iso()
+            if sleep_start is not None:
+                record = {
+                    'sleep_start': sleep_start,
+                    'sleep_end': event['sleep_end'],
+                    'duration_minutes': event['duration_minutes']
+                }
+                session = user.session
+                try:
+                    if session is None:
+                        raise ValueError(sleep_start)
+                    end_us, end_offset = parse_iso(event['sleep_end'])
+                    user.records.append(session.start_us, session.start_offset, end_us, end_offset, event['duration_minutes'])
+                except (TypeError, ValueError):
+                    user.records.append_dict(record)
+                self._aggregates[user_id].add(record)
+                user.session = None
+                if user.extra is not None:
+                    user.extra.pop('sleep_start', None)
+            user.is_sleeping = False
+            if event.get('mark_wake', True):
+                user.sleep_end = event['sleep_end']
+            return record
+        elif op == 'clear_wake':
+            user.sleep_end = None
+        elif op == 'fold':
+            old, user.records = user.records.split_before(event['before'], _latest_valid_index(user.records))
+            valid = [record['duration_minutes'] for record in old if SleepAggregate.is_valid(record)]
+            if valid:
+                archived = user.archived or {'count': 0, 'total_minutes': 0}
+                user.archived = {
+                    'count': archived.get('count', 0) + len(valid),
+                    'total_minutes': archived.get('total_minutes', 0) + sum(valid)
+                }
+        elif op == 'import':
+            aggregate = self._aggregates[user_id]
+            for record in event['records']:
+                user.records.append_dict(record)
+                aggregate.add(record)
+            # 古いバックアップなどは既存の記録より前に入れ、最新の記録（表示・保持期間で残す記録）を取り違えない
+            records = user.records.sorted_by_start()
+            if records is not user.records:
+                user.records = records
+                latest = _latest_valid_index(records)
+                aggregate.latest_record = records[latest] if latest is not None else None
+        return None
+
+    # ---- 永続化 ----
+
+    def _open_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+        # バイナリで開く（チェックポイントの位置はバイト数で数えるので、改行の変換が入らないように）
+        self._journal = open(self.journal_path, 'ab')
+        self._journal_events = 0
+        self._journal_size = os.path.getsize(self.journal_path)
+
+    def _write_line(self, event: dict):
+        line = (json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        self._journal.write(line)
+        size = len(line)
+        self._journal_size += size
+        self.bytes_written += size
+
+    def _append(self, event: dict):
+        self._write_line(event)
+        if not self._batch_depth:
+            self._journal.flush()
+        self._journal_events += 1
+        self.mark_dirty()
+
+    @contextlib.contextmanager
+    def batch(self):
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._journal is not None:
+                self._journal.flush()
+
+    def mark_dirty(self):
+        self._dirty = True
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # イベントループ外（スクリプト等）では即座に書き出す
+            self.flush()
+            return
+        self._flush_handle = loop.call_later(self.flush_delay, self._on_flush_timer)
+
+    def _on_flush_timer(self):
+        self._flush_handle = None
+        if self.io is not None:
+            asyncio.ensure_future(self._flush_in_background())
+            return
+        try:
+            self.flush()
+        except OSError as e:
+            print(f'睡眠データの保存中にエラーが発生しました: {e}')
+            self._schedule_flush()
+
+    async def _flush_in_background(self):
+        try:
+            await self.flush_async()
+        except OSError as e:
+            print(f'睡眠データの保存中にエラーが発生しました: {e}')
+            self._schedule_flush()
+
+    async def flush_async(self):
+        # flush() と同じことを I/O スレッドで行う。同時に呼ばれた保存は1回にまとめる
+        if self.io is None:
+            self.flush()
+            return
+        await self.io.save(self.path, self._flush_on_io)
+
+    async def _flush_on_io(self):
+        if not self._dirty or self._journal is None:
+            return
+        # 保存中に来た変更は、次の保存で書き出す
+        self._dirty = False
+        try:
+            self._journal.flush()
+            if self._journal_events >= self.compact_every:
+                await self._compact_on_io()
+            else:
+                await self.io.run(os.fsync, self._journal.fileno())
+        except BaseException:
+            self._dirty = True
+            raise
+
+    def flush(self):
+        # ジャーナルをディスクに同期し、溜まっていればスナップショットへ圧縮する
+        if not self._dirty:
+            return
+        if self._journal_events >= self.compact_every:
+            self.compact()
+        else:
+            os.fsync(self._journal.fileno())
+        self._dirty = False
+
+    def compact(self):
+        digest, size = _atomic_write_chunks(self.path, _snapshot_bytes(self._users))
+        header = json.dumps({'base': digest}) + '\n'
+        _atomic_write(self.journal_path, header.encode('utf-8'))
+        self.bytes_written += size + len(header)
+        self._open_journal()
+
+    async def _compact_on_io(self):
+        # compact() を I/O スレッドで行う。
+        # 1. 今の状態を固定し（以降の変更はコピーオンライト）、一時ファイルに書き出す
+        # 2. ジャーナルにチェックポイント（新しいスナップショットのハッシュと、固定した時点の位置）を書いてから差し替える
+        # 3. ジャーナルを、固定した時点より後のイベントだけのものに置き換える
+        # どこで止まっても、起動時にスナップショットとジャーナル（チェックポイント）から同じ状態に戻る
+        offset = self._journal_size
+        events = self._journal_events
+        self._frozen = dict(self._users)
+        try:
+            tmp_path, digest, size = await self.io.run(_write_snapshot_tmp, self.path, self._frozen)
+        finally:
+            self._frozen = None
+        self.bytes_written += size
+        self._write_line({'op': 'checkpoint', 'base': digest, 'offset': offset})
+        self._journal.flush()
+        await self.io.run(_fsync_and_replace, self._journal.fileno(), tmp_path, self.path)
+
+        header = json.dumps({'base': digest}) + '\n'
+        self._journal.flush()
+        end = self._journal_size
+        journal_tmp = await self.io.run(_write_journal_tail, self.journal_path, header, offset, end)
+        # I/O スレッドで書いている間に追記された分（少量）を足してから差し替える
+        self._journal.flush()
+        with open(self.journal_path, 'rb') as src:
+            src.seek(end)
+            extra = src.read()
+        with open(journal_tmp, 'ab') as dst:
+            dst.write(extra)
+        os.replace(journal_tmp, self.journal_path)
+        remaining = self._journal_events - events
+        self._open_journal()
+        self._journal_events = remaining
+        self.bytes_written += self._journal_size
+
+    def close(self):
+        # シャットダウン時に必ず呼ぶ。ジャーナルをスナップショットに取り込んで閉じる
+        # （io を使っている場合は、先に io.shutdown() で書き出し中の処理を終わらせておく）
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._frozen = None
+        if self._journal is None:
+            return
+        if self._journal_events:
+            self.compact()
+        self._journal.close()
+        self._journal = None
+        self._dirty = False
+
+
+def _latest_valid_index(records: SleepRecords) -> Optional[int]:
+    # SleepAggregate.latest_record にあたる記録の位置
+    for i in range(len(records) - 1, -1, -1):
+        if SleepAggregate.is_valid(records[i]):
+            return i
+    return None
+
+
+def _snapshot_bytes(users: dict):
+    # json.dump(data, indent=2) と同じ出力を、ユーザー1人分ずつ作る
+    if not users:
+        yield b'{}'
+        return
+    separator = '{\n  '
+    for user_id, user in users.items():
+        yield (separator + json.dumps(user_id, ensure_ascii=False) + ': ' + user.dump_json('  ')).encode('utf-8')
+        separator = ',\n  '
+    yield b'\n}'
+
+
+def _find_checkpoint(f, snapshot_hash: Optional[str]) -> Optional[int]:
+    # snapshot_hash のチェックポイントがあれば、再生を始める位置を返す
+    if snapshot_hash is None:
+        return None
+    for line in f:
+        if not line.startswith(CHECKPOINT_PREFIX):
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return None
+        if event.get('op') == 'checkpoint' and event.get('base') == snapshot_hash:
+            return event['offset']
+    return None
+
+
+def _write_snapshot_tmp(path: str, users: dict):
+    # I/O スレッドで実行する。一時ファイルに書いて fsync し、(一時ファイル, sha1, サイズ) を返す（差し替えはしない）
+    tmp_path = path + '.tmp'
+    digest, size = _write_chunks(tmp_path, _snapshot_bytes(users))
+    return tmp_path, digest, size
+
+
+def _fsync_and_replace(journal_fd: int, tmp_path: str, path: str):
+    # チェックポイントを書いたジャーナルを確定させてから、スナップショットを差し替える
+    os.fsync(journal_fd)
+    os.replace(tmp_path, path)
+
+
+def _write_journal_tail(journal_path: str, header: str, start: int, end: int) -> str:
+    # 新しいジャーナル（ヘッダー + start から end までのイベント）を一時ファイルに書き、そのパスを返す
+    tmp_path = journal_path + '.tmp'
+    with open(journal_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        dst.write(header.encode('utf-8'))
+        src.seek(start)
+        for line in src.read(end - start).splitlines(keepends=True):
+            if not line.startswith(CHECKPOINT_PREFIX):
+                dst.write(line)
+        dst.flush()
+        os.fsync(dst.fileno())
+    return tmp_path
+
+
+def _write_chunks(path: str, chunks):
+    digest = hashlib.sha1()
+    size = 0
+    with open(path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    return digest.hexdigest(), size
+
+
+def _atomic_write_chunks(path: str, chunks):
+    # 一時ファイルに書いてから差し替える。書いた内容の sha1 とサイズを返す
+    tmp_path = path + '.tmp'
+    digest, size = _write_chunks(tmp_path, chunks)
+    os.replace(tmp_path, path)
+    return digest, size
+
+
+def _atomic_write(path: str, raw: bytes):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
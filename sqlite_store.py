@@ -0,0 +1,411 @@
+import contextlib
+import os
+import sqlite3
+import sys
+from typing import Optional
+
+from sleep_records import parse_iso
+from sleep_store import MAX_VALID_SLEEP_MINUTES, JsonSleepStore, SleepAggregate, SleepStore
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    is_sleeping INTEGER NOT NULL DEFAULT 0,
+    sleep_end TEXT
+);
+CREATE TABLE IF NOT EXISTS sleep_sessions (
+    user_id TEXT PRIMARY KEY REFERENCES users (user_id) ON DELETE CASCADE,
+    sleep_start TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sleep_records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+    sleep_start TEXT NOT NULL,
+    sleep_end TEXT NOT NULL,
+    duration_minutes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sleep_records_user_start ON sleep_records (user_id, sleep_start);
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id TEXT PRIMARY KEY REFERENCES users (user_id) ON DELETE CASCADE,
+    record_count INTEGER NOT NULL DEFAULT 0,
+    total_minutes INTEGER NOT NULL DEFAULT 0,
+    latest_record_id INTEGER
+);
+"""
+
+# user_stats が無い（古いスキーマの）ユーザーの集計を sleep_records から作り直す
+REBUILD_STATS = """
+INSERT INTO user_stats (user_id, record_count, total_minutes, latest_record_id)
+SELECT u.user_id,
+       (SELECT COUNT(*) FROM sleep_records r WHERE r.user_id = u.user_id AND r.duration_minutes < :max_minutes),
+       (SELECT COALESCE(SUM(duration_minutes), 0) FROM sleep_records r WHERE r.user_id = u.user_id AND r.duration_minutes < :max_minutes),
+       (SELECT MAX(id) FROM sleep_records r WHERE r.user_id = u.user_id AND r.duration_minutes < :max_minutes)
+FROM users u
+WHERE u.user_id NOT IN (SELECT user_id FROM user_stats)
+"""
+
+
+class SqliteSleepStore(SleepStore):
+    # 標準ライブラリの sqlite3 を使うバックエンド。
+    # 1ユーザーの状態・記録の取得はすべて user_id のインデックスを使う点検索になる。
+    # 各更新は1トランザクションでコミットされ、WAL モードなのでクラッシュしても途中状態は残らない。
+
+    def __init__(self, path: str, migrate_from: Optional[str] = None):
+        super().__init__()
+        self.path = path
+        self.migrate_from = migrate_from
+        self._conn: Optional[sqlite3.Connection] = None
+        self._in_batch = False
+
+    def load(self):
+        is_new = not os.path.exists(self.path)
+        # 起動時は別スレッドで読み込むことがある（使うのは常に1スレッドずつ）
+        self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA foreign_keys=ON')
+        self._conn.executescript(SCHEMA)
+        self._conn.execute(REBUILD_STATS, {'max_minutes': MAX_VALID_SLEEP_MINUTES})
+        if is_new and self.migrate_from and os.path.exists(self.migrate_from):
+            count = migrate_json_to_sqlite(self.migrate_from, self)
+            print(f'{self.migrate_from} から {count}人分の睡眠データを移行しました。')
+
+    def flush(self):
+        # 各更新はコミット済み
+        pass
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # ---- 読み取り ----
+
+    def __contains__(self, user_id) -> bool:
+        row = self._conn.execute('SELECT 1 FROM users WHERE user_id = ?', (str(user_id),)).fetchone()
+        return row is not None
+
+    def user_ids(self):
+        return [row[0] for row in self._conn.execute('SELECT user_id FROM users')]
+
+    def get_state(self, user_id) -> Optional[dict]:
+        row = self._conn.execute(
+            'SELECT u.is_sleeping, u.sleep_end, s.sleep_start FROM users u '
+            'LEFT JOIN sleep_sessions s ON s.user_id = u.user_id WHERE u.user_id = ?',
+            (str(user_id),)
+        ).fetchone()
+        if row is None:
+            return None
+        state = {'is_sleeping': bool(row['is_sleeping'])}
+        if row['sleep_start'] is not None:
+            state['sleep_start'] = row['sleep_start']
+        if row['sleep_end'] is not None:
+            state['sleep_end'] = row['sleep_end']
+        return state
+
+    def get_sleep_summary(self, user_id) -> dict:
+        row = self._conn.execute(
+            'SELECT st.record_count, st.total_minutes, r.sleep_start, r.sleep_end, r.duration_minutes '
+            'FROM user_stats st LEFT JOIN sleep_records r ON r.id = st.latest_record_id '
+            'WHERE st.user_id = ?',
+            (str(user_id),)
+        ).fetchone()
+        if row is None:
+            return {'count': 0, 'total_minutes': 0, 'latest_record': None}
+        latest_record = None
+        if row['sleep_start'] is not None:
+            latest_record = {
+                'sleep_start': row['sleep_start'],
+                'sleep_end': row['sleep_end'],
+                'duration_minutes': row['duration_minutes']
+            }
+        return {
+            'count': row['record_count'],
+            'total_minutes': row['total_minutes'],
+            'latest_record': latest_record
+        }
+
+    def get_records(self, user_id) -> list:
+        rows = self._conn.execute(
+            'SELECT sleep_start, sleep_end, duration_minutes FROM sleep_records '
+            'WHERE user_id = ? ORDER BY sleep_start, id',
+            (str(user_id),)
+        )
+        return [dict(row) for row in rows]
+
+    def get_status_snapshot(self, user_ids) -> dict:
+        # 1回のレンダリングにつき、変数の上限に収まる単位でまとめて1クエリずつ引く
+        user_ids = [str(user_id) for user_id in user_ids]
+        snapshot = {}
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self._conn.execute(
+                'SELECT u.user_id, u.is_sleeping, u.sleep_end, s.sleep_start, '
+                'st.record_count, st.total_minutes, '
+                'r.sleep_start AS latest_start, r.sleep_end AS latest_end, r.duration_minutes AS latest_duration '
+                'FROM users u '
+                'LEFT JOIN sleep_sessions s ON s.user_id = u.user_id '
+                'LEFT JOIN user_stats st ON st.user_id = u.user_id '
+                'LEFT JOIN sleep_records r ON r.id = st.latest_record_id '
+                f'WHERE u.user_id IN ({placeholders})',
+                chunk
+            )
+            for row in rows:
+                state = {'is_sleeping': bool(row['is_sleeping'])}
+                if row['sleep_start'] is not None:
+                    state['sleep_start'] = row['sleep_start']
+                if row['sleep_end'] is not None:
+                    state['sleep_end'] = row['sleep_end']
+                latest_record = None
+                if row['latest_start'] is not None:
+                    latest_record = {
+                        'sleep_start': row['latest_start'],
+                        'sleep_end': row['latest_end'],
+                        'duration_minutes': row['latest_duration']
+                    }
+                summary = {
+                    'count': row['record_count'] or 0,
+                    'total_minutes': row['total_minutes'] or 0,
+                    'latest_record': latest_record
+                }
+                snapshot[row['user_id']] = (state, summary)
+        return snapshot
+
+    # ---- 更新 ----
+
+    def start_sleep(self, user_id, sleep_start: str):
+        user_id = str(user_id)
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO users (user_id, is_sleeping) VALUES (?, 1) '
+                'ON CONFLICT (user_id) DO UPDATE SET is_sleeping = 1',
+                (user_id,)
+            )
+            conn.execute('INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)', (user_id,))
+            conn.execute(
+                'INSERT OR REPLACE INTO sleep_sessions (user_id, sleep_start) VALUES (?, ?)',
+                (user_id, sleep_start)
+            )
+        self._notify(user_id, 'sleep')
+
+    def end_sleep(self, user_id, sleep_end: str, duration_minutes: int, mark_wake: bool = True) -> Optional[dict]:
+        user_id = str(user_id)
+        record = None
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+            conn.execute('INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)', (user_id,))
+            row = conn.execute('SELECT sleep_start FROM sleep_sessions WHERE user_id = ?', (user_id,)).fetchone()
+            if row is not None:
+                record = {
+                    'sleep_start': row['sleep_start'],
+                    'sleep_end': sleep_end,
+                    'duration_minutes': duration_minutes
+                }
+                cursor = conn.execute(
+                    'INSERT INTO sleep_records (user_id, sleep_start, sleep_end, duration_minutes) VALUES (?, ?, ?, ?)',
+                    (user_id, record['sleep_start'], sleep_end, duration_minutes)
+                )
+                if duration_minutes < MAX_VALID_SLEEP_MINUTES:
+                    conn.execute(
+                        'UPDATE user_stats SET record_count = record_count + 1, '
+                        'total_minutes = total_minutes + ?, latest_record_id = ? WHERE user_id = ?',
+                        (duration_minutes, cursor.lastrowid, user_id)
+                    )
+                conn.execute('DELETE FROM sleep_sessions WHERE user_id = ?', (user_id,))
+            if mark_wake:
+                conn.execute('UPDATE users SET is_sleeping = 0, sleep_end = ? WHERE user_id = ?', (sleep_end, user_id))
+            else:
+                conn.execute('UPDATE users SET is_sleeping = 0 WHERE user_id = ?', (user_id,))
+        self._notify(user_id, 'wake', record)
+        return record
+
+    def clear_wake(self, user_id):
+        with self._transaction() as conn:
+            conn.execute('UPDATE users SET sleep_end = NULL WHERE user_id = ?', (str(user_id),))
+        self._notify(str(user_id), 'clear_wake')
+
+    def clear_user(self, user_id) -> bool:
+        with self._transaction() as conn:
+            cursor = conn.execute('DELETE FROM users WHERE user_id = ?', (str(user_id),))
+        if cursor.rowcount == 0:
+            return False
+        self._notify(str(user_id), 'clear')
+        return True
+
+    def add_records(self, user_id, records: list):
+        if not records:
+            return
+        user_id = str(user_id)
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+            conn.execute('INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)', (user_id,))
+            # 最新の記録は、今の最新より後に起きた記録を取り込んだときだけ差し替える（古いバックアップの取り込み）
+            row = conn.execute(
+                'SELECT r.sleep_end FROM user_stats st JOIN sleep_records r ON r.id = st.latest_record_id '
+                'WHERE st.user_id = ?',
+                (user_id,)
+            ).fetchone()
+            latest_end = _end_us(row['sleep_end']) if row is not None else None
+            count = 0
+            total = 0
+            latest_id = None
+            for record in records:
+                cursor = conn.execute(
+                    'INSERT INTO sleep_records (user_id, sleep_start, sleep_end, duration_minutes) VALUES (?, ?, ?, ?)',
+                    (user_id, record['sleep_start'], record['sleep_end'], record['duration_minutes'])
+                )
+                if record['duration_minutes'] < MAX_VALID_SLEEP_MINUTES:
+                    count += 1
+                    total += record['duration_minutes']
+                    end_us = _end_us(record['sleep_end'])
+                    if latest_end is None or (end_us is not None and end_us >= latest_end):
+                        latest_end = end_us
+                        latest_id = cursor.lastrowid
+            if count:
+                conn.execute(
+                    'UPDATE user_stats SET record_count = record_count + ?, total_minutes = total_minutes + ?, '
+                    'latest_record_id = COALESCE(?, latest_record_id) WHERE user_id = ?',
+                    (count, total, latest_id, user_id)
+                )
+        for record in records:
+            self._notify(user_id, 'import', record)
+
+    def _old_rows(self, user_id: str, cutoff_us: int) -> list:
+        rows = self._conn.execute(
+            'SELECT r.id, r.sleep_start, r.sleep_end, r.duration_minutes FROM sleep_records r '
+            'LEFT JOIN user_stats st ON st.user_id = r.user_id '
+            'WHERE r.user_id = ? AND r.id IS NOT st.latest_record_id ORDER BY r.sleep_start, r.id',
+            (user_id,)
+        )
+        old = []
+        for row in rows:
+            try:
+                end_us, _ = parse_iso(row['sleep_end'])
+            except (TypeError, ValueError):
+                continue
+            if end_us < cutoff_us:
+                old.append(row)
+        return old
+
+    def records_before(self, user_id, cutoff_us: int) -> list:
+        return [
+            {'sleep_start': row['sleep_start'], 'sleep_end': row['sleep_end'], 'duration_minutes': row['duration_minutes']}
+            for row in self._old_rows(str(user_id), cutoff_us)
+        ]
+
+    def fold_records(self, user_id, cutoff_us: int):
+        # user_stats は累計のままにする（アーカイブに移した記録も平均に含める）
+        user_id = str(user_id)
+        with self._transaction() as conn:
+            old = self._old_rows(user_id, cutoff_us)
+            conn.executemany('DELETE FROM sleep_records WHERE id = ?', [(row['id'],) for row in old])
+        if old:
+            self._notify(user_id, 'fold')
+
+    def _transaction(self):
+        if self._in_batch:
+            # batch() の外側のトランザクションにまとめる
+            return contextlib.nullcontext(self._conn)
+        return _Transaction(self._conn)
+
+    @contextlib.contextmanager
+    def batch(self):
+        if self._in_batch:
+            yield self
+            return
+        with _Transaction(self._conn):
+            self._in_batch = True
+            try:
+                yield self
+            finally:
+                self._in_batch = False
+
+    def import_user(self, user_id, user_data: dict) -> int:
+        # sleep_data.json 形式の1ユーザー分をそのまま書き込む（移行用）。
+        # sleep_start / sleep_end のない記録は書き込めないので飛ばし、飛ばした件数を返す
+        user_id = str(user_id)
+        conn = self._conn
+        conn.execute(
+            'INSERT OR REPLACE INTO users (user_id, is_sleeping, sleep_end) VALUES (?, ?, ?)',
+            (user_id, int(bool(user_data.get('is_sleeping', False))), user_data.get('sleep_end'))
+        )
+        if user_data.get('sleep_start') is not None:
+            conn.execute(
+                'INSERT OR REPLACE INTO sleep_sessions (user_id, sleep_start) VALUES (?, ?)',
+                (user_id, user_data['sleep_start'])
+            )
+        aggregate = SleepAggregate()
+        archived = user_data.get('archived_summary') or {}
+        aggregate.count = archived.get('count', 0)
+        aggregate.total_minutes = archived.get('total_minutes', 0)
+        latest_record_id = None
+        skipped = 0
+        for record in user_data.get('sleep_records', []):
+            if record.get('sleep_start') is None or record.get('sleep_end') is None:
+                skipped += 1
+                continue
+            cursor = conn.execute(
+                'INSERT INTO sleep_records (user_id, sleep_start, sleep_end, duration_minutes) VALUES (?, ?, ?, ?)',
+                (user_id, record['sleep_start'], record['sleep_end'], record.get('duration_minutes', 0))
+            )
+            if aggregate.is_valid(record):
+                aggregate.add(record)
+                latest_record_id = cursor.lastrowid
+        conn.execute(
+            'INSERT OR REPLACE INTO user_stats (user_id, record_count, total_minutes, latest_record_id) VALUES (?, ?, ?, ?)',
+            (user_id, aggregate.count, aggregate.total_minutes, latest_record_id)
+        )
+        return skipped
+
+
+def _end_us(sleep_end) -> Optional[int]:
+    try:
+        return parse_iso(sleep_end)[0]
+    except (TypeError, ValueError):
+        return None
+
+
+class _Transaction:
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
+
+
+def migrate_json_to_sqlite(json_path: str, target: SqliteSleepStore) -> int:
+    # ジャーナルも含めて JSON ストアを読み込み、1トランザクションで SQLite に書き込む。
+    # 元のファイルは読むだけで書き換えない（失敗してもそのままやり直せるように）
+    source = JsonSleepStore(json_path)
+    source.load(read_only=True)
+    count = 0
+    skipped = 0
+    with target.batch():
+        for user_id in list(source.user_ids()):
+            skipped += target.import_user(user_id, source.get_user_data(user_id))
+            count += 1
+    if skipped:
+        print(f'開始・終了時刻のない睡眠記録 {skipped}件は移行しませんでした。')
+    return count
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('使い方: python sqlite_store.py sleep_data.json sleep_data.db')
+        sys.exit(1)
+    if os.path.exists(sys.argv[2]):
+        print(f'エラー: {sys.argv[2]} は既に存在します')
+        sys.exit(1)
+    store = SqliteSleepStore(sys.argv[2], migrate_from=sys.argv[1])
+    store.load()
+    store.close()
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+# コマンドツリーのハッシュを保存するファイル（アプリケーションIDごと）
+TREE_HASH_FILE = '.command_tree_hash'
+
+
+class StartupTimer:
+    # 起動の各段階にかかった時間を記録して表示する。started はプロセス開始時の time.perf_counter()
+
+    def __init__(self, started: Optional[float] = None):
+        self.started = started if started is not None else time.perf_counter()
+        self.phases = []
+        self._marked = set()
+
+    def record(self, name: str, seconds: float):
+        self.phases.append((name, seconds))
+        print(f'[起動] {name}: {seconds * 1000:.0f}ms')
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def mark(self, name: str):
+        # プロセス開始からの経過時間を1度だけ記録する（接続完了・最初のインタラクションなど）
+        if name in self._marked:
+            return
+        self._marked.add(name)
+        self.record(name, time.perf_counter() - self.started)
+
+
+def command_tree_hash(tree) -> str:
+    # 登録されているコマンドの定義（Discord に送る形）のハッシュ
+    payload = sorted(
+        (command.to_dict(tree) for command in tree.get_commands()),
+        key=lambda command: (command.get('type', 1), command['name'])
+    )
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _read_hashes(path: str) -> dict:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+async def sync_tree_if_changed(tree, application_id, path: str = TREE_HASH_FILE) -> Optional[int]:
+    # 前回同期したときからコマンドが変わっている場合だけ同期する。同期したらコマンド数、しなければ None
+    key = str(application_id)
+    digest = command_tree_hash(tree)
+    hashes = _read_hashes(path)
+    if hashes.get(key) == digest:
+        return None
+    synced = await tree.sync()
+    hashes[key] = digest
+    # 一時ファイルはプロセスごとに分ける（シャードごとのプロセスが同じ一時ファイルを書かないように）
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(hashes, f)
+    os.replace(tmp_path, path)
+    return len(synced)
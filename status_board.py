@@ -0,0 +1,219 @@
+import asyncio
+import json
+import os
+import time
+from typing import Optional
+
+import discord
+
+from outbound import housekeeping
+from sleep_store import _atomic_write
+
+# 各ボタンで全員分の embed を新しく送る代わりに、チャンネルごとに1つのステータス掲示板のメッセージを置いて書き換える。
+#  - 更新の要求（ボタン・記録の変化）は debounce 秒待ってからまとめ、同じ掲示板の編集は interval 秒に1回まで
+#  - 作り直した内容が前回と同じなら編集しない（行は StatusRenderer のキャッシュから作る）
+#  - 掲示板のメッセージ ID はギルドのデータ置き場（path_of(guild_id)）に保存し、再起動後も同じメッセージを書き換える。
+#    消されていたら新しく送る。ファイルはギルドを受け持つプロセスだけが読み書きする（シャードごとのプロセスで共有しない）
+#  - 編集は後片付け（outbound.housekeeping）として送り、インタラクションへの応答を先に通す
+
+BOARD_FILE = 'status_boards.json'
+
+TITLE = '📊 ステータス'
+DESCRIPTION = 'サーバーのメンバーの睡眠状況'
+EMPTY_DESCRIPTION = 'まだ睡眠記録があるメンバーがいません。「おやすみ」ボタンから記録を開始してください。'
+COLOR = 0x99ffff
+
+
+class StatusBoard:
+    # 1チャンネル分の掲示板
+    __slots__ = ('channel_id', 'guild_id', 'path', 'message_id', 'channel', 'guild', 'message', 'fields',
+                 'due_at', 'last_edit', 'disabled')
+
+    def __init__(self, channel_id: int, guild_id, path: str, message_id: Optional[int] = None):
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        # メッセージ ID を保存するファイル
+        self.path = path
+        self.message_id = message_id
+        self.channel = None
+        self.guild = None
+        self.message = None
+        # 最後に送った (フィールド名, 値) のリスト
+        self.fields = None
+        # 次に編集する時刻（clock の値）。None なら更新の要求はない
+        self.due_at: Optional[float] = None
+        self.last_edit: Optional[float] = None
+        # 送信の権限がないなど、このチャンネルでは掲示板を使えない
+        self.disabled = False
+
+
+class StatusBoardManager:
+    # render(guild) は掲示板のフィールド [(名前, 値)] を返すコルーチン関数。
+    # path_of(guild_id) はそのギルドの掲示板を保存するファイルを返す関数、
+    # resolve_channel(channel_id) は再起動後に保存してあった掲示板のチャンネルを探す関数（見つからなければ None）
+
+    def __init__(self, render, path_of=None, interval: float = 10.0, debounce: float = 1.0,
+                 clock=time.monotonic, resolve_channel=None):
+        self.render = render
+        self.path_of = path_of or (lambda guild_id: BOARD_FILE)
+        self.interval = interval
+        self.debounce = debounce
+        self.clock = clock
+        self.resolve_channel = resolve_channel
+        self._boards: dict = {}
+        # 読み込み済みのファイル
+        self._loaded: set = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self.counters = {'requests': 0, 'coalesced': 0, 'edits': 0, 'sends': 0, 'unchanged': 0, 'errors': 0}
+
+    def __len__(self):
+        return len(self._boards)
+
+    def _load(self, guild_id) -> str:
+        # そのギルドの掲示板のファイルを最初に使うときに読み込み、パスを返す
+        path = self.path_of(guild_id)
+        if path in self._loaded:
+            return path
+        self._loaded.add(path)
+        if not os.path.exists(path):
+            return path
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f'ステータス掲示板の読み込み中にエラーが発生しました: {e}')
+            return path
+        for channel_id, entry in saved.items():
+            if int(channel_id) not in self._boards:
+                self._boards[int(channel_id)] = StatusBoard(int(channel_id), entry.get('guild_id'), path, entry.get('message_id'))
+        return path
+
+    def _save(self, path: str):
+        # そのファイルに属する掲示板だけを書く
+        saved = {
+            str(board.channel_id): {'guild_id': board.guild_id, 'message_id': board.message_id}
+            for board in self._boards.values() if board.path == path and board.message_id is not None
+        }
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _atomic_write(path, json.dumps(saved, indent=2).encode('utf-8'))
+
+    def request(self, channel, guild) -> bool:
+        # そのチャンネルの掲示板の更新を予約する。掲示板を置けないチャンネルなら False
+        if guild is None or channel is None or not hasattr(channel, 'send'):
+            return False
+        path = self._load(guild.id)
+        board = self._boards.get(channel.id)
+        if board is None:
+            board = self._boards[channel.id] = StatusBoard(channel.id, guild.id, path)
+        if board.disabled:
+            return False
+        board.channel = channel
+        board.guild = guild
+        board.guild_id = guild.id
+        self._schedule(board)
+        return True
+
+    def request_guild(self, guild_id):
+        # ギルドの記録が変わったときに、そのギルドの掲示板をすべて更新する（guild_id が None なら全ギルド）
+        self._load(guild_id)
+        for board in self._boards.values():
+            if not board.disabled and (guild_id is None or board.guild_id == guild_id):
+                self._schedule(board)
+
+    def _schedule(self, board: StatusBoard):
+        self.counters['requests'] += 1
+        if board.due_at is not None:
+            self.counters['coalesced'] += 1
+            return
+        due_at = self.clock() + self.debounce
+        if board.last_edit is not None:
+            due_at = max(due_at, board.last_edit + self.interval)
+        board.due_at = due_at
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def next_due(self) -> Optional[float]:
+        due = [board.due_at for board in self._boards.values() if board.due_at is not None]
+        return min(due) if due else None
+
+    async def flush_due(self) -> int:
+        # 予定の時刻を過ぎた掲示板を作り直して送り、編集・送信した数を返す
+        now = self.clock()
+        published = 0
+        for board in [board for board in self._boards.values() if board.due_at is not None and board.due_at <= now]:
+            board.due_at = None
+            try:
+                if await self._publish(board):
+                    published += 1
+            except Exception as e:
+                self.counters['errors'] += 1
+                print(f'ステータス掲示板の更新中にエラーが発生しました: {e}')
+        return published
+
+    async def _publish(self, board: StatusBoard) -> bool:
+        if board.channel is None and self.resolve_channel is not None:
+            board.channel = self.resolve_channel(board.channel_id)
+            board.guild = getattr(board.channel, 'guild', None)
+        if board.channel is None or board.guild is None:
+            return False
+        fields = await self.render(board.guild)
+        board.last_edit = self.clock()
+        if fields == board.fields:
+            self.counters['unchanged'] += 1
+            return False
+        embed = build_embed(fields)
+
+        if board.message is None and board.message_id is not None:
+            board.message = board.channel.get_partial_message(board.message_id)
+        if board.message is not None:
+            try:
+                await board.message.edit(embed=embed)
+                board.fields = fields
+                self.counters['edits'] += 1
+                return True
+            except discord.NotFound:
+                # 掲示板のメッセージが消されていた
+                board.message = None
+                board.message_id = None
+        try:
+            board.message = await board.channel.send(embed=embed)
+        except discord.Forbidden:
+            board.disabled = True
+            print(f'チャンネル {board.channel_id} にステータス掲示板を送る権限がありません。')
+            return False
+        board.message_id = board.message.id
+        board.fields = fields
+        self.counters['sends'] += 1
+        self._save(board.path)
+        return True
+
+    async def run(self, max_sleep: float = 60.0):
+        self._wakeup = asyncio.Event()
+        # 掲示板の編集はすべて後片付けとして扱う
+        with housekeeping():
+            while True:
+                await self.flush_due()
+                timeout = max_sleep
+                due = self.next_due()
+                if due is not None:
+                    timeout = min(timeout, max(0.0, due - self.clock()))
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+
+def build_embed(fields) -> discord.Embed:
+    # 経過時間は Discord の相対時刻の表示に任せるので、内容が変わったときだけ書き換えればよい
+    embed = discord.Embed(
+        title=TITLE,
+        description=DESCRIPTION if fields else EMPTY_DESCRIPTION,
+        color=COLOR,
+        timestamp=discord.utils.utcnow()
+    )
+    for name, value in fields:
+        embed.add_field(name=name, value=value, inline=False)
+    return embed
@@ -0,0 +1,144 @@
+from datetime import datetime
+from typing import Optional
+
+from sleep_store import SleepStore, build_sleep_info
+
+# embed のフィールド値の上限
+FIELD_VALUE_LIMIT = 1024
+
+AWAKE_RESET_SECONDS = 200 * 3600
+
+
+class _CachedLine:
+    __slots__ = ('status_icon', 'is_sleeping', 'since_ts', 'head', 'tail')
+
+    def __init__(self, status_icon, is_sleeping, since_ts, head, tail):
+        self.status_icon = status_icon
+        self.is_sleeping = is_sleeping
+        self.since_ts = since_ts
+        self.head = head
+        self.tail = tail
+
+
+def format_elapsed(is_sleeping: bool, since_ts: Optional[float], now_ts: float) -> str:
+    if since_ts is None:
+        return ""
+    elapsed = now_ts - since_ts
+    hours = int(elapsed // 3600)
+    minutes = int((elapsed % 3600) // 60)
+    if is_sleeping:
+        return f" ({hours}時間{minutes}分睡眠中)"
+    if elapsed < AWAKE_RESET_SECONDS:
+        return f" ({hours}時間{minutes}分起床中)"
+    return ""
+
+
+def format_since(is_sleeping: bool, since_ts: Optional[float]) -> str:
+    # format_elapsed の代わりに Discord の相対時刻（<t:...:R>）を使う。表示はクライアントが更新するので、行は時間で変わらない。
+    # 起床から200時間を過ぎると ExpiryScheduler が起床時刻を消すので、行もそのときに作り直される
+    if since_ts is None:
+        return ""
+    return f" (<t:{int(since_ts)}:R>から{'睡眠中' if is_sleeping else '起床中'})"
+
+
+class StatusRenderer:
+    # ステータス embed の1メンバー分の行をキャッシュする。
+    # 睡眠状態が変わったとき（ストアの通知）とプレゼンスが変わったときだけ作り直し、
+    # 経過時間の部分だけを毎回タイムスタンプから計算する。
+
+    def __init__(self, store: SleepStore, tz):
+        self.store = store
+        self.tz = tz
+        self._lines: dict = {}
+        store.add_listener(self._on_store_change)
+
+    def _on_store_change(self, user_id, op, record):
+        self._lines.pop(user_id, None)
+
+    def _format_datetime(self, value: Optional[str]) -> str:
+        if not value:
+            return "記録なし"
+        try:
+            return datetime.fromisoformat(value).astimezone(self.tz).strftime('%Y-%m-%d %H:%M')
+        except ValueError:
+            return "日付形式エラー"
+
+    def _build(self, mention: str, status_icon: str, member_info: dict) -> _CachedLine:
+        is_sleeping = member_info['is_sleeping']
+        raw_user_data = member_info['raw_user_data']
+
+        since_ts = None
+        if is_sleeping and 'sleep_start' in raw_user_data:
+            since_ts = datetime.fromisoformat(raw_user_data['sleep_start']).timestamp()
+        elif not is_sleeping and 'sleep_end' in raw_user_data:
+            since_ts = datetime.fromisoformat(raw_user_data['sleep_end']).timestamp()
+
+        status_emoji = "😴" if is_sleeping else "☀️"
+        status_text = "睡眠中" if is_sleeping else "起床中"
+
+        avg_sleep_display = "記録なし"
+        if member_info['average_sleep_minutes'] > 0:
+            avg_hours = int(member_info['average_sleep_minutes'] // 60)
+            avg_minutes = int(member_info['average_sleep_minutes'] % 60)
+            avg_sleep_display = f"{avg_hours}時間{avg_minutes}分"
+
+        head = f"{mention} {status_emoji} **{status_text}**"
+        tail = (
+            f"  最後に寝た時間: {self._format_datetime(member_info['last_sleep_start'])}\n"
+            f"  最後に起きた時間: {self._format_datetime(member_info['last_sleep_end'])}\n"
+            f"  平均睡眠時間: {avg_sleep_display}"
+        )
+        return _CachedLine(status_icon, is_sleeping, since_ts, head, tail)
+
+    @staticmethod
+    def _join(line: _CachedLine, now_ts: Optional[float]) -> str:
+        if now_ts is None:
+            elapsed = format_since(line.is_sleeping, line.since_ts)
+        else:
+            elapsed = format_elapsed(line.is_sleeping, line.since_ts, now_ts)
+        return f"{line.head} {elapsed} {line.status_icon}\n{line.tail}"
+
+    def render(self, members, now: Optional[datetime] = None) -> list:
+        # members は (user_id, mention, status_icon) のリスト（表示順）。
+        # ストアに記録のないメンバーは除外する。now を省くと経過時間を相対時刻の表示にする（ステータス掲示板用）
+        now_ts = now.timestamp() if now is not None else None
+        missing = [user_id for user_id, _, _ in members if user_id not in self._lines]
+        snapshot = self.store.get_status_snapshot(missing) if missing else {}
+
+        status_messages = []
+        for user_id, mention, status_icon in members:
+            line = self._lines.get(user_id)
+            if line is None:
+                entry = snapshot.get(user_id)
+                if entry is None:
+                    continue
+                line = self._build(mention, status_icon, build_sleep_info(*entry))
+                self._lines[user_id] = line
+            elif line.status_icon != status_icon:
+                line.status_icon = status_icon
+
+            status_messages.append(self._join(line, now_ts))
+        return status_messages
+
+
+def build_status_fields(status_messages, limit: int = FIELD_VALUE_LIMIT) -> list:
+    # 行を順に積みながら上限ごとにチャンクを切り、(フィールド名, 値) のリストを返す
+    chunks = []
+    current_chunk = []
+    current_chunk_len = 0
+    total_len = 0
+    for msg in status_messages:
+        total_len += len(msg) + (2 if total_len else 0)
+        if current_chunk_len + len(msg) + 2 > limit and current_chunk:
+            chunks.append("\n\n".join(current_chunk))
+            current_chunk = [msg]
+            current_chunk_len = len(msg) + 2
+        else:
+            current_chunk.append(msg)
+            current_chunk_len += len(msg) + 2
+    if current_chunk:
+        chunks.append("\n\n".join(current_chunk))
+
+    if total_len <= limit:
+        return [('メンバーのステータス', "\n\n".join(status_messages))]
+    return [(f'メンバーのステータス ({i+1}/{len(chunks)})', chunk) for i, chunk in enumerate(chunks)]